@@ -2,14 +2,22 @@ import sys
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
     QTableWidget, QTableWidgetItem, QMessageBox, QLineEdit, QDialog, QFormLayout,
-    QDialogButtonBox, QComboBox, QLabel, QSizePolicy, QProgressBar
+    QDialogButtonBox, QComboBox, QLabel, QSizePolicy, QProgressBar, QTableView,
+    QHeaderView, QAbstractItemView, QCheckBox, QFileDialog, QProgressDialog, QShortcut
 )
-from PyQt5.QtCore import Qt, QMargins
-from PyQt5.QtChart import QChart, QChartView, QPieSeries, QPieSlice
-from PyQt5.QtGui import QPainter, QColor, QFont
-import json
+from PyQt5.QtCore import (
+    Qt, QMargins, QAbstractTableModel, QAbstractProxyModel, QModelIndex, QObject, QTimer, pyqtSignal,
+    QDateTime, QEvent, QPointF, QFileSystemWatcher
+)
+from PyQt5.QtGui import QPainter, QColor, QFont, QKeySequence
 import os
-from datetime import datetime
+import threading
+from array import array
+import time
+from datetime import date, datetime
+
+from ledger import API_ENV, REPORT_KINDS, AggregateCache, Ledger, RecordQuery, StatementImporter, format_cents, \
+    guess_import_mapping, lttb, profiler, statement_columns, write_report_csv
 
 # 预算设置对话框
 class BudgetDialog(QDialog):
@@ -189,25 +197,644 @@ class CategoryDialog(QDialog):
             del self.categories[current_type][row]
             self.update_category_list()
 
+# 账单导入对话框: 选择文件并把账单的列对应到记录字段
+class ImportDialog(QDialog):
+    FIELDS = [('date', "日期列:"), ('description', "描述列:"), ('amount', "金额列:"),
+              ('type', "类型列:"), ('category', "分类列:")]
+    NONE = "(无)"
+
+    def __init__(self, parent=None):
+        super(ImportDialog, self).__init__(parent)
+        self.setWindowTitle("导入账单")
+        
+        self.layout = QFormLayout(self)
+        
+        file_layout = QHBoxLayout()
+        self.path_edit = QLineEdit(self)
+        self.path_edit.setReadOnly(True)
+        file_layout.addWidget(self.path_edit)
+        self.browse_button = QPushButton("选择文件", self)
+        self.browse_button.clicked.connect(self.choose_file)
+        file_layout.addWidget(self.browse_button)
+        self.layout.addRow("账单文件:", file_layout)
+        
+        self.combos = {}
+        for field, label in self.FIELDS:
+            combo = QComboBox(self)
+            combo.addItem(self.NONE)
+            self.layout.addRow(label, combo)
+            self.combos[field] = combo
+        
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        self.layout.addWidget(self.buttons)
+    
+    def choose_file(self):
+        path, _ = QFileDialog.getOpenFileName(self, "选择账单文件", "", "账单 (*.csv *.jsonl *.json *.ndjson)")
+        if not path:
+            return
+        try:
+            columns = statement_columns(path)
+        except Exception as e:
+            QMessageBox.warning(self, "警告", f"无法读取账单: {e}")
+            return
+        self.path_edit.setText(path)
+        guessed = guess_import_mapping(columns)
+        for field, combo in self.combos.items():
+            combo.clear()
+            combo.addItem(self.NONE)
+            combo.addItems(columns)
+            if guessed[field]:
+                combo.setCurrentText(guessed[field])
+    
+    def get_data(self):
+        mapping = {field: (combo.currentText() if combo.currentText() != self.NONE else None)
+                   for field, combo in self.combos.items()}
+        return self.path_edit.text(), mapping
+
+# 在后台线程中运行导入, 通过信号把每批记录和进度交回界面线程;
+# 去重要用的某个月已有记录的内容计数也通过信号在界面线程中取, 后台线程等待结果
+class ImportJob(QObject):
+    batch_ready = pyqtSignal(list)
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(dict)
+    hashes_requested = pyqtSignal(str, object)
+
+    def __init__(self, importer, path, parent=None):
+        super(ImportJob, self).__init__(parent)
+        self.importer = importer
+        self.path = path
+        self.thread = threading.Thread(target=self.run, name="ledger-import", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def month_hashes(self, month):
+        from concurrent.futures import Future
+        future = Future()
+        self.hashes_requested.emit(month, future)
+        return future.result()
+
+    def run(self):
+        try:
+            stats = self.importer.run(self.path, self.month_hashes, self.batch_ready.emit, self.progress.emit)
+        except Exception as e:
+            stats = {'error': str(e)}
+        self.finished.emit(stats)
+
+# 记录表格模型: 直接读取记录列表, 只有可见行才会被视图请求数据
+class RecordTableModel(QAbstractTableModel):
+    HEADERS = ["日期", "描述", "金额", "类型", "分类"]
+
+    def __init__(self, records, parent=None):
+        super(RecordTableModel, self).__init__(parent)
+        self.records = records
+        # 每一行对应的记录编号, 增删改和排序都不会让行指向别的记录; 批量导入时记录先追加, 最后统一刷新
+        self.ids = array('q', records.ids)
+        # 是否显示全部记录 (而不是查询结果)
+        self.showing_all = True
+        self.count = len(self.ids)
+        # 分页加载时已显示部分在 records 中的起始行; 显示全部记录时从第 0 行开始
+        self.first_loaded = 0
+        # 脚本接口写入的新记录先记在这里, 由 flush_pending 定时合并插入, 不必每次提交都插入一行重绘一次表格
+        self.pending = []
+        # 记录编号 -> 行号, 同步改动时按编号找行; 用到时才建立, 整体替换或在前面插入行时作废.
+        # records 中删除会把最后一行移到空位, 表格的行与 records 的行不对应, 不能用 records.id_rows
+        self.rows = None
+        self.getters = [records.date, records.description, records.amount_text,
+                        records.type_name, records.category]
+
+    def record_id(self, row):
+        return self.ids[row]
+
+    def row_map(self):
+        if self.rows is None:
+            self.rows = dict(zip(self.ids, range(self.count)))
+        return self.rows
+
+    # 删除行之后调用: 去掉删除的编号, first (删除的最小行号) 之后的行前移
+    def forget_rows(self, record_ids, first):
+        if self.rows is None:
+            return
+        for record_id in record_ids:
+            self.rows.pop(record_id, None)
+        self.rows.update(zip(self.ids[first:], range(first, self.count)))
+
+    # 行对应的记录在 records 中的下标
+    def record_index(self, row):
+        return self.records.id_rows[self.ids[row]]
+
+    # 当前显示的全部记录下标
+    def record_rows(self):
+        return self.records.rows_of(self.ids)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.getters[index.column()](self.record_index(index.row()))
+        if role == Qt.TextAlignmentRole and index.column() == 2:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super(RecordTableModel, self).headerData(section, orientation, role)
+
+    # 排序用原始值: 日期按天数, 金额按分, 其余按文本
+    def column_key(self, column):
+        records = self.records
+        if column == 0:
+            return lambda i: (records.days[i], records.date(i))
+        if column == 2:
+            return records.cents.__getitem__
+        return self.getters[column]
+
+    def sort_key(self, column):
+        key = self.column_key(column)
+        return lambda row: key(self.record_index(row))
+
+    def sort_keys(self, column):
+        key = self.column_key(column)
+        return [key(i) for i in self.record_rows()]
+
+    # rows 为要显示的记录下标, None 表示全部记录
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.showing_all = rows is None
+        if rows is None:
+            self.ids = array('q', self.records.ids)
+        else:
+            ids = self.records.ids
+            self.ids = array('q', (ids[i] for i in rows))
+        self.count = len(self.ids)
+        self.pending = []
+        self.rows = None
+        self.endResetModel()
+
+    # 新记录已追加到 records 之后调用
+    def row_appended(self, record_id):
+        self.pending.append(record_id)
+        self.flush_pending()
+
+    # 一次插入所有待插入的行, 排序代理在行数较多时整体重排
+    def flush_pending(self):
+        if not self.pending:
+            return
+        record_ids, self.pending = self.pending, []
+        row = self.count
+        self.beginInsertRows(QModelIndex(), row, row + len(record_ids) - 1)
+        self.ids.extend(record_ids)
+        self.count += len(record_ids)
+        if self.rows is not None:
+            self.rows.update(zip(record_ids, range(row, self.count)))
+        self.endInsertRows()
+
+    # 分页加载: 已显示的是 records 中从 self.first_loaded 开始的行, 更早的一页 [start, end) 插到最前面
+    def rows_loaded(self, start, end):
+        first = self.first_loaded if self.count else end
+        if start >= first:
+            return
+        self.beginInsertRows(QModelIndex(), 0, first - start - 1)
+        self.ids[0:0] = self.records.ids[start:first]
+        self.first_loaded = start
+        self.count = len(self.ids)
+        self.rows = None
+        self.endInsertRows()
+
+    def row_changed(self, row):
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.HEADERS) - 1))
+
+    # 其他实例的改动已应用到 records 之后调用, changes 为 [(op, 编号)]: 删除的行移除, 编辑的行重绘,
+    # 显示全部记录时追加新记录 (查询结果不变, 下次查询时才包含新记录). 按编号找行, 不扫描全部行.
+    # 先移除已删除的行 (从后往前, 前面的行号不变), 排序代理处理编辑时会读取其余各行的排序键.
+    # defer 为 True 时新记录只记入 pending, 由调用方稍后 flush_pending
+    def records_synced(self, changes, defer=False):
+        deleted = {record_id for op, record_id in changes if op == "delete"}
+        if deleted:
+            self.pending = [record_id for record_id in self.pending if record_id not in deleted]
+            rows = self.row_map()
+            removed = sorted((rows[record_id] for record_id in deleted if record_id in rows), reverse=True)
+            for row in removed:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.ids[row]
+                self.count -= 1
+                self.endRemoveRows()
+            if removed:
+                self.forget_rows(deleted, removed[-1])
+        edited = {record_id for op, record_id in changes if op == "edit"}
+        if edited:
+            rows = self.row_map()
+            for record_id in edited:
+                row = rows.get(record_id)
+                if row is not None:
+                    self.row_changed(row)
+        if self.showing_all:
+            self.pending.extend(record_id for op, record_id in changes if op == "add")
+            if not defer:
+                self.flush_pending()
+    
+    # remove(record_id) 负责从记录中删除, 在 beginRemoveRows / endRemoveRows 之间调用
+    def remove_row(self, row, remove):
+        record_id = self.ids[row]
+        self.beginRemoveRows(QModelIndex(), row, row)
+        remove(record_id)
+        del self.ids[row]
+        self.count -= 1
+        self.forget_rows([record_id], row)
+        self.endRemoveRows()
+
+# 排序代理模型: 用 Python 的 sorted 一次算出行顺序, 源模型增删改时只移动受影响的行
+class RecordSortProxyModel(QAbstractProxyModel):
+    # 一次插入超过这么多行 (分页加载) 时整体重新排序, 不再逐行二分插入
+    BULK_INSERT = 1000
+
+    def __init__(self, parent=None):
+        super(RecordSortProxyModel, self).__init__(parent)
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self.count = 0
+        # 排序后第 i 行对应的源行号, None 表示保持源顺序
+        self.order = None
+        # 源行号 -> 排序后行号, 需要时才重建
+        self.positions = None
+
+    def setSourceModel(self, model):
+        super(RecordSortProxyModel, self).setSourceModel(model)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self.source_reset)
+        model.rowsInserted.connect(self.source_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self.source_rows_about_to_be_removed)
+        model.rowsRemoved.connect(self.source_rows_removed)
+        model.dataChanged.connect(self.source_data_changed)
+        self.source_reset()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def columnCount(self, parent=QModelIndex()):
+        return self.sourceModel().columnCount()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not (0 <= row < self.count and 0 <= column < self.columnCount()):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QModelIndex()):
+        return QModelIndex()
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        row = self.order[index.row()] if self.order is not None else index.row()
+        return self.sourceModel().index(row, index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index(self.proxy_row(index.row()), index.column())
+
+    def proxy_row(self, source_row):
+        if self.order is None:
+            return source_row
+        if self.positions is None:
+            self.positions = [0] * len(self.order)
+            for i, row in enumerate(self.order):
+                self.positions[row] = i
+        return self.positions[source_row]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal:
+            return self.sourceModel().headerData(section, orientation, role)
+        return section + 1 if role == Qt.DisplayRole else None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        old_indexes = self.persistentIndexList()
+        source_indexes = [self.mapToSource(index) for index in old_indexes]
+        self.compute_order()
+        self.changePersistentIndexList(old_indexes, [self.mapFromSource(index) for index in source_indexes])
+        self.layoutChanged.emit()
+
+    def compute_order(self):
+        self.positions = None
+        if self.sort_column < 0:
+            self.order = None
+            return
+        with profiler.span("sort"):
+            keys = self.sourceModel().sort_keys(self.sort_column)
+            self.order = sorted(range(len(keys)), key=keys.__getitem__,
+                                reverse=self.sort_order == Qt.DescendingOrder)
+
+    # 二分查找新行应插入的位置, 相同的值排在已有行之后
+    def insert_position(self, source_row):
+        key = self.sourceModel().sort_key(self.sort_column)
+        value = key(source_row)
+        descending = self.sort_order == Qt.DescendingOrder
+        low, high = 0, len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            other = key(self.order[mid])
+            if (other < value) if descending else (value < other):
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def source_reset(self):
+        self.count = self.sourceModel().rowCount()
+        self.compute_order()
+        self.endResetModel()
+
+    def source_rows_inserted(self, parent, first, last):
+        inserted = last - first + 1
+        if self.order is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+            self.count += inserted
+            self.endInsertRows()
+            return
+        if inserted > self.BULK_INSERT:
+            self.beginResetModel()
+            self.source_reset()
+            return
+        if first < self.count:
+            self.order = [row + inserted if row >= first else row for row in self.order]
+        for source_row in range(first, last + 1):
+            position = self.insert_position(source_row)
+            self.beginInsertRows(QModelIndex(), position, position)
+            self.order.insert(position, source_row)
+            self.positions = None
+            self.count += 1
+            self.endInsertRows()
+
+    def source_rows_about_to_be_removed(self, parent, first, last):
+        if self.order is None:
+            self.beginRemoveRows(QModelIndex(), first, last)
+            self.count -= last - first + 1
+            self.endRemoveRows()
+            return
+        for source_row in range(last, first - 1, -1):
+            position = self.proxy_row(source_row)
+            self.beginRemoveRows(QModelIndex(), position, position)
+            del self.order[position]
+            self.positions = None
+            self.count -= 1
+            self.endRemoveRows()
+
+    def source_rows_removed(self, parent, first, last):
+        if self.order is not None and first < self.count:
+            removed = last - first + 1
+            self.order = [row - removed if row > last else row for row in self.order]
+            self.positions = None
+
+    def source_data_changed(self, top_left, bottom_right, roles=[]):
+        last_column = self.columnCount() - 1
+        for source_row in range(top_left.row(), bottom_right.row() + 1):
+            position = self.proxy_row(source_row)
+            if self.order is not None and top_left.column() <= self.sort_column <= bottom_right.column():
+                # 排序列变了, 把这一行移动到新位置
+                del self.order[position]
+                new_position = self.insert_position(source_row)
+                self.order.insert(position, source_row)
+                destination = new_position + 1 if new_position >= position else new_position
+                if self.beginMoveRows(QModelIndex(), position, position, QModelIndex(), destination):
+                    del self.order[position]
+                    self.order.insert(new_position, source_row)
+                    self.endMoveRows()
+                self.positions = None
+                position = new_position
+            self.dataChanged.emit(self.index(position, 0), self.index(position, last_column))
+
+# 性能面板: 各阶段最近若干次耗时的 p50 / p95 和累计计数, 每秒刷新, 可导出 Chrome trace
+class ProfilerDialog(QDialog):
+    def __init__(self, parent=None):
+        super(ProfilerDialog, self).__init__(parent)
+        self.setWindowTitle("性能面板")
+        self.resize(520, 420)
+        
+        layout = QVBoxLayout(self)
+        self.enabled_check = QCheckBox("启用性能剖析", self)
+        self.enabled_check.setChecked(profiler.enabled)
+        self.enabled_check.toggled.connect(self.set_enabled)
+        layout.addWidget(self.enabled_check)
+        
+        self.phase_table = QTableWidget(0, 5, self)
+        self.phase_table.setHorizontalHeaderLabels(["阶段", "次数", "p50 (ms)", "p95 (ms)", "最近 (ms)"])
+        self.phase_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.phase_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.phase_table)
+        
+        self.counter_label = QLabel(self)
+        self.counter_label.setWordWrap(True)
+        layout.addWidget(self.counter_label)
+        
+        btn_layout = QHBoxLayout()
+        reset_button = QPushButton("清空", self)
+        reset_button.clicked.connect(self.reset)
+        btn_layout.addWidget(reset_button)
+        export_button = QPushButton("导出 Trace...", self)
+        export_button.clicked.connect(self.export_trace)
+        btn_layout.addWidget(export_button)
+        layout.addLayout(btn_layout)
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        self.refresh()
+    
+    def set_enabled(self, checked):
+        profiler.enabled = checked
+    
+    def reset(self):
+        profiler.reset()
+        self.refresh()
+    
+    def refresh(self):
+        if not self.isVisible():
+            return
+        stats = profiler.stats()
+        self.phase_table.setRowCount(len(stats))
+        for row, (name, (count, p50, p95, last)) in enumerate(sorted(stats.items())):
+            values = [name, str(count), f"{p50 * 1000:.2f}", f"{p95 * 1000:.2f}", f"{last * 1000:.2f}"]
+            for column, value in enumerate(values):
+                self.phase_table.setItem(row, column, QTableWidgetItem(value))
+        self.counter_label.setText(" | ".join(
+            f"{name}: {value}" for name, value in sorted(dict(profiler.counters).items())) or "暂无计数")
+    
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "导出 Trace", "ledger-trace.json", "Chrome Trace (*.json)")
+        if not path:
+            return
+        try:
+            count = profiler.export_trace(path)
+            QMessageBox.information(self, "导出完成", f"已导出 {count} 个事件, 可在 chrome://tracing 中打开")
+        except Exception as e:
+            QMessageBox.warning(self, "导出失败", f"导出 Trace 失败: {e}")
+
+# 报表窗口: 选择报表种类和月份区间, 结果来自账本的按月缓存, 可导出 CSV.
+# build_report(kind, month_from, month_to) 返回 (表头, 行)
+class ReportDialog(QDialog):
+    def __init__(self, build_report, parent=None):
+        super(ReportDialog, self).__init__(parent)
+        self.setWindowTitle("报表")
+        self.resize(900, 500)
+        self.build_report = build_report
+        self.header = []
+        self.rows = []
+        
+        layout = QVBoxLayout(self)
+        option_layout = QHBoxLayout()
+        self.kind_combo = QComboBox(self)
+        for kind, name in REPORT_KINDS.items():
+            self.kind_combo.addItem(name, kind)
+        option_layout.addWidget(self.kind_combo)
+        now = datetime.now()
+        self.month_from_edit = QLineEdit(f"{now.year}-01", self)
+        self.month_from_edit.setPlaceholderText("起始月份 YYYY-MM")
+        option_layout.addWidget(self.month_from_edit)
+        self.month_to_edit = QLineEdit(now.strftime("%Y-%m"), self)
+        self.month_to_edit.setPlaceholderText("结束月份 YYYY-MM")
+        option_layout.addWidget(self.month_to_edit)
+        self.run_button = QPushButton("生成", self)
+        self.run_button.clicked.connect(self.refresh)
+        option_layout.addWidget(self.run_button)
+        self.export_button = QPushButton("导出 CSV...", self)
+        self.export_button.clicked.connect(self.export_csv)
+        option_layout.addWidget(self.export_button)
+        layout.addLayout(option_layout)
+        self.kind_combo.currentIndexChanged.connect(self.refresh)
+        
+        self.table = QTableWidget(0, 0, self)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        layout.addWidget(self.table)
+    
+    # 返回 (起始月份, 结束月份), 格式不对时提示并返回 None
+    def month_range(self):
+        months = [self.month_from_edit.text().strip(), self.month_to_edit.text().strip()]
+        try:
+            for month in months:
+                datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            QMessageBox.warning(self, "警告", "月份格式应为 YYYY-MM")
+            return None
+        return min(months), max(months)
+    
+    def refresh(self):
+        months = self.month_range()
+        if months is None:
+            return
+        self.header, self.rows = self.build_report(self.kind_combo.currentData(), *months)
+        self.table.clear()
+        self.table.setColumnCount(len(self.header))
+        self.table.setHorizontalHeaderLabels(self.header)
+        self.table.setRowCount(len(self.rows))
+        for row, values in enumerate(self.rows):
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 0 and value[:1] in tuple("-0123456789"):
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+    
+    def export_csv(self):
+        if not self.header:
+            self.refresh()
+        name = f"{self.kind_combo.currentData()}.csv"
+        path, _ = QFileDialog.getSaveFileName(self, "导出报表", name, "CSV 文件 (*.csv)")
+        if not path:
+            return
+        try:
+            write_report_csv(path, self.header, self.rows)
+            QMessageBox.information(self, "导出完成", f"已导出 {len(self.rows)} 行")
+        except Exception as e:
+            QMessageBox.warning(self, "导出失败", f"导出报表失败: {e}")
+
 # 主窗口类
 class MainWindow(QMainWindow):
-    def __init__(self):
+    # 后台保存线程通过信号把状态交回界面线程
+    save_status_changed = pyqtSignal(str, object)
+    # 分页加载线程通过信号交回每一页 (起始行, 结束行, 聚合结果) 和结束时的错误
+    records_page_loaded = pyqtSignal(int, int, object)
+    records_loaded = pyqtSignal(object)
+    # 保存线程把读到的其他实例的改动交回界面线程
+    changes_pulled = pyqtSignal(object)
+    # 脚本接口线程把 (函数, Future) 交给界面线程执行
+    api_call = pyqtSignal(object)
+    # 两次图表更新间隔小于这个秒数时视为连续更新, 不播放动画
+    CHART_BURST_INTERVAL = 0.5
+    # 饼图最多显示的扇区数 (含 "其他") 和单独显示所需的最小占比
+    PIE_MAX_SLICES = 8
+    PIE_FOLD_RATIO = 0.03
+    # 趋势图至少保留的点数, 图表还没有布局 (宽度很小) 时使用
+    TREND_MIN_POINTS = 200
+    # 预算进度条按级别 (正常 / 超过 80% / 超支) 着色
+    BUDGET_COLORS = ("#4CAF50", "#FFC107", "#F44336")
+    # 账本文件变化的通知在这么多毫秒内合并为一次同步 (一次保存会改动多个文件)
+    SYNC_DELAY = 300
+    # 脚本接口连续写入时, 统计、图表和预算进度最多每隔这么多毫秒刷新一次 (表格逐行即时更新)
+    API_REFRESH_INTERVAL = 200
+
+    # ledger 为 None 时按默认存储后端在后台分页加载当前目录下的账本, 窗口可以立即显示
+    def __init__(self, ledger=None):
         super(MainWindow, self).__init__()
         self.setWindowTitle("个人记账管理系统 - 带预算功能")
         self.resize(1200, 750)
         
-        self.categories = {
-            "支出": ["餐饮", "交通", "购物", "娱乐", "住房"],
-            "收入": ["工资", "奖金", "投资", "兼职"]
-        }
-        self.budgets = []
-        self.records = []
-        
-        self.load_categories()
-        self.load_records()
-        self.load_budgets()
+        paged = ledger is None
+        if paged:
+            ledger = Ledger(paged=True)
+        self.ledger = ledger
+        self.ledger.writer.on_status = self.save_status_changed.emit
+        # 组合查询生效时, 统计和饼图改为显示查询结果的聚合
+        self.query_aggregates = None
+        # 导入账单时出现了新分类, 导入结束后保存
+        self.categories_changed = False
+        # 图表在第一次显示时才创建, 启动时不加载 QtChart
+        self.chart_panel = None
+        self.chart_view = None
+        self.trend_view = None
+        # 饼图各分类对应的扇区 (只增不删) 和颜色, 以及上次显示的内容; 趋势图上次显示的 (按日, 宽度, 数据点)
+        self.pie_slices = {}
+        self.slice_colors = {}
+        self.pie_state = None
+        self.trend_state = None
+        self.last_chart_update = 0
+        self.import_job = None
         
         self.init_ui()
+        
+        # 其他实例 (或导入脚本) 写入账本文件后, 只读取增量并更新界面
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(self.SYNC_DELAY)
+        self.sync_timer.timeout.connect(self.sync_external_changes)
+        self.file_watcher = QFileSystemWatcher(self)
+        self.file_watcher.fileChanged.connect(self.schedule_sync)
+        self.file_watcher.directoryChanged.connect(self.schedule_sync)
+        self.changes_pulled.connect(self.apply_external_changes)
+        self.watch_ledger_files()
+        
+        # 设置了 LEDGER_API 时启动本机脚本接口: 请求在后台线程中解析和合并, 改动交给界面线程应用
+        self.api_server = None
+        self.api_refresh_timer = QTimer(self)
+        self.api_refresh_timer.setSingleShot(True)
+        self.api_refresh_timer.setInterval(self.API_REFRESH_INTERVAL)
+        self.api_refresh_timer.timeout.connect(self.refresh_after_api)
+        self.api_call.connect(self.run_api_call)
+        if os.environ.get(API_ENV):
+            self.start_api(os.environ[API_ENV])
+        if paged:
+            self.start_loading()
     
     def init_ui(self):
         central = QWidget(self)
@@ -225,9 +852,13 @@ class MainWindow(QMainWindow):
         self.search_button.clicked.connect(self.search_records)
         filter_layout.addWidget(self.search_button)
         
+        self.instant_search_check = QCheckBox("边输入边搜索", self)
+        self.instant_search_check.toggled.connect(self.toggle_instant_search)
+        filter_layout.addWidget(self.instant_search_check)
+        
         self.filter_combo = QComboBox(self)
         self.filter_combo.addItem("所有分类")
-        self.filter_combo.addItems(self.get_all_categories())
+        self.filter_combo.addItems(self.ledger.get_all_categories())
         filter_layout.addWidget(self.filter_combo)
         
         self.filter_button = QPushButton("筛选", self)
@@ -236,6 +867,34 @@ class MainWindow(QMainWindow):
         
         main_layout.addLayout(filter_layout)
         
+        query_layout = QHBoxLayout()
+        
+        self.date_from_edit = QLineEdit(self)
+        self.date_from_edit.setPlaceholderText("起始日期 YYYY-MM-DD")
+        query_layout.addWidget(self.date_from_edit)
+        
+        self.date_to_edit = QLineEdit(self)
+        self.date_to_edit.setPlaceholderText("截止日期 YYYY-MM-DD")
+        query_layout.addWidget(self.date_to_edit)
+        
+        self.type_filter_combo = QComboBox(self)
+        self.type_filter_combo.addItems(["所有类型", "支出", "收入"])
+        query_layout.addWidget(self.type_filter_combo)
+        
+        self.amount_min_edit = QLineEdit(self)
+        self.amount_min_edit.setPlaceholderText("最低金额")
+        query_layout.addWidget(self.amount_min_edit)
+        
+        self.amount_max_edit = QLineEdit(self)
+        self.amount_max_edit.setPlaceholderText("最高金额")
+        query_layout.addWidget(self.amount_max_edit)
+        
+        self.clear_query_button = QPushButton("清除条件", self)
+        self.clear_query_button.clicked.connect(self.clear_query)
+        query_layout.addWidget(self.clear_query_button)
+        
+        main_layout.addLayout(query_layout)
+        
         stats_layout = QVBoxLayout()
         
         basic_stats_layout = QHBoxLayout()
@@ -254,38 +913,43 @@ class MainWindow(QMainWindow):
         self.chart_button.clicked.connect(self.show_charts)
         basic_stats_layout.addWidget(self.chart_button)
         
+        self.report_button = QPushButton("报表", self)
+        self.report_button.clicked.connect(self.show_report)
+        basic_stats_layout.addWidget(self.report_button)
+        self.report_dialog = None
+        
         stats_layout.addLayout(basic_stats_layout)
         
         self.budget_progress_layout = QHBoxLayout()
         self.budget_progress_label = QLabel("本月预算:")
         self.budget_progress_layout.addWidget(self.budget_progress_label)
         
+        # 分类 -> (标签, 进度条), 随分类管理和账单导入增删
         self.category_progress = {}
-        for category in self.categories["支出"]:
-            label = QLabel(category)
-            progress = QProgressBar()
-            progress.setMaximum(100)
-            progress.setFormat(f"{category}: %p% (%v/100)")
-            progress.setStyleSheet("QProgressBar::chunk { background-color: #4CAF50; }")
-            self.budget_progress_layout.addWidget(label)
-            self.budget_progress_layout.addWidget(progress)
-            self.category_progress[category] = progress
+        # 分类 -> 进度条当前的颜色级别, 级别不变时不重设样式表
+        self.budget_levels = {}
+        self.budget_alert = None
+        self.sync_budget_progress()
         
         stats_layout.addLayout(self.budget_progress_layout)
         main_layout.addLayout(stats_layout)
         
         content_layout = QHBoxLayout()
         
-        self.table = QTableWidget(0, 5, self)
-        self.table.setHorizontalHeaderLabels(["日期", "描述", "金额", "类型", "分类"])
+        self.table_model = RecordTableModel(self.ledger.records, self)
+        self.table_proxy = RecordSortProxyModel(self)
+        self.table_proxy.setSourceModel(self.table_model)
+        self.table = QTableView(self)
+        self.table.setModel(self.table_proxy)
         self.table.setSortingEnabled(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        # 固定行高和列宽, 避免为了自适应而测量所有单元格
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
         content_layout.addWidget(self.table, 3)
-        
-        self.chart_view = QChartView()
-        self.chart_view.setRenderHint(QPainter.Antialiasing)
-        self.chart_view.setMinimumWidth(450)
-        self.chart_view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        content_layout.addWidget(self.chart_view, 2)
+        self.content_layout = content_layout
         
         main_layout.addLayout(content_layout)
         
@@ -299,250 +963,631 @@ class MainWindow(QMainWindow):
         self.delete_button = QPushButton("删除记录", self)
         self.delete_button.clicked.connect(self.delete_record)
         btn_layout.addWidget(self.delete_button)
+        self.import_button = QPushButton("导入账单", self)
+        self.import_button.clicked.connect(self.import_statement)
+        btn_layout.addWidget(self.import_button)
         main_layout.addLayout(btn_layout)
         
+        self.save_status_label = QLabel("已加载", self)
+        self.statusBar().addPermanentWidget(self.save_status_label)
+        self.save_status_changed.connect(self.show_save_status)
+        
+        # 性能面板默认隐藏, Ctrl+Shift+P 打开
+        self.profiler_dialog = None
+        QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.show_profiler)
+        
         self.refresh_table()
-        self.update_stats()
-        self.update_charts()
     
-    def get_all_categories(self):
-        all_categories = []
-        for type_categories in self.categories.values():
-            all_categories.extend(type_categories)
-        return sorted(list(set(all_categories)))
+    def start_loading(self):
+        self.records_page_loaded.connect(self.load_page)
+        self.records_loaded.connect(self.finish_loading)
+        self.set_loading(True)
+        self.table_model.set_rows(range(0))
+        self.ledger.start_paged_load(self.records_page_loaded.emit, self.records_loaded.emit)
     
-    def load_categories(self):
-        try:
-            if os.path.exists("categories.json"):
-                with open("categories.json", "r", encoding="utf-8") as f:
-                    self.categories = json.load(f)
-        except Exception as e:
-            print(f"加载分类数据失败: {e}")
+    def load_page(self, start, end, aggregates):
+        self.ledger.page_loaded(aggregates)
+        self.table_model.rows_loaded(start, end)
+        self.save_status_label.setText(f"正在加载, 已读取 {self.table_model.count} 条")
+        self.update_views()
     
-    def save_categories(self):
-        try:
-            with open("categories.json", "w", encoding="utf-8") as f:
-                json.dump(self.categories, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存分类数据失败: {e}")
+    def finish_loading(self, error):
+        self.ledger.finish_paged_load(error)
+        self.set_loading(False)
+        self.save_status_label.setText("已加载" if error is None else f"加载失败: {error}")
+        self.refresh_table()
     
-    def load_records(self):
-        try:
-            if os.path.exists("records.json"):
-                with open("records.json", "r", encoding="utf-8") as f:
-                    self.records = json.load(f)
-        except Exception as e:
-            print(f"加载记录失败: {e}")
+    # 加载期间记录还不完整, 不能增删改和查询
+    def set_loading(self, loading):
+        for widget in (self.add_button, self.edit_button, self.delete_button, self.import_button,
+                       self.search_edit, self.search_button, self.instant_search_check,
+                       self.filter_combo, self.filter_button, self.date_from_edit, self.date_to_edit,
+                       self.type_filter_combo, self.amount_min_edit, self.amount_max_edit,
+                       self.clear_query_button, self.report_button):
+            widget.setEnabled(not loading)
     
-    def save_records(self):
-        try:
-            with open("records.json", "w", encoding="utf-8") as f:
-                json.dump(self.records, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存记录失败: {e}")
+    def show_save_status(self, status, detail):
+        if status == "pending":
+            self.save_status_label.setText("有未保存的改动")
+        elif status == "saving":
+            self.save_status_label.setText("正在保存...")
+        elif status == "saved":
+            self.save_status_label.setText(f"已保存 {detail.strftime('%H:%M:%S')}")
+        else:
+            self.save_status_label.setText(f"保存失败: {detail}")
+    
+    # 原子写入 (rename) 替换的文件会从监视列表中消失, 每次收到通知后重新加上; 还不存在的文件由所在目录的通知补上
+    def watch_ledger_files(self):
+        watched = set(self.file_watcher.files()) | set(self.file_watcher.directories())
+        paths = [os.path.abspath(path) for path in self.ledger.storage.watched_paths()]
+        paths = [path for path in paths if path not in watched and os.path.exists(path)]
+        if paths:
+            self.file_watcher.addPaths(paths)
+    
+    def schedule_sync(self, path):
+        self.watch_ledger_files()
+        self.sync_timer.start()
     
-    def load_budgets(self):
+    # 读取其他实例的改动: 文件在保存线程中读取, 界面线程不等待写锁. 上一次读取还没应用时稍后再试
+    def sync_external_changes(self):
+        if self.ledger.loading or self.import_job is not None or \
+                not self.ledger.request_pull(self.changes_pulled.emit):
+            self.sync_timer.start()
+    
+    # 表格只增删、重绘受影响的行, 统计、图表、报表和预算进度随后刷新.
+    # 本实例自己的保存也会触发通知, 这时没有增量, 什么都不做
+    def apply_external_changes(self, data):
         try:
-            if os.path.exists("budgets.json"):
-                with open("budgets.json", "r", encoding="utf-8") as f:
-                    self.budgets = json.load(f)
+            changes = self.ledger.apply_pull(data)
         except Exception as e:
-            print(f"加载预算数据失败: {e}")
+            print(f"读取其他实例的改动失败: {e}")
+            return
+        if changes is None:
+            self.refresh_table()
+            self.statusBar().showMessage("账本已被其他程序改写, 已重新加载", 5000)
+        elif changes:
+            self.table_model.records_synced(changes)
+            self.update_views()
+            self.statusBar().showMessage(f"已同步其他程序的 {len(changes)} 处改动", 5000)
+        else:
+            return
+        self.update_budget_progress()
     
-    def save_budgets(self):
+    # 脚本接口 (asyncio) 只在设置了 LEDGER_API 时才导入
+    def start_api(self, address):
+        from ledger_api import LedgerServer, parse_address
         try:
-            with open("budgets.json", "w", encoding="utf-8") as f:
-                json.dump(self.budgets, f, ensure_ascii=False, indent=2)
+            server = LedgerServer(self.ledger, execute=self.call_in_ui, on_change=self.api_records_changed)
+            server.start_thread(**parse_address(address))
         except Exception as e:
-            print(f"保存预算数据失败: {e}")
-    
-    def refresh_table(self, records=None):
-        if records is None:
-            records = self.records
-        self.table.setRowCount(0)
-        for rec in records:
-            row = self.table.rowCount()
-            self.table.insertRow(row)
-            self.table.setItem(row, 0, QTableWidgetItem(rec['date']))
-            self.table.setItem(row, 1, QTableWidgetItem(rec['description']))
-            
-            amount_item = QTableWidgetItem(f"{rec['amount']:.2f}")
-            amount_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-            self.table.setItem(row, 2, amount_item)
-            
-            self.table.setItem(row, 3, QTableWidgetItem(rec['type']))
-            self.table.setItem(row, 4, QTableWidgetItem(rec.get('category', '')))
-        
-        self.table.resizeColumnsToContents()
-        self.save_records()
+            print(f"启动脚本接口失败: {e}")
+            self.statusBar().showMessage(f"启动脚本接口失败: {e}", 10000)
+            return
+        self.api_server = server
+    
+    # 在脚本接口线程中调用: fn 交给界面线程执行, 返回它的 Future
+    def call_in_ui(self, fn):
+        from concurrent.futures import Future
+        future = Future()
+        self.api_call.emit((fn, future))
+        return future
+    
+    def run_api_call(self, call):
+        from ledger_api import run_now
+        run_now(*call)
+    
+    # 脚本接口的一组改动已应用到账本: 删除和编辑立即反映到表格, 新增的行和其余视图合并刷新.
+    # 分片存储为此读入了其他分片时表格整体刷新
+    def api_records_changed(self, changes, categories_changed):
+        self.table_model.records_synced(changes, defer=True)
+        model = self.table_model
+        if model.showing_all and model.count + len(model.pending) != len(self.ledger.records):
+            self.refresh_table()
+        if categories_changed:
+            self.refresh_category_filter()
+            self.sync_budget_progress()
+        if not self.api_refresh_timer.isActive():
+            self.api_refresh_timer.start()
+    
+    def refresh_after_api(self):
+        self.table_model.flush_pending()
+        self.update_views()
+        self.update_budget_progress()
+    
+    # rows 为要显示的记录下标列表, None 表示全部记录
+    def refresh_table(self, rows=None):
+        if rows is None:
+            self.query_aggregates = None
+        with profiler.span("refresh"):
+            self.table_model.set_rows(rows)
+        profiler.count("records_shown", self.table_model.count)
+        self.update_views()
+    
+    # 记录改动之后调用; 只是切换显示内容时用 update_views, 不触发保存
+    def records_changed(self):
+        self.ledger.records_changed()
+        self.update_views()
+    
+    def update_views(self):
+        if self.query_aggregates is not None:
+            self.query_aggregates.rebuild(self.ledger.records, self.table_model.record_rows())
         self.update_stats()
         self.update_charts()
+        if self.report_dialog is not None and self.report_dialog.isVisible():
+            self.report_dialog.refresh()
+    
+    # 返回选中行在表格模型中的行号和记录编号, 与表格的排序和筛选无关
+    def selected_record(self):
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
+            return None, None
+        row = self.table_proxy.mapToSource(rows[0]).row()
+        return row, self.table_model.record_id(row)
     
     def update_stats(self):
-        total_income = sum(rec['amount'] for rec in self.records if rec['type'] == "收入")
-        total_expense = sum(rec['amount'] for rec in self.records if rec['type'] == "支出")
+        aggregates = self.query_aggregates or self.ledger.aggregates
+        total_income = aggregates.get_total("收入")
+        total_expense = aggregates.get_total("支出")
         balance = total_income - total_expense
         
         self.total_label.setText(
-            f"总收入: {total_income:.2f} | 总支出: {total_expense:.2f} | 结余: {balance:.2f}"
+            ("加载中, 统计尚不完整 - " if self.ledger.loading else "") +
+            ("查询结果 - " if self.query_aggregates else "") +
+            f"总收入: {format_cents(total_income)} | 总支出: {format_cents(total_expense)} | "
+            f"结余: {format_cents(balance)}"
         )
         
         self.update_budget_progress()
     
     def update_budget_progress(self):
+        with profiler.span("budget_progress"):
+            self.refresh_budget_progress()
+    
+    # 只更新预算引擎报告状态有变化的进度条
+    def refresh_budget_progress(self):
         current_month = datetime.now().strftime("%Y-%m")
-        monthly_expenses = self.get_monthly_expenses(current_month)
+        changed, events = self.ledger.budget_engine.evaluate(
+            current_month, self.category_progress, notify=not self.ledger.loading)
         
-        for category in self.categories["支出"]:
-            progress = self.category_progress[category]
-            budget = next((b for b in self.budgets if 
-                         b['month'] == current_month and 
-                         b['category'] == category), None)
-            
-            if budget:
-                budget_amount = budget['amount']
-                expense = monthly_expenses.get(category, 0)
-                percentage = min(100, (expense / budget_amount) * 100) if budget_amount > 0 else 0
-                
-                progress.setValue(int(percentage))
-                progress.setFormat(f"{category}: %p% (¥{expense:.2f}/¥{budget_amount:.2f})")
-                
-                if percentage >= 100:
-                    progress.setStyleSheet("QProgressBar::chunk { background-color: #F44336; }")
-                    QMessageBox.warning(self, "预算超支", f"{category}分类已超支！")
-                elif percentage >= 80:
-                    progress.setStyleSheet("QProgressBar::chunk { background-color: #FFC107; }")
-                else:
-                    progress.setStyleSheet("QProgressBar::chunk { background-color: #4CAF50; }")
-            else:
+        for category, state in changed.items():
+            progress = self.category_progress[category][1]
+            if state is None:
+                level = 0
                 progress.setValue(0)
                 progress.setFormat(f"{category}: 未设置预算")
+            else:
+                level, percent, actual, planned = state
+                progress.setValue(percent)
+                progress.setFormat(f"{category}: %p% (¥{format_cents(actual)}/¥{format_cents(planned)})")
+            if self.budget_levels.get(category) != level:
+                self.budget_levels[category] = level
+                progress.setStyleSheet(f"QProgressBar::chunk {{ background-color: {self.BUDGET_COLORS[level]}; }}")
+        
+        if events:
+            self.show_budget_alert(events)
     
-    def get_monthly_expenses(self, month):
-        expenses = {}
-        for rec in self.records:
-            if rec['type'] == "支出":
-                try:
-                    record_month = datetime.strptime(rec['date'], "%Y-%m-%d").strftime("%Y-%m")
-                    if record_month == month:
-                        category = rec.get('category', '其他')
-                        expenses[category] = expenses.get(category, 0) + rec['amount']
-                except ValueError:
-                    continue
-        return expenses
+    # 非模态提醒, 上一条还没关闭时追加到其中
+    def show_budget_alert(self, events):
+        lines = [f"{category}分类已超支！" if level == 2 else f"{category}分类已用去 80% 以上的预算"
+                 for category, level in events]
+        self.statusBar().showMessage(" ".join(lines), 10000)
+        if self.budget_alert is None:
+            self.budget_alert = QMessageBox(QMessageBox.Warning, "预算提醒", "", QMessageBox.Ok, self)
+            self.budget_alert.setModal(False)
+            self.budget_alert.finished.connect(lambda _: self.budget_alert.setText(""))
+        text = self.budget_alert.text()
+        self.budget_alert.setText("\n".join(([text] if text else []) + lines))
+        self.budget_alert.show()
+    
+    # 按当前的支出分类增删预算进度条
+    def sync_budget_progress(self):
+        categories = self.ledger.categories["支出"]
+        for category in [category for category in self.category_progress if category not in categories]:
+            for widget in self.category_progress.pop(category):
+                self.budget_progress_layout.removeWidget(widget)
+                widget.deleteLater()
+            self.budget_levels.pop(category, None)
+        for category in categories:
+            if category in self.category_progress:
+                continue
+            label = QLabel(category)
+            progress = QProgressBar()
+            progress.setMaximum(100)
+            progress.setFormat(f"{category}: %p% (%v/100)")
+            self.budget_progress_layout.addWidget(label)
+            self.budget_progress_layout.addWidget(progress)
+            self.category_progress[category] = (label, progress)
     
     def update_charts(self):
-        expense_series = QPieSeries()
-        expense_series.setName("支出分类")
-        
+        if self.chart_panel is None or self.chart_panel.isHidden():
+            return
+        from PyQt5.QtChart import QChart
+        with profiler.span("chart"):
+            # 连续快速更新 (即时搜索、导入、分页加载) 时不播放动画, 只显示最终结果
+            now = time.perf_counter()
+            burst = now - self.last_chart_update < self.CHART_BURST_INTERVAL
+            self.last_chart_update = now
+            self.update_pie(QChart.NoAnimation if burst else QChart.SeriesAnimations)
+            self.update_trend()
+    
+    # 按金额从大到小排列, 占比小于 PIE_FOLD_RATIO 或超出 PIE_MAX_SLICES 的分类合并为 "其他"
+    def fold_slices(self, expense_data):
+        items = sorted(expense_data.items(), key=lambda item: -item[1])
+        total = sum(amount for _, amount in items if amount > 0)
+        kept = []
+        other = 0
+        for category, amount in items:
+            if category != "其他" and len(kept) < self.PIE_MAX_SLICES - 1 and total > 0 and \
+                    amount / total >= self.PIE_FOLD_RATIO:
+                kept.append((category, amount))
+            else:
+                other += amount
+        if other:
+            kept.append(("其他", other))
+        return kept
+    
+    # 在已有的饼图上增删改扇区, 不重建 QChart
+    def update_pie(self, animations):
+        from PyQt5.QtChart import QPieSlice
         current_month = datetime.now().strftime("%Y-%m")
-        expense_data = self.get_monthly_expenses(current_month)
-        
-        colors = [QColor(255, 99, 132), QColor(54, 162, 235), QColor(255, 206, 86),
-                 QColor(75, 192, 192), QColor(153, 102, 255), QColor(255, 159, 64)]
+        if self.query_aggregates:
+            expense_data = {category: cents / 100
+                            for category, cents in self.query_aggregates.get_category_expenses().items()}
+            title = "查询结果支出分类占比 (带本月预算对比)"
+        else:
+            expense_data = self.ledger.get_monthly_expenses(current_month)
+            title = f"{current_month}支出分类占比 (带预算对比)"
+        title += " - 加载中" if self.ledger.loading else ""
         
-        for i, (category, amount) in enumerate(expense_data.items()):
-            budget = next((b for b in self.budgets if 
-                         b['month'] == current_month and 
-                         b['category'] == category), None)
+        slices = []
+        for category, amount in self.fold_slices(expense_data):
+            budget = self.ledger.get_budget(current_month, category)
             
             label = f"{category}: ¥{amount:.2f}"
             if budget:
                 label += f" (预算:¥{budget['amount']:.2f})"
                 if amount > budget['amount']:
                     label += "⚠️"
-            
-            slice = expense_series.append(label, amount)
-            slice.setColor(colors[i % len(colors)])
+            slices.append((category, label, amount))
+        
+        state = (title, slices)
+        if state == self.pie_state:
+            return
+        self.pie_state = state
+        chart = self.chart_view.chart()
+        chart.setAnimationOptions(animations)
+        chart.setTitle(title)
+        
+        # 不再显示的分类只把扇区清零并隐藏: 在动画开关切换后删除扇区会让 QtChart 崩溃
+        shown = {category for category, _, _ in slices}
+        for category, slice in self.pie_slices.items():
+            if category not in shown and slice.value() != 0:
+                slice.setValue(0)
+                slice.setLabelVisible(False)
+        for category, label, amount in slices:
+            slice = self.pie_slices.get(category)
+            if slice is None:
+                slice = QPieSlice(label, amount)
+                slice.setColor(self.slice_color(category))
+                slice.setLabelPosition(QPieSlice.LabelOutside)
+                slice.setLabelFont(QFont("Arial", 8))
+                self.pie_series.append(slice)
+                self.pie_slices[category] = slice
+            else:
+                if slice.value() != amount:
+                    slice.setValue(amount)
+                if slice.label() != label:
+                    slice.setLabel(label)
             slice.setLabelVisible(True)
-            slice.setLabelPosition(QPieSlice.LabelOutside)
-            slice.setLabelFont(QFont("Arial", 8))
+        visible = [self.pie_slices[category] for category in shown]
+        for marker in chart.legend().markers(self.pie_series):
+            marker.setVisible(any(marker.slice() is slice for slice in visible))
+    
+    # 同一分类始终使用同一种颜色
+    def slice_color(self, category):
+        if category == "其他":
+            return QColor(158, 158, 158)
+        colors = [QColor(255, 99, 132), QColor(54, 162, 235), QColor(255, 206, 86),
+                 QColor(75, 192, 192), QColor(153, 102, 255), QColor(255, 159, 64)]
+        if category not in self.slice_colors:
+            self.slice_colors[category] = colors[len(self.slice_colors) % len(colors)]
+        return self.slice_colors[category]
+    
+    # 全部记录的每月 / 每日支出折线 (分片存储的每日折线只含已读入的分片), 用 LTTB 降采样到图表的像素宽度,
+    # 数据和宽度都没变时不重画
+    def update_trend(self):
+        if self.chart_panel is None or self.chart_panel.isHidden():
+            return
+        daily = self.trend_combo.currentData() == "day"
+        if daily and self.ledger.loading:
+            return
+        if daily:
+            points = self.ledger.daily_expenses()
+        else:
+            points = [(date(month // 100, month % 100, 1).toordinal(), cents)
+                      for month, cents in self.ledger.aggregates.get_monthly_totals()]
+        width = max(self.TREND_MIN_POINTS, self.trend_view.width())
+        state = (daily, width, points)
+        if state == self.trend_state:
+            return
+        self.trend_state = state
         
+        sampled = lttb(points, width)
+        self.trend_series.replace([QPointF(datetime.fromordinal(day).timestamp() * 1000, cents / 100)
+                                   for day, cents in sampled])
+        chart = self.trend_view.chart()
+        chart.setTitle(("每日" if daily else "每月") + "支出趋势" +
+                       (" (已加载的月份)" if daily and self.ledger.storage.unloaded_shards() else "") +
+                       (f" (共 {len(points)} 点, 显示 {len(sampled)} 点)" if len(sampled) < len(points) else ""))
+        axis_x, axis_y = chart.axes(Qt.Horizontal)[0], chart.axes(Qt.Vertical)[0]
+        axis_x.setFormat("yyyy-MM-dd" if daily else "yyyy-MM")
+        if points:
+            axis_x.setRange(QDateTime.fromMSecsSinceEpoch(int(datetime.fromordinal(points[0][0]).timestamp() * 1000)),
+                            QDateTime.fromMSecsSinceEpoch(int(datetime.fromordinal(points[-1][0]).timestamp() * 1000)))
+            values = [cents / 100 for _, cents in sampled]
+            axis_y.setRange(min(0, min(values)), max(values) * 1.1 or 1)
+    
+    def create_charts(self):
+        from PyQt5.QtChart import QChart, QChartView, QDateTimeAxis, QLineSeries, QPieSeries, QValueAxis
+        self.chart_panel = QWidget(self)
+        panel_layout = QVBoxLayout(self.chart_panel)
+        panel_layout.setContentsMargins(0, 0, 0, 0)
+        
+        self.pie_series = QPieSeries()
+        self.pie_series.setName("支出分类")
         chart = QChart()
-        chart.addSeries(expense_series)
-        chart.setTitle(f"{current_month}支出分类占比 (带预算对比)")
-        chart.setAnimationOptions(QChart.SeriesAnimations)
+        chart.addSeries(self.pie_series)
         chart.legend().setVisible(True)
         chart.legend().setAlignment(Qt.AlignRight)
         chart.setMargins(QMargins(5, 5, 5, 5))
+        self.chart_view = QChartView(chart)
+        self.chart_view.setRenderHint(QPainter.Antialiasing)
+        panel_layout.addWidget(self.chart_view, 3)
+        
+        trend_layout = QHBoxLayout()
+        trend_layout.addWidget(QLabel("支出趋势:"))
+        self.trend_combo = QComboBox(self)
+        self.trend_combo.addItem("按月", "month")
+        self.trend_combo.addItem("按日", "day")
+        self.trend_combo.currentIndexChanged.connect(self.update_trend)
+        trend_layout.addWidget(self.trend_combo)
+        trend_layout.addStretch()
+        panel_layout.addLayout(trend_layout)
+        
+        self.trend_series = QLineSeries()
+        chart = QChart()
+        chart.addSeries(self.trend_series)
+        chart.legend().hide()
+        chart.setMargins(QMargins(5, 5, 5, 5))
+        axis_x = QDateTimeAxis()
+        axis_x.setTickCount(6)
+        chart.addAxis(axis_x, Qt.AlignBottom)
+        self.trend_series.attachAxis(axis_x)
+        axis_y = QValueAxis()
+        axis_y.setLabelFormat("%.0f")
+        chart.addAxis(axis_y, Qt.AlignLeft)
+        self.trend_series.attachAxis(axis_y)
+        self.trend_view = QChartView(chart)
+        self.trend_view.setRenderHint(QPainter.Antialiasing)
+        # 宽度变化时按新的像素宽度重新降采样
+        self.trend_view.installEventFilter(self)
+        panel_layout.addWidget(self.trend_view, 2)
         
-        self.chart_view.setChart(chart)
+        self.chart_panel.setMinimumWidth(450)
+        self.chart_panel.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.chart_panel.hide()
+        self.content_layout.addWidget(self.chart_panel, 2)
+    
+    def eventFilter(self, watched, event):
+        if watched is self.trend_view and event.type() == QEvent.Resize:
+            self.update_trend()
+        return super(MainWindow, self).eventFilter(watched, event)
     
     def show_charts(self):
-        if self.chart_view.isVisible():
-            self.chart_view.hide()
+        if self.chart_panel is None:
+            self.create_charts()
+        if self.chart_panel.isVisible():
+            self.chart_panel.hide()
             self.chart_button.setText("显示图表")
         else:
-            self.chart_view.show()
+            self.chart_panel.show()
             self.chart_button.setText("隐藏图表")
             self.update_charts()
     
+    def show_report(self):
+        if self.report_dialog is None:
+            self.report_dialog = ReportDialog(self.build_report, self)
+        self.report_dialog.show()
+        self.report_dialog.raise_()
+        self.report_dialog.refresh()
+    
+    def build_report(self, kind, month_from, month_to):
+        count = len(self.ledger.records)
+        result = self.ledger.report(kind, month_from, month_to)
+        # 分片存储可能读入了区间内的分片, 表格显示全部记录时同步行数
+        if len(self.ledger.records) != count and self.table_model.showing_all:
+            self.table_model.set_rows(None)
+        return result
+    
     def add_record(self):
-        dialog = RecordDialog(self.categories, parent=self)
+        dialog = RecordDialog(self.ledger.categories, parent=self)
         if dialog.exec_():
-            new_record = dialog.get_data()
-            self.records.append(new_record)
-            self.refresh_table()
+            record_id = self.ledger.add_record(dialog.get_data())
+            # 分片存储可能先读入了新记录所在的分片, 这时整体刷新
+            if self.table_model.showing_all and self.table_model.count == len(self.ledger.records) - 1:
+                self.table_model.row_appended(record_id)
+            else:
+                self.query_aggregates = None
+                self.table_model.set_rows(None)
+            self.update_views()
     
     def edit_record(self):
-        selected_items = self.table.selectedItems()
-        if not selected_items:
+        row, record_id = self.selected_record()
+        if row is None:
             QMessageBox.warning(self, "警告", "请选择要编辑的记录")
             return
-        row = selected_items[0].row()
-        record = self.records[row]
-        dialog = RecordDialog(self.categories, record, parent=self)
+        record = self.ledger.get_record(record_id)
+        dialog = RecordDialog(self.ledger.categories, record, parent=self)
         if dialog.exec_():
-            self.records[row] = dialog.get_data()
-            self.refresh_table()
+            self.ledger.edit_record(record_id, dialog.get_data())
+            if self.table_model.showing_all and self.table_model.count != len(self.ledger.records):
+                self.table_model.set_rows(None)
+            else:
+                self.table_model.row_changed(row)
+            self.update_views()
     
     def delete_record(self):
-        selected_items = self.table.selectedItems()
-        if not selected_items:
+        row, record_id = self.selected_record()
+        if row is None:
             QMessageBox.warning(self, "警告", "请选择要删除的记录")
             return
-        row = selected_items[0].row()
-        del self.records[row]
-        self.refresh_table()
+        self.table_model.remove_row(row, self.ledger.delete_record)
+        self.update_views()
     
+    # 搜索和筛选都按界面上的全部条件组合查询
     def search_records(self):
-        keyword = self.search_edit.text().lower()
-        if not keyword:
-            self.refresh_table()
-            return
-        filtered = [rec for rec in self.records if keyword in rec['description'].lower()]
-        self.refresh_table(filtered)
+        self.apply_query()
     
     def filter_by_category(self):
-        selected_category = self.filter_combo.currentText()
-        if selected_category == "所有分类":
+        self.apply_query()
+    
+    def build_query(self):
+        query = RecordQuery(keyword=self.search_edit.text().strip())
+        for name, edit in (("date_from", self.date_from_edit), ("date_to", self.date_to_edit)):
+            text = edit.text().strip()
+            if text:
+                try:
+                    datetime.strptime(text, "%Y-%m-%d")
+                except ValueError:
+                    QMessageBox.warning(self, "警告", "日期格式应为 YYYY-MM-DD")
+                    return None
+                setattr(query, name, text)
+        for name, edit in (("amount_min", self.amount_min_edit), ("amount_max", self.amount_max_edit)):
+            text = edit.text().strip()
+            if text:
+                try:
+                    setattr(query, name, float(text))
+                except ValueError:
+                    QMessageBox.warning(self, "警告", "金额必须是数字")
+                    return None
+        if self.type_filter_combo.currentText() != "所有类型":
+            query.types = {self.type_filter_combo.currentText()}
+        if self.filter_combo.currentText() != "所有分类":
+            query.categories = {self.filter_combo.currentText()}
+        return query
+    
+    def apply_query(self):
+        query = self.build_query()
+        if query is None:
+            return
+        if query.is_empty():
             self.refresh_table()
             return
+        self.query_aggregates = AggregateCache()
+        self.refresh_table(self.ledger.query(query))
+    
+    def clear_query(self):
+        for edit in (self.search_edit, self.date_from_edit, self.date_to_edit,
+                     self.amount_min_edit, self.amount_max_edit):
+            edit.clear()
+        self.type_filter_combo.setCurrentIndex(0)
+        self.filter_combo.setCurrentIndex(0)
+        self.refresh_table()
+    
+    def toggle_instant_search(self, checked):
+        if checked:
+            self.search_edit.textChanged.connect(self.search_records)
+            self.search_records()
+        else:
+            self.search_edit.textChanged.disconnect(self.search_records)
+    
+    def import_statement(self):
+        dialog = ImportDialog(parent=self)
+        if not dialog.exec_():
+            return
+        path, mapping = dialog.get_data()
+        if not path or not mapping['date'] or not mapping['amount']:
+            QMessageBox.warning(self, "警告", "请选择账单文件并指定日期列和金额列")
+            return
+        
+        self.import_progress = QProgressDialog("正在导入账单...", "取消", 0, 100, self)
+        self.import_progress.setWindowModality(Qt.WindowModal)
+        self.import_progress.setMinimumDuration(0)
+        self.import_progress.setValue(0)
         
-        filtered = [rec for rec in self.records if rec.get('category', '') == selected_category]
-        self.refresh_table(filtered)
+        importer = StatementImporter(mapping)
+        self.import_progress.canceled.connect(importer.cancel)
+        self.import_job = ImportJob(importer, path, self)
+        self.import_job.hashes_requested.connect(self.send_month_hashes)
+        self.import_job.batch_ready.connect(self.commit_import_batch)
+        self.import_job.progress.connect(self.import_progress.setValue)
+        self.import_job.finished.connect(self.finish_import)
+        self.import_job.start()
+    
+    # 信号排在之前各批记录之后, 执行时那些记录都已追加; 只读入这个月所在的分片
+    def send_month_hashes(self, month, future):
+        try:
+            future.set_result(self.ledger.month_hashes(month))
+        except Exception as e:
+            future.set_exception(e)
+    
+    # 每批记录只追加并更新聚合, 表格和图表在导入结束后统一刷新
+    def commit_import_batch(self, batch):
+        if self.ledger.add_records(batch):
+            self.categories_changed = True
+    
+    def finish_import(self, stats):
+        self.import_progress.reset()
+        self.import_job = None
+        self.query_aggregates = None
+        self.table_model.set_rows(None)
+        self.records_changed()
+        if self.categories_changed:
+            self.categories_changed = False
+            self.refresh_category_filter()
+            self.ledger.save_categories()
+            self.sync_budget_progress()
+            self.update_budget_progress()
+        if 'error' in stats:
+            QMessageBox.warning(self, "导入失败", stats['error'])
+            return
+        QMessageBox.information(
+            self, "导入完成",
+            f"导入 {stats['imported']} 条, 跳过重复 {stats['duplicates']} 条, 无法解析 {stats['errors']} 条"
+            + (" (已取消)" if stats['cancelled'] else ""))
+    
+    def refresh_category_filter(self):
+        self.filter_combo.clear()
+        self.filter_combo.addItem("所有分类")
+        self.filter_combo.addItems(self.ledger.get_all_categories())
     
     def manage_categories(self):
-        dialog = CategoryDialog(self.categories, parent=self)
+        dialog = CategoryDialog(self.ledger.categories, parent=self)
         if dialog.exec_():
-            self.filter_combo.clear()
-            self.filter_combo.addItem("所有分类")
-            self.filter_combo.addItems(self.get_all_categories())
-            self.save_categories()
+            self.refresh_category_filter()
+            self.ledger.save_categories()
+            self.sync_budget_progress()
+            self.update_budget_progress()
     
     def manage_budgets(self):
-        dialog = BudgetDialog(self.budgets, self.categories, parent=self)
+        dialog = BudgetDialog(self.ledger.budgets, self.ledger.categories, parent=self)
         if dialog.exec_():
             new_budget = dialog.get_data()
-            existing = next((b for b in self.budgets if 
-                           b['month'] == new_budget['month'] and 
-                           b['category'] == new_budget['category']), None)
-            if existing:
-                existing['amount'] = new_budget['amount']
-            else:
-                self.budgets.append(new_budget)
-            self.save_budgets()
+            self.ledger.set_budget(new_budget['month'], new_budget['category'], new_budget['amount'])
             self.update_budget_progress()
+    
+    def show_profiler(self):
+        if self.profiler_dialog is None:
+            self.profiler_dialog = ProfilerDialog(self)
+        self.profiler_dialog.show()
+        self.profiler_dialog.raise_()
+        self.profiler_dialog.refresh()
+    
+    def closeEvent(self, event):
+        if self.api_server is not None:
+            self.api_server.stop()
+        self.ledger.close()
+        super(MainWindow, self).closeEvent(event)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
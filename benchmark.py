@@ -0,0 +1,296 @@
+# 性能基准: 生成确定性的模拟账本 (1 万到 1000 万条, 跨多年), 按存储后端和数据规模计时常用操作,
+# 每项结果输出一行 JSON, 可以与之前的结果对比找出性能退化.
+#
+#   QT_QPA_PLATFORM=offscreen python benchmark.py --sizes 10k,100k,1M --output bench.jsonl
+#   python benchmark.py --sizes 10k --compare bench.jsonl
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+import ledger
+
+# 界面操作在没有显示器的环境下也能运行
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "77-源代码.py")
+BACKENDS = ["sqlite", "journal", "json", "sharded"]
+
+# 分类: (权重, 对数正态分布的 mu / sigma (单位: 元), 描述中的商户或来源)
+EXPENSE_PROFILE = {
+    "餐饮": (45, 3.3, 0.8, ["美团外卖", "饿了么", "肯德基", "麦当劳", "星巴克", "瑞幸咖啡", "海底捞",
+                          "食堂午饭", "楼下面馆", "早餐包子", "沙县小吃", "超市水果"]),
+    "交通": (20, 2.3, 1.0, ["地铁", "公交", "滴滴出行", "出租车", "共享单车", "加油", "高铁票",
+                          "停车费", "机票"]),
+    "购物": (15, 4.6, 1.1, ["淘宝", "京东", "拼多多", "优衣库", "宜家", "屈臣氏", "苏宁易购",
+                          "小米之家", "超市日用品"]),
+    "娱乐": (12, 4.0, 0.9, ["电影票", "KTV", "健身房", "网易云音乐会员", "视频会员", "游戏充值",
+                          "演唱会门票", "剧本杀"]),
+    "住房": (8, 6.5, 0.9, ["房租", "物业费", "水费", "电费", "燃气费", "宽带", "维修"]),
+}
+INCOME_PROFILE = {
+    "工资": (40, 9.2, 0.3, ["工资", "月薪", "绩效工资"]),
+    "奖金": (10, 8.5, 0.8, ["年终奖", "季度奖金", "项目奖金"]),
+    "投资": (25, 5.5, 1.3, ["基金收益", "股票分红", "理财利息", "余额宝收益"]),
+    "兼职": (25, 6.0, 0.8, ["家教", "翻译稿费", "设计外包", "周末兼职"]),
+}
+INCOME_RATIO = 0.08
+DISTRICTS = ["朝阳", "海淀", "浦东", "徐汇", "天河", "南山", "西湖", "武侯", "江汉", "鼓楼"]
+# 搜索和筛选计时用的条件, 在生成的数据中都有大量命中
+SEARCH_KEYWORD = "外卖"
+FILTER_CATEGORY = "餐饮"
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+# 同一 (count, seed, years, end) 总是生成相同的记录; 日期均匀分布在截止到 end 的 years 年内并按时间顺序排列.
+# end 默认为今天, 使分片存储启动时读入的当前月份也有数据
+def generate_records(count, seed=0, years=10, end=None):
+    end = end or date.today()
+    rng = random.Random(seed)
+    start = end - timedelta(days=365 * years - 1)
+    span = (end - start).days + 1
+    expense_names = list(EXPENSE_PROFILE)
+    expense_weights = [EXPENSE_PROFILE[name][0] for name in expense_names]
+    income_names = list(INCOME_PROFILE)
+    income_weights = [INCOME_PROFILE[name][0] for name in income_names]
+    for i in range(count):
+        day = start + timedelta(days=i * span // count)
+        if rng.random() < INCOME_RATIO:
+            type_name = "收入"
+            category = rng.choices(income_names, income_weights)[0]
+            _, mu, sigma, sources = INCOME_PROFILE[category]
+            description = rng.choice(sources)
+        else:
+            type_name = "支出"
+            category = rng.choices(expense_names, expense_weights)[0]
+            _, mu, sigma, sources = EXPENSE_PROFILE[category]
+            description = rng.choice(sources)
+            if rng.random() < 0.5:
+                description += f"({rng.choice(DISTRICTS)}店)"
+        yield {
+            'date': day.strftime("%Y-%m-%d"),
+            'description': description,
+            'amount': round(rng.lognormvariate(mu, sigma), 2),
+            'type': type_name,
+            'category': category,
+        }
+
+# 在 directory 中写出 backend 对应的账本文件, 逐条写入, 不在内存中保留记录字典 (二进制快照只需要列式记录)
+def write_dataset(directory, backend, count, seed=0, years=10, end=None):
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        if backend == "sqlite":
+            storage = ledger.SqliteStorage()
+            with storage.batch():
+                storage.conn.executemany(
+                    "INSERT INTO records (date, month, description, amount, type, category) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (storage.record_params(rec) for rec in generate_records(count, seed, years, end)))
+            storage.close()
+        else:
+            # 记录带上编号, 与程序保存的文件相同 (加载时可以从末尾分页读取); 边写边计算 CRC32,
+            # 二进制快照直接由逐条追加的列式记录写出, 不经过字典列表, 也不重写 records.json
+            columns = ledger.RecordColumns() if backend != "sharded" else None
+            crc = 0
+            with open("records.json", "wb") as f:
+                for i, rec in enumerate(generate_records(count, seed, years, end)):
+                    rec['id'] = i
+                    chunk = (("," if i else "[") + json.dumps(rec, ensure_ascii=False)).encode("utf-8")
+                    crc = zlib.crc32(chunk, crc)
+                    f.write(chunk)
+                    if columns is not None:
+                        columns.append(rec)
+                chunk = b"]" if count else b"[]"
+                crc = zlib.crc32(chunk, crc)
+                f.write(chunk)
+            if columns is not None:
+                ledger.write_binary_snapshot(columns, "records.json", crc)
+            else:
+                # 首次打开时按月拆分; 迁移提示不能混进标准输出中的结果
+                with contextlib.redirect_stdout(sys.stderr):
+                    ledger.ShardedStorage().close()
+    finally:
+        os.chdir(cwd)
+
+# 运行 repeat 次, 返回首次 (含缓存和索引的建立) 以及最快和中位数耗时 (秒)
+def measure(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return {'first': times[0], 'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+def load_app():
+    spec = importlib.util.spec_from_file_location("ledger_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class LedgerBenchmark:
+    def __init__(self, count, backend, repeat=5, seed=0, years=10, end=None, headless=False):
+        self.count = count
+        self.backend = backend
+        self.repeat = repeat
+        self.seed = seed
+        self.years = years
+        self.end = end
+        self.headless = headless
+
+    def result(self, op, timing):
+        result = {'op': op, 'size': self.count, 'backend': self.backend}
+        result.update(timing)
+        return result
+
+    def run(self):
+        directory = tempfile.mkdtemp(prefix="ledger-bench-")
+        cwd = os.getcwd()
+        try:
+            started = time.perf_counter()
+            write_dataset(directory, self.backend, self.count, self.seed, self.years, self.end)
+            print(f"生成 {self.count} 条记录 ({self.backend}) 用时 {time.perf_counter() - started:.1f}s",
+                  file=sys.stderr)
+            os.chdir(directory)
+            results = []
+            # 加载包括读取存储和重建聚合缓存, 与程序启动时相同
+            ledgers = []
+
+            def close_ledgers():
+                while ledgers:
+                    ledgers.pop().close()
+
+            results.append(self.result("load_records", measure(
+                lambda: ledgers.append(ledger.Ledger(ledger.create_storage(self.backend))),
+                self.repeat, setup=close_ledgers)))
+            book = ledgers[0]
+            # 一次编辑按当前后端的方式落盘 (JSON 整体重写, 日志追加, SQLite 更新一行, 分片重写当月文件).
+            # 分片存储启动时只读入当前月份, 数据截止日期早于本月时没有可编辑的记录
+            if len(book.records):
+                record = dict(book.records[len(book.records) // 2])
+                results.append(self.result("save_records", measure(
+                    lambda: (book.edit_record(record['id'], record), book.flush()), self.repeat)))
+            month = (self.end or date.today()).strftime("%Y-%m")
+            results.append(self.result("get_monthly_expenses", measure(
+                lambda: book.get_monthly_expenses(month), self.repeat)))
+            if not self.headless:
+                results.extend(self.run_window(book))
+            book.close()
+            return results
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    # 界面操作包括处理事件 (重绘表格和图表) 的时间
+    def run_window(self, book):
+        from PyQt5.QtWidgets import QApplication
+        app_module = load_app()
+        qt_app = QApplication.instance() or QApplication(sys.argv)
+        window = app_module.MainWindow(book)
+        window.show()
+        qt_app.processEvents()
+
+        def timed(func):
+            def run():
+                func()
+                qt_app.processEvents()
+            return run
+
+        def search():
+            window.search_edit.setText(SEARCH_KEYWORD)
+            window.search_records()
+
+        def filter_category():
+            window.filter_combo.setCurrentText(FILTER_CATEGORY)
+            window.filter_by_category()
+
+        results = [
+            self.result("refresh_table", measure(timed(window.refresh_table), self.repeat)),
+            self.result("update_stats", measure(timed(window.update_stats), self.repeat)),
+            self.result("search_records", measure(timed(search), self.repeat, setup=window.clear_query)),
+            self.result("filter_by_category", measure(timed(filter_category), self.repeat,
+                                                      setup=window.clear_query)),
+        ]
+        window.clear_query()
+        # 第一次显示图表时才加载 QtChart, 计入首次耗时
+        window.show_charts()
+        results.append(self.result("update_charts", measure(timed(window.update_charts), self.repeat)))
+        # 账本由调用方关闭, 之后的保存状态不再发给已销毁的窗口
+        book.writer.on_status = None
+        window.hide()
+        window.deleteLater()
+        qt_app.processEvents()
+        return results
+
+def load_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# 中位数比基准慢 threshold 倍以上的操作视为退化, 返回 (结果, 基准) 列表
+def find_regressions(results, baseline, threshold):
+    previous = {(r['op'], r['size'], r['backend']): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['op'], result['size'], result['backend']))
+        if old and result['median'] > old['median'] * threshold:
+            regressions.append((result, old))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="记账程序性能基准")
+    parser.add_argument("--sizes", default="10k,100k,1M", help="记录数, 逗号分隔, 可用 k / M 后缀 (最大 10M)")
+    parser.add_argument("--backends", default="sqlite", help="存储后端, 逗号分隔: " + ",".join(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--years", type=int, default=10, help="数据跨越的年数")
+    parser.add_argument("--end", help="数据的截止日期 YYYY-MM-DD, 默认为今天; 对比不同日期的结果时应固定")
+    parser.add_argument("--headless", action="store_true", help="只计时账本操作, 不创建窗口")
+    parser.add_argument("--output", help="把结果 (JSON Lines) 写入文件, 默认输出到标准输出")
+    parser.add_argument("--compare", help="与之前的结果文件对比, 有退化时返回 1")
+    parser.add_argument("--threshold", type=float, default=1.25, help="中位数变慢超过这个倍数视为退化")
+    args = parser.parse_args(argv)
+    end = datetime.strptime(args.end, "%Y-%m-%d").date() if args.end else date.today()
+
+    meta = {'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    results = []
+    try:
+        for size in [parse_size(s) for s in args.sizes.split(",")]:
+            for backend in args.backends.split(","):
+                benchmark = LedgerBenchmark(size, backend, args.repeat, args.seed, args.years, end,
+                                            args.headless)
+                for result in benchmark.run():
+                    result.update(meta)
+                    results.append(result)
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    if args.compare:
+        regressions = find_regressions(results, load_results(args.compare), args.threshold)
+        for result, old in regressions:
+            print(f"退化: {result['op']} ({result['size']} 条, {result['backend']}) "
+                  f"{old['median'] * 1000:.1f}ms -> {result['median'] * 1000:.1f}ms", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# 多账本合并报表: 每个账本目录 (各自的 records.json / budgets.json, 或其他存储后端的文件) 在单独的
+# 工作进程中逐块读取并聚合, 主进程合并各账本的聚合结果 (总额、分类 × 月份支出、预算 vs 实际) 后写出一份 CSV.
+# 工作进程同一时间只持有一页记录、一个分片或映射的二进制快照, 内存占用与账本大小基本无关.
+#
+#   python consolidate.py 爸爸 妈妈 信用卡 --year 2025 --output 2025.csv
+#   python consolidate.py ledgers/* --from 2025-01 --to 2025-06 --workers 4
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import ledger
+
+# 当前目录中已有文件对应的存储后端, 有多种时优先使用 ledger.STORAGE_BACKEND; 没有账本文件时为 None
+def detect_backend():
+    present = {"sqlite": os.path.exists(ledger.SQLITE_PATH),
+               "sharded": os.path.exists(os.path.join(ledger.SHARD_DIR, "manifest.json")),
+               "journal": os.path.exists("records.journal"),
+               "json": os.path.exists("records.json")}
+    if present.get(ledger.STORAGE_BACKEND):
+        return ledger.STORAGE_BACKEND
+    return next((backend for backend, exists in present.items() if exists), None)
+
+# 逐块给出 RecordColumns: 分片存储只读区间内的分片, SQLite 经 (type, month) 索引筛选后分批读取
+# (报表只用到收入和支出), JSON 和日志后端优先映射二进制快照, 否则按页读取
+def record_chunks(storage, backend, month_from, month_to):
+    if backend == "sharded":
+        storage.loaded = set()
+        for name in storage.unloaded_shards(month_from, month_to):
+            yield ledger.RecordColumns.from_records(storage.read_shard(name))
+        return
+    if backend == "sqlite":
+        cursor = storage.conn.execute(f"SELECT {storage.RECORD_COLUMNS} FROM records "
+                                      "WHERE type IN ('收入', '支出') AND month BETWEEN ? AND ?",
+                                      (month_from, month_to))
+        while True:
+            rows = cursor.fetchmany(ledger.LOAD_PAGE_SIZE)
+            if not rows:
+                return
+            yield ledger.RecordColumns.from_records([storage.row_to_record(row) for row in rows])
+    columns = storage.load_columns()
+    if columns is not None:
+        yield columns
+        return
+    count, pages = storage.load_record_pages(ledger.LOAD_PAGE_SIZE)
+    for start, page in pages:
+        yield ledger.RecordColumns.from_records(page)
+
+# 在工作进程中运行: 聚合一个账本目录中 [month_from, month_to] 的记录和预算, 返回可以合并的部分结果
+def aggregate_ledger(name, directory, month_from, month_to):
+    started = time.perf_counter()
+    low, high = ledger.month_key(month_from), ledger.month_key(month_to)
+    partial = {'name': name, 'records': 0, 'aggregates': ledger.AggregateCache(), 'budgets': {}, 'error': None}
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        backend = detect_backend()
+        if backend is None:
+            raise ValueError("目录中没有账本文件")
+        # 只读打开: 不加锁, 不建表, 不重置或压缩日志, 账本目录中的文件保持原样
+        storage = ledger.create_storage(backend, read_only=True)
+        try:
+            for records in record_chunks(storage, backend, month_from, month_to):
+                for i in range(len(records)):
+                    if low <= records.months[i] <= high:
+                        partial['aggregates'].add(records, i)
+                        partial['records'] += 1
+            for budget in storage.load_budgets():
+                month = ledger.month_key(budget['month'])
+                if low <= month <= high:
+                    partial['budgets'][(month, budget['category'])] = ledger.to_cents(budget['amount'])
+        finally:
+            storage.close()
+    except Exception as e:
+        partial['error'] = str(e)
+    finally:
+        os.chdir(cwd)
+    partial['seconds'] = time.perf_counter() - started
+    return partial
+
+# 合并各账本的聚合结果, 同一 (月份, 分类) 的预算相加
+def merge_partials(partials):
+    aggregates = ledger.AggregateCache()
+    budgets = {}
+    for partial in partials:
+        aggregates.merge(partial['aggregates'])
+        for key, cents in partial['budgets'].items():
+            budgets[key] = budgets.get(key, 0) + cents
+    return aggregates, budgets
+
+# 报表的三段: 各账本总额, 分类 × 月份支出, 预算 vs 实际; 段之间空一行
+def report_rows(partials, aggregates, budgets, months):
+    rows = [["账本", "记录数", "总收入", "总支出", "结余"]]
+    for partial in partials:
+        income, expense = partial['aggregates'].get_total("收入"), partial['aggregates'].get_total("支出")
+        rows.append([partial['name'], partial['records'], ledger.format_cents(income),
+                     ledger.format_cents(expense), ledger.format_cents(income - expense)])
+    income, expense = aggregates.get_total("收入"), aggregates.get_total("支出")
+    rows.append(["合计", sum(partial['records'] for partial in partials), ledger.format_cents(income),
+                 ledger.format_cents(expense), ledger.format_cents(income - expense)])
+
+    labels = [ledger.month_label(month) for month in months]
+    table = {}
+    for month, label in zip(months, labels):
+        for category, cents in aggregates.monthly.get(month, {}).items():
+            table.setdefault(category, {})[label] = cents
+    pivot, column_totals = ledger.pivot_rows(table, labels)
+    rows += [[], ["分类"] + labels + ["合计"]] + pivot + [ledger.total_row("合计", column_totals)]
+
+    rows += [[], ledger.BUDGET_HEADER]
+    for month, label in zip(months, labels):
+        actual = aggregates.monthly.get(month, {})
+        for category in sorted(set(actual) | {c for m, c in budgets if m == month}):
+            rows.append(ledger.budget_row(label, category, budgets.get((month, category)), actual.get(category, 0)))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多个账本目录的合并报表")
+    parser.add_argument("directories", nargs="+", help="账本目录")
+    parser.add_argument("--year", type=int, default=datetime.now().year, help="统计的年份, 默认为今年")
+    parser.add_argument("--from", dest="month_from", help="起始月份 YYYY-MM, 与 --to 一起代替 --year")
+    parser.add_argument("--to", dest="month_to", help="结束月份 YYYY-MM")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="工作进程数, 默认为 CPU 核数")
+    parser.add_argument("--output", default="consolidated.csv", help="输出的 CSV 文件")
+    args = parser.parse_args(argv)
+    month_from = args.month_from or f"{args.year:04d}-01"
+    month_to = args.month_to or f"{args.year:04d}-12"
+    try:
+        months = ledger.months_between(month_from, month_to)
+    except ValueError:
+        parser.error("月份格式应为 YYYY-MM")
+
+    started = time.perf_counter()
+    partials = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(args.directories)))) as pool:
+        futures = [pool.submit(aggregate_ledger, directory, os.path.abspath(directory), month_from, month_to)
+                   for directory in args.directories]
+        for future in as_completed(futures):
+            partial = future.result()
+            partials[partial['name']] = partial
+            if partial['error']:
+                print(f"账本 {partial['name']} 汇总失败: {partial['error']}", file=sys.stderr)
+            else:
+                print(f"{partial['name']}: {partial['records']} 条, 用时 {partial['seconds']:.2f}s", file=sys.stderr)
+
+    done = [partials[directory] for directory in args.directories if not partials[directory]['error']]
+    aggregates, budgets = merge_partials(done)
+    rows = report_rows(done, aggregates, budgets, months)
+    ledger.write_report_csv(args.output, rows[0], rows[1:])
+    print(f"已写出 {args.output}: {len(done)} 个账本, {sum(p['records'] for p in done)} 条记录, "
+          f"{month_from} 至 {month_to}, 用时 {time.perf_counter() - started:.1f}s")
+    return 1 if len(done) < len(args.directories) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3275 @@
+# 记账核心: 记录、分类、预算、查询、聚合和持久化, 不依赖 Qt, 可以在脚本和定时任务中直接使用
+import codecs
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from itertools import chain
+from datetime import date, datetime
+
+# 跨进程文件锁: POSIX 用 flock, Windows 用 msvcrt.locking
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# 存储后端: "json" 每次整体重写 records.json, "journal" 追加日志并定期压缩,
+# "sqlite" 使用本地数据库 ledger.db, "sharded" 每个月 (或每年) 一个文件 (首次启动时都会自动迁移已有 JSON 文件)
+STORAGE_BACKEND = "sqlite"
+SQLITE_PATH = "ledger.db"
+# 分片存储的目录和分片周期 ("month" 或 "year")
+SHARD_DIR = "records"
+SHARD_PERIOD = "month"
+# JSON 和日志后端保存 records.json 时同时写出的二进制快照, records.json 没有被改过时启动直接映射它.
+# 实际文件名中还带有 records.json 的大小和修改时间 (如 records.1f3a.17c2e5d4a1b0.bin), 见 binary_snapshot_path
+BINARY_SNAPSHOT_PATH = "records.bin"
+# 多个实例 (或导入脚本) 打开同一个账本时用于互斥写入的锁文件. 保存线程在整次写入期间持有它
+LOCK_PATH = "ledger.lock"
+# 保存下一个可用记录编号的文件, 用单独的锁只在读写计数时短暂持有; 每个实例一次领取这么多个编号, 用完再领
+ID_COUNTER_PATH = "ledger.ids"
+ID_BLOCK_SIZE = 1000
+# 后台保存的防抖时间 (秒): 连续改动在安静这么久之后合并为一次写入
+SAVE_DELAY = 0.5
+# 账单导入: 每批提交的记录数
+IMPORT_BATCH_SIZE = 5000
+# 分页加载: 每页的记录数
+LOAD_PAGE_SIZE = 20000
+# 账单导入时各字段可能的列名, 按顺序匹配表头
+IMPORT_COLUMN_NAMES = {
+    'date': ["日期", "交易日期", "记账日期", "交易时间", "date"],
+    'description': ["描述", "摘要", "备注", "交易说明", "商品", "description"],
+    'amount': ["金额", "交易金额", "金额(元)", "amount"],
+    'type': ["类型", "收/支", "收支", "type"],
+    'category': ["分类", "category"]
+}
+IMPORT_DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d", "%Y%m%d", "%Y.%m.%d", "%Y年%m月%d日",
+                       "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M"]
+# 账单没有分类列时按描述关键字自动分类, 可以用 category_rules.json ([[关键字, 分类], ...]) 覆盖
+DEFAULT_CATEGORY_RULES = [
+    ["外卖", "餐饮"], ["餐", "餐饮"], ["咖啡", "餐饮"], ["饭", "餐饮"],
+    ["地铁", "交通"], ["公交", "交通"], ["打车", "交通"], ["滴滴", "交通"], ["加油", "交通"],
+    ["超市", "购物"], ["淘宝", "购物"], ["京东", "购物"],
+    ["电影", "娱乐"], ["游戏", "娱乐"],
+    ["房租", "住房"], ["物业", "住房"], ["水电", "住房"],
+    ["工资", "工资"], ["薪", "工资"], ["奖金", "奖金"], ["利息", "投资"], ["分红", "投资"]
+]
+# 为 True 时每次改动记录后都把聚合缓存与全量重算结果对比 (调试用)
+CHECK_AGGREGATES = False
+# 日志条数超过 max(JOURNAL_COMPACT_MIN, 记录数 // JOURNAL_COMPACT_RATIO) 时压缩为快照
+JOURNAL_COMPACT_MIN = 500
+JOURNAL_COMPACT_RATIO = 4
+# 设置环境变量 LEDGER_PROFILE=1 时启动即打开性能剖析, 也可以在性能面板中开关
+PROFILE_ENV = "LEDGER_PROFILE"
+# 设置环境变量 LEDGER_API (端口号, 或 "unix:" 加套接字路径) 时主窗口启动本机脚本接口, 见 ledger_api.py
+API_ENV = "LEDGER_API"
+# 每个阶段保留最近多少次耗时用于计算 p50 / p95, 以及最多保留多少个 trace 事件
+PROFILE_WINDOW = 200
+PROFILE_MAX_EVENTS = 100000
+
+# 关闭剖析时 span() 返回的空上下文, 不计时也不分配对象
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+class Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+# 性能剖析器: 记录各阶段的耗时 (span) 和计数 (处理的记录数、写入的字节数), 可导出为 Chrome trace
+# (chrome://tracing 或 Perfetto 打开). 关闭时每个埋点只多一次属性判断
+class Profiler:
+    NULL_SPAN = NullSpan()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counters = {}
+            self.events = deque(maxlen=PROFILE_MAX_EVENTS)
+
+    # with profiler.span("save", records=n): ...
+    def span(self, name, **args):
+        if not self.enabled:
+            return self.NULL_SPAN
+        return Span(self, name, args)
+
+    def record(self, name, start, end, args=None):
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=PROFILE_WINDOW)
+            samples.append(end - start)
+            self.events.append(("X", name, start, end - start, threading.get_ident(), args))
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            total = self.counters[name] = self.counters.get(name, 0) + value
+            self.events.append(("C", name, time.perf_counter(), total, threading.get_ident(), None))
+
+    # 返回 {阶段: (次数, p50, p95, 最近一次)}, 耗时单位为秒, 只统计最近 PROFILE_WINDOW 次
+    def stats(self):
+        with self.lock:
+            windows = {name: list(samples) for name, samples in self.samples.items()}
+        result = {}
+        for name, values in windows.items():
+            ordered = sorted(values)
+            result[name] = (len(values), percentile(ordered, 0.5), percentile(ordered, 0.95), values[-1])
+        return result
+
+    def export_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        pid = os.getpid()
+        for kind, name, start, value, tid, args in events:
+            event = {'name': name, 'ph': kind, 'ts': (start - self.origin) * 1e6, 'pid': pid, 'tid': tid}
+            if kind == "X":
+                event['dur'] = value * 1e6
+                if args:
+                    event['args'] = args
+            else:
+                event['args'] = {name: value}
+            trace.append(event)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({'traceEvents': trace}, f)
+        return len(trace)
+
+profiler = Profiler(enabled=bool(os.environ.get(PROFILE_ENV)))
+
+# 原子写入: 先写临时文件再 rename, 中途崩溃不会留下半个文件
+def atomic_write_bytes(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    profiler.count("bytes_written", len(data))
+
+# 文件的 (大小, 修改时间), 不存在时为 None
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+# 跨进程文件锁: 写入账本文件和读取其他实例的改动在 LOCK_PATH 的锁内进行, 领取记录编号在 ID_COUNTER_PATH
+# 的锁内进行. 同一个对象可以在同一线程中重复进入; 同一进程的不同线程之间也互斥
+class FileLock:
+    def __init__(self, path=LOCK_PATH):
+        self.path = path
+        self.file = None
+        self.depth = 0
+        self.thread_lock = threading.RLock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                self.file = open(self.path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self.file.seek(0)
+                    # LK_LOCK 重试 10 秒后抛出 OSError, 继续等待
+                    while True:
+                        try:
+                            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass
+            except Exception:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.thread_lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+    # 锁文件中保存的下一个可用编号, 只能在锁内调用
+    def read_counter(self):
+        self.file.seek(0)
+        text = self.file.read().strip()
+        return int(text) if text.isdigit() else 0
+
+    def write_counter(self, value):
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(str(value).encode("ascii"))
+        self.file.flush()
+
+# 旧版本保存的记录没有编号: 按在文件中的位置编号 (每次加载结果相同), 有记录被编号时返回 True
+def assign_record_ids(records):
+    assigned = False
+    for i, rec in enumerate(records):
+        if 'id' not in rec:
+            rec['id'] = i
+            assigned = True
+    return assigned
+
+# 按编号把一条改动应用到 RecordColumns 上, 返回是否生效. 多个实例可能先后改同一条记录:
+# 编号已存在的记录不再追加, 已被删除的记录忽略之后的编辑和删除 (删除优先)
+def apply_change(records, op, record_id, record):
+    if op == "add":
+        if records.row_of(record.get('id')) >= 0:
+            return False
+        records.append(record)
+        return True
+    if op not in ("edit", "delete"):
+        raise KeyError(op)
+    row = records.row_of(record_id)
+    if row < 0:
+        return False
+    if op == "edit":
+        records[row] = record
+    else:
+        del records[row]
+    return True
+
+# 追加式交易日志: records.json 作为快照, records.journal 记录之后的增删改.
+# 多个实例可以向同一个日志追加 (在 FileLock 内), 各自记住已读到的位置, 之后只读取其他实例追加的部分
+class RecordJournal:
+    def __init__(self, snapshot_path="records.json", journal_path="records.journal", read_only=False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        # 只读时重放不重置日志, 也不截断末尾损坏的条目
+        self.read_only = read_only
+        self.snapshot_crc = 0
+        self.entry_count = 0
+        # 快照或日志中有没有编号的旧记录, 需要压缩一次把编号写回快照
+        self.ids_assigned = False
+        # 重放时的 编号 -> 下标 和下一个可用编号
+        self.positions = None
+        self.next_id = 0
+        # 已读到 (或本实例写到) 的日志末尾位置, 以及在这之后本实例追加的 [起点, 终点) 区间, 读取增量时跳过
+        self.size = 0
+        self.own = []
+
+    def load(self):
+        records = []
+        data = b""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+            records = json.loads(data.decode("utf-8")) if data.strip() else []
+        self.snapshot_crc = zlib.crc32(data)
+        self.ids_assigned = assign_record_ids(records)
+        self.entry_count = self.replay(records)
+        return records
+
+    def replay(self, records):
+        if not os.path.exists(self.journal_path):
+            if not self.read_only:
+                self.reset()
+            return 0
+        with open(self.journal_path, "rb") as f:
+            data = f.read()
+
+        # 第一行是日志头, 记录它所基于的快照校验值; 不匹配说明压缩时在重置日志前崩溃, 日志内容已在快照中
+        lines = data.split(b"\n")
+        try:
+            header = json.loads(lines[0].decode("utf-8"))
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("snapshot_crc") != self.snapshot_crc:
+            if not self.read_only:
+                self.reset()
+            return 0
+
+        good_end = len(lines[0]) + 1
+        count = 0
+        self.positions = None
+        # 最后一段没有换行符说明写入被中断, 与无法解析的行一样丢弃并截断
+        for line in lines[1:-1]:
+            try:
+                entry = json.loads(line.decode("utf-8"))
+                self.apply(records, entry)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                print(f"日志条目损坏, 已忽略之后的内容: {e}")
+                break
+            good_end += len(line) + 1
+            count += 1
+
+        if good_end < len(data) and not self.read_only:
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_end)
+        self.size = good_end
+        self.own = []
+        return count
+
+    # 按记录编号应用一条日志, 删除与 RecordColumns 一样用最后一条记录填补空位; 已被 (其他实例) 删除的
+    # 记录的编辑和删除直接忽略. 旧版本的日志按下标 ("index") 修改和删除, 追加的记录没有编号
+    def apply(self, records, entry):
+        op = entry["op"]
+        if isinstance(records, RecordColumns):
+            self.apply_columns(records, op, entry)
+            return
+        if "index" in entry:
+            if op == "edit":
+                entry["record"]['id'] = records[entry["index"]]['id']
+                records[entry["index"]] = entry["record"]
+            elif op == "delete":
+                del records[entry["index"]]
+            else:
+                raise KeyError(op)
+            self.positions = None
+            return
+        # 编号 -> 下标, 重放开始或按下标删除之后重新建立
+        positions = self.positions
+        if positions is None:
+            positions = self.positions = {rec['id']: i for i, rec in enumerate(records)}
+            self.next_id = max(positions, default=-1) + 1
+        if op == "add":
+            rec = entry["record"]
+            if 'id' not in rec:
+                rec['id'] = self.next_id
+                self.ids_assigned = True
+            elif rec['id'] in positions:
+                return
+            self.next_id = max(self.next_id, rec['id'] + 1)
+            positions[rec['id']] = len(records)
+            records.append(rec)
+        elif op == "edit":
+            if entry["id"] in positions:
+                records[positions[entry["id"]]] = entry["record"]
+        elif op == "delete":
+            i = positions.pop(entry["id"], None)
+            if i is None:
+                return
+            last = records.pop()
+            if i < len(records):
+                records[i] = last
+                positions[last['id']] = i
+        else:
+            raise KeyError(op)
+
+    # 在二进制快照的列上重放, 列式容器自带 编号 -> 行号 索引. 只支持按编号的日志
+    def apply_columns(self, records, op, entry):
+        if op == "add" and 'id' not in entry["record"]:
+            self.ids_assigned = True
+        apply_change(records, op, entry.get("id"), entry.get("record"))
+
+    @staticmethod
+    def entry(op, record_id=None, record=None):
+        entry = {"op": op}
+        if record_id is not None:
+            entry["id"] = record_id
+        if record is not None:
+            entry["record"] = record
+        return entry
+
+    def append(self, op, record_id=None, record=None):
+        self.append_entries([self.entry(op, record_id, record)])
+
+    # 多条日志一次写入, 只 fsync 一次
+    def append_entries(self, entries):
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            start = f.seek(0, os.SEEK_END)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if start == self.size:
+            self.size = start + len(data)
+        else:
+            self.own.append((start, start + len(data)))
+        self.entry_count += len(entries)
+        profiler.count("bytes_written", len(data))
+
+    # 其他实例在上次读取之后追加的日志条目和读到的末尾位置 (调用方持有 FileLock), 由 mark_read 记为已读;
+    # 日志已被其他实例压缩 (基于新的快照重新开始) 时返回 None, 调用方需要整体重新加载
+    def read_new_entries(self):
+        if not os.path.exists(self.journal_path):
+            return None
+        with open(self.journal_path, "rb") as f:
+            try:
+                header = json.loads(f.readline().decode("utf-8"))
+            except ValueError:
+                return None
+            if not isinstance(header, dict) or header.get("snapshot_crc") != self.snapshot_crc:
+                return None
+            f.seek(self.size)
+            data = f.read()
+        entries = []
+        offset = self.size
+        # 锁内读取不会遇到写了一半的条目, 没有换行符的末尾 (崩溃留下的) 留给下次启动时截断
+        for line in data.split(b"\n")[:-1]:
+            start, offset = offset, offset + len(line) + 1
+            if any(low <= start < high for low, high in self.own):
+                continue
+            entries.append(json.loads(line.decode("utf-8")))
+        return entries, offset
+
+    def mark_read(self, offset, count):
+        self.size = offset
+        self.own = [(low, high) for low, high in self.own if low >= offset]
+        self.entry_count += count
+
+    # 日志中没有本实例还没读到的条目时返回 True, 这时才能用内存中的记录压缩日志
+    def is_current(self):
+        stamp = file_stamp(self.journal_path)
+        return stamp is not None and stamp[0] == self.size
+
+    def needs_compaction(self, record_count):
+        return self.entry_count > max(JOURNAL_COMPACT_MIN, record_count // JOURNAL_COMPACT_RATIO)
+
+    def compact(self, records):
+        data = json.dumps(records, ensure_ascii=False, indent=2).encode("utf-8")
+        atomic_write_bytes(self.snapshot_path, data)
+        self.snapshot_crc = zlib.crc32(data)
+        self.ids_assigned = False
+        self.reset()
+
+    # 日志中有旧版本按下标的条目时返回 True
+    def has_index_entries(self):
+        if not os.path.exists(self.journal_path):
+            return False
+        with open(self.journal_path, "rb") as f:
+            return b'"index": ' in f.read()
+
+    # 日志头之后还有内容时返回 True
+    def has_entries(self):
+        if not os.path.exists(self.journal_path):
+            return False
+        with open(self.journal_path, "rb") as f:
+            f.readline()
+            return bool(f.read(1))
+
+    def reset(self):
+        header = json.dumps({"snapshot_crc": self.snapshot_crc}) + "\n"
+        atomic_write_bytes(self.journal_path, header.encode("utf-8"))
+        self.entry_count = 0
+        self.size = len(header)
+        self.own = []
+
+def record_month(date):
+    try:
+        return datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
+    except ValueError:
+        return None
+
+def month_key(month):
+    return int(month[:4]) * 100 + int(month[5:7])
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+# 把 array 或 memoryview 按块复制为新的 array
+def column_array(typecode, column):
+    result = array(typecode)
+    result.frombytes(memoryview(column).cast('B'))
+    return result
+
+# 列式记录容器: 日期解析一次存为天数和月份键, 金额存为整数分, 类型和分类编码为字符串表下标,
+# 描述统一存放在一个 UTF-8 缓冲区中. 下标访问和迭代仍然返回与原来相同的记录字典
+class RecordColumns:
+    # 定长列和类型码, 也是二进制快照中各列的顺序
+    COLUMNS = (("days", 'i'), ("months", 'i'), ("date_texts", 'i'), ("cents", 'q'), ("types", 'i'),
+               ("categories", 'i'), ("desc_starts", 'q'), ("desc_lengths", 'i'), ("ids", 'q'))
+
+    def __init__(self):
+        # 类型 / 分类 / 非标准写法的日期共用一张字符串表
+        self.strings = []
+        self.string_codes = {}
+        self.days = array('i')         # date.toordinal(), 无法解析时为 -1
+        self.months = array('i')       # 年 * 100 + 月, 无法解析时为 -1
+        self.date_texts = array('i')   # -1 表示日期就是 days 的 ISO 写法, 否则为原文在字符串表中的编码
+        self.cents = array('q')
+        self.types = array('i')
+        self.categories = array('i')   # -1 表示记录没有分类字段
+        self.text = bytearray()
+        self.desc_starts = array('q')
+        self.desc_lengths = array('i')
+        # 每条记录的持久编号 (随记录保存), 以及 编号 -> 行号 的索引; 行的顺序不代表编号顺序
+        self.ids = array('q')
+        self.id_rows = {}
+        self.next_id = 0
+        # 编辑和删除后 text 中不再被引用的字节数, 超过一半时整理缓冲区
+        self.garbage = 0
+        # 从二进制快照打开时为映射对象: 除 ids 外的列和 text 是映射上的只读 memoryview, 第一次修改前复制出来
+        self.mapping = None
+        self.date_cache = {}
+        self.iso_cache = {}
+
+    @classmethod
+    def from_records(cls, records):
+        columns = cls()
+        for rec in records:
+            columns.append(rec)
+        return columns
+
+    # 给后台保存线程用的快照: 列数组和缓冲区按块复制, 不逐条生成字典
+    def copy(self):
+        other = RecordColumns()
+        for name, typecode in self.COLUMNS:
+            setattr(other, name, column_array(typecode, getattr(self, name)))
+        other.text = bytearray(self.text)
+        other.id_rows = dict(self.id_rows)
+        other.strings = list(self.strings)
+        other.string_codes = dict(self.string_codes)
+        other.next_id = self.next_id
+        other.garbage = self.garbage
+        return other
+
+    # 接管另一个容器的全部内容 (分页加载时 records 已被界面引用, 不能换成新对象)
+    def adopt(self, other):
+        self.__dict__.update(other.__dict__)
+
+    # 映射的列复制为 array, 之后就可以修改; 没有别的引用后映射随之关闭
+    def make_writable(self):
+        if self.mapping is None:
+            return
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, column_array(typecode, getattr(self, name)))
+        self.text = bytearray(self.text)
+        self.mapping = None
+
+    def intern(self, value):
+        code = self.string_codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(value)
+            self.string_codes[value] = code
+        return code
+
+    def code_of(self, value):
+        return self.string_codes.get(value, -1)
+
+    # 返回 (天数, 月份键, 原文编码); 同一个日期字符串只解析一次
+    def parse_date(self, text):
+        parsed = self.date_cache.get(text)
+        if parsed is None:
+            try:
+                day = datetime.strptime(text, "%Y-%m-%d").date()
+                parsed = (day.toordinal(), day.year * 100 + day.month,
+                          -1 if day.isoformat() == text else self.intern(text))
+            except ValueError:
+                parsed = (-1, -1, self.intern(text))
+            self.date_cache[text] = parsed
+        return parsed
+
+    def __len__(self):
+        return len(self.cents)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        rec = {
+            'id': self.ids[i],
+            'date': self.date(i),
+            'description': self.description(i),
+            'amount': self.cents[i] / 100,
+            'type': self.strings[self.types[i]]
+        }
+        if self.categories[i] >= 0:
+            rec['category'] = self.strings[self.categories[i]]
+        return rec
+
+    def date(self, i):
+        if self.date_texts[i] >= 0:
+            return self.strings[self.date_texts[i]]
+        day = self.days[i]
+        text = self.iso_cache.get(day)
+        if text is None:
+            text = self.iso_cache[day] = date.fromordinal(day).isoformat()
+        return text
+
+    def description(self, i):
+        start = self.desc_starts[i]
+        return str(self.text[start:start + self.desc_lengths[i]], "utf-8")
+
+    def type_name(self, i):
+        return self.strings[self.types[i]]
+
+    def category(self, i):
+        code = self.categories[i]
+        return self.strings[code] if code >= 0 else ''
+
+    def amount_text(self, i):
+        return format_cents(self.cents[i])
+
+    # 编号对应的行号, 不存在时为 -1
+    def row_of(self, record_id):
+        return self.id_rows.get(record_id, -1)
+
+    def rows_of(self, record_ids):
+        id_rows = self.id_rows
+        return [id_rows[record_id] for record_id in record_ids]
+
+    # 记录自带编号时沿用 (重复的除外), 否则分配新编号
+    def take_id(self, rec):
+        record_id = rec.get('id')
+        if record_id is None or record_id in self.id_rows:
+            record_id = self.next_id
+        self.next_id = max(self.next_id, record_id + 1)
+        return record_id
+
+    def append(self, rec):
+        self.make_writable()
+        day, month, date_text = self.parse_date(rec['date'])
+        self.days.append(day)
+        self.months.append(month)
+        self.date_texts.append(date_text)
+        self.cents.append(to_cents(rec['amount']))
+        self.types.append(self.intern(rec['type']))
+        self.categories.append(self.intern(rec['category']) if 'category' in rec else -1)
+        data = rec.get('description', '').encode("utf-8")
+        self.desc_starts.append(len(self.text))
+        self.desc_lengths.append(len(data))
+        self.text += data
+        record_id = self.take_id(rec)
+        self.id_rows[record_id] = len(self.ids)
+        self.ids.append(record_id)
+
+    def __setitem__(self, i, rec):
+        self.make_writable()
+        self.days[i], self.months[i], self.date_texts[i] = self.parse_date(rec['date'])
+        self.cents[i] = to_cents(rec['amount'])
+        self.types[i] = self.intern(rec['type'])
+        self.categories[i] = self.intern(rec['category']) if 'category' in rec else -1
+        data = rec.get('description', '').encode("utf-8")
+        self.garbage += self.desc_lengths[i]
+        self.desc_starts[i] = len(self.text)
+        self.desc_lengths[i] = len(data)
+        self.text += data
+        self.maybe_compact_text()
+
+    # 把最后一行移到被删除的位置, 其他行不动, 代价与记录数无关
+    def __delitem__(self, i):
+        self.make_writable()
+        self.garbage += self.desc_lengths[i]
+        del self.id_rows[self.ids[i]]
+        for column in (self.days, self.months, self.date_texts, self.cents, self.types,
+                       self.categories, self.desc_starts, self.desc_lengths, self.ids):
+            column[i] = column[-1]
+            column.pop()
+        if i < len(self.ids):
+            self.id_rows[self.ids[i]] = i
+        self.maybe_compact_text()
+
+    # 在末尾预先分配 count 行, 分页加载时各页按任意顺序用 fill 写入; 写入之前这些行的内容无效, 编号为 -1
+    def reserve(self, count):
+        self.make_writable()
+        for column in (self.days, self.months, self.date_texts, self.cents, self.types,
+                       self.categories, self.desc_starts, self.desc_lengths):
+            column.extend(array(column.typecode, bytes(column.itemsize * count)))
+        self.ids.extend(array('q', [-1]) * count)
+
+    def fill(self, start, records):
+        for i, rec in enumerate(records, start):
+            self[i] = rec
+            record_id = self.take_id(rec)
+            self.ids[i] = record_id
+            self.id_rows[record_id] = i
+
+    # 删除前 count 行 (预先分配但没有用到的行), 其余行前移, 编号不变
+    def drop_front(self, count):
+        self.make_writable()
+        for column in (self.days, self.months, self.date_texts, self.cents, self.types,
+                       self.categories, self.desc_starts, self.desc_lengths, self.ids):
+            del column[:count]
+        if count:
+            self.id_rows = {record_id: i for i, record_id in enumerate(self.ids)}
+
+    def maybe_compact_text(self):
+        if self.garbage * 2 <= len(self.text):
+            return
+        text = bytearray()
+        for i in range(len(self)):
+            start = self.desc_starts[i]
+            self.desc_starts[i] = len(text)
+            text += self.text[start:start + self.desc_lengths[i]]
+        self.text = text
+        self.garbage = 0
+
+# 二进制快照: 头部之后是字符串表 (JSON 数组), RecordColumns.COLUMNS 中的各列 (本机字节序) 和描述缓冲区,
+# 每段按 8 字节对齐. 头部记录对应的 records.json 的大小、修改时间和 CRC32, JSON 文件在快照之后被改过
+# (或被别的程序替换) 时不使用快照
+SNAPSHOT_MAGIC = b"LEDGSNAP"
+SNAPSHOT_VERSION = 1
+# 魔数, 版本, 是否小端, 记录数, 下一个编号, 描述缓冲区中的废弃字节数, 字符串表长度, 描述缓冲区长度,
+# JSON 文件大小, JSON 文件修改时间 (纳秒), JSON 文件 CRC32, 头部 (校验和记为 0) 和之后全部内容的 CRC32
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQQQQQQII")
+
+def aligned(size):
+    return (size + 7) // 8 * 8
+
+# 与 source_path 当前内容对应的快照文件名. 每次保存写到新的文件, 不覆盖旧的: 旧快照可能还被映射着
+# (本实例的记录列或其他实例), Windows 上不能替换或删除映射中的文件
+def binary_snapshot_path(source_path, path=BINARY_SNAPSHOT_PATH):
+    stat = os.stat(source_path)
+    base, ext = os.path.splitext(path)
+    return f"{base}.{stat.st_size:x}.{stat.st_mtime_ns:x}{ext}"
+
+# 删除 current 以外的旧快照 (包括不带版本的旧文件名); 还在映射中删不掉的留到下次保存
+def remove_old_snapshots(current, path=BINARY_SNAPSHOT_PATH):
+    directory, name = os.path.split(path)
+    base, ext = os.path.splitext(name)
+    pattern = re.compile(re.escape(base) + r"\.[0-9a-f]+\.[0-9a-f]+" + re.escape(ext))
+    for entry in os.listdir(directory or "."):
+        old = os.path.join(directory, entry)
+        if old != current and (entry == name or pattern.fullmatch(entry)):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+# source_path 为刚写好的 JSON 文件, source_crc 为其内容的 CRC32
+def write_binary_snapshot(records, source_path, source_crc, path=BINARY_SNAPSHOT_PATH):
+    with profiler.span("snapshot", records=len(records)):
+        strings = json.dumps(records.strings, ensure_ascii=False).encode("utf-8")
+        chunks = [strings]
+        for name, _ in RecordColumns.COLUMNS:
+            chunks.append(getattr(records, name).tobytes())
+        chunks.append(bytes(records.text))
+        body = b"".join(chunk + bytes(aligned(len(chunk)) - len(chunk)) for chunk in chunks)
+        stat = os.stat(source_path)
+        fields = (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder == "little", len(records), records.next_id,
+                  records.garbage, len(strings), len(records.text), stat.st_size, stat.st_mtime_ns, source_crc)
+        checksum = zlib.crc32(body, zlib.crc32(SNAPSHOT_HEADER.pack(*fields, 0)))
+        current = binary_snapshot_path(source_path, path)
+        atomic_write_bytes(current, SNAPSHOT_HEADER.pack(*fields, checksum) + body)
+        remove_old_snapshots(current, path)
+
+# 映射与 source_path 对应的二进制快照, 返回 (RecordColumns, JSON 文件的 CRC32);
+# 没有快照、快照已过期或校验失败时返回 None, 调用方改为读取 JSON
+def open_binary_snapshot(source_path, path=BINARY_SNAPSHOT_PATH):
+    if not os.path.exists(source_path):
+        return None
+    path = binary_snapshot_path(source_path, path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SNAPSHOT_HEADER.size:
+                return None
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        print(f"打开二进制快照失败: {e}")
+        return None
+    fields = SNAPSHOT_HEADER.unpack_from(mapping)
+    (magic, version, little, count, next_id, garbage, strings_size, text_size,
+     source_size, source_mtime, source_crc, checksum) = fields
+    stat = os.stat(source_path)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or little != (sys.byteorder == "little") or \
+            (stat.st_size, stat.st_mtime_ns) != (source_size, source_mtime):
+        return None
+    sizes = [strings_size] + [count * array(typecode).itemsize for _, typecode in RecordColumns.COLUMNS]
+    view = memoryview(mapping)
+    if SNAPSHOT_HEADER.size + sum(aligned(size) for size in sizes) + aligned(text_size) != size or \
+            zlib.crc32(view[SNAPSHOT_HEADER.size:], zlib.crc32(SNAPSHOT_HEADER.pack(*fields[:-1], 0))) != checksum:
+        print("二进制快照校验失败, 改为读取 JSON")
+        return None
+
+    records = RecordColumns()
+    offset = SNAPSHOT_HEADER.size
+    records.strings = json.loads(str(view[offset:offset + strings_size], "utf-8"))
+    records.string_codes = {value: code for code, value in enumerate(records.strings)}
+    offset += aligned(strings_size)
+    for (name, typecode), column_size in zip(RecordColumns.COLUMNS, sizes[1:]):
+        setattr(records, name, view[offset:offset + column_size].cast(typecode))
+        offset += aligned(column_size)
+    records.text = view[offset:offset + text_size]
+    # 编号要建立 编号 -> 行号 索引, 并且会随增删改变, 直接复制出来
+    records.ids = column_array('q', records.ids)
+    records.id_rows = dict(zip(records.ids, range(count)))
+    records.next_id = next_id
+    records.garbage = garbage
+    records.mapping = mapping
+    return records, source_crc
+
+# 描述的字符 n-gram 倒排索引. 中文没有词边界, 按单字和相邻两字切分即可覆盖任意子串查询.
+# 账本里的描述大量重复, 因此倒排表指向去重后的描述文本, 每个文本再对应一组有序的记录编号
+class NgramIndex:
+    def __init__(self):
+        # gram -> 包含它的描述文本 (小写) 集合
+        self.postings = {}
+        # 描述文本 (小写) -> 有序的记录编号
+        self.ids_by_text = {}
+
+    @staticmethod
+    def grams(text):
+        if len(text) == 1:
+            return {text}
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def build(self, records):
+        # 先按原始字节分组, 每个不同的描述只解码和切分一次
+        text = bytes(records.text)
+        groups = {}
+        for record_id, start, length in zip(records.ids, records.desc_starts, records.desc_lengths):
+            key = text[start:start + length]
+            ids = groups.get(key)
+            if ids is None:
+                ids = groups[key] = array('q')
+            ids.append(record_id)
+        self.postings = {}
+        self.ids_by_text = {}
+        for key, ids in groups.items():
+            # 行的顺序不是编号顺序 (删除会移动最后一行, 分片按需追加)
+            ids = array('q', sorted(ids))
+            lowered = key.decode("utf-8").lower()
+            existing = self.ids_by_text.get(lowered)
+            if existing is not None:
+                # 只有大小写不同的描述合并到一起
+                self.ids_by_text[lowered] = array('q', sorted(existing + ids))
+                continue
+            self.ids_by_text[lowered] = ids
+            self.add_text(lowered)
+
+    def add_text(self, text):
+        for gram in self.grams(text) | set(text):
+            self.postings.setdefault(gram, set()).add(text)
+
+    def add(self, records, i):
+        text = records.description(i).lower()
+        record_id = records.ids[i]
+        ids = self.ids_by_text.get(text)
+        if ids is None:
+            self.ids_by_text[text] = array('q', [record_id])
+            self.add_text(text)
+        elif ids[-1] < record_id:
+            ids.append(record_id)
+        else:
+            ids.insert(bisect_left(ids, record_id), record_id)
+
+    def remove(self, records, i):
+        text = records.description(i).lower()
+        ids = self.ids_by_text.get(text)
+        if ids is None:
+            return
+        j = bisect_left(ids, records.ids[i])
+        if j < len(ids) and ids[j] == records.ids[i]:
+            del ids[j]
+        if ids:
+            return
+        del self.ids_by_text[text]
+        for gram in self.grams(text) | set(text):
+            texts = self.postings.get(gram)
+            if texts is not None:
+                texts.discard(text)
+                if not texts:
+                    del self.postings[gram]
+
+    # 返回描述中包含 keyword (已转小写) 的记录行号
+    def search(self, records, keyword):
+        return records.rows_of(self.search_ids(keyword))
+
+    # 返回描述中包含 keyword (已转小写) 的记录编号, 按编号排序
+    def search_ids(self, keyword):
+        candidates = []
+        for gram in self.grams(keyword):
+            texts = self.postings.get(gram)
+            if texts is None:
+                return []
+            candidates.append(texts)
+        candidates.sort(key=len)
+        texts = candidates[0].intersection(*candidates[1:])
+        if len(keyword) > 2:
+            texts = [text for text in texts if keyword in text]
+        if len(texts) == 1:
+            return list(self.ids_by_text[next(iter(texts))])
+        return sorted(record_id for text in texts for record_id in self.ids_by_text[text])
+
+# 组合查询条件, 各项为 None 表示不限. 日期为 YYYY-MM-DD 字符串 (含两端), 金额单位为元
+class RecordQuery:
+    def __init__(self, date_from=None, date_to=None, types=None, categories=None,
+                 amount_min=None, amount_max=None, keyword=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.types = set(types) if types else None
+        self.categories = set(categories) if categories else None
+        self.amount_min = amount_min
+        self.amount_max = amount_max
+        self.keyword = keyword.lower() if keyword else None
+
+    def is_empty(self):
+        return all(value is None for value in (
+            self.date_from, self.date_to, self.types, self.categories,
+            self.amount_min, self.amount_max, self.keyword))
+
+# 位图中置位的编号, 逐字节跳过全零部分
+BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+def bitmap_from_ids(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for record_id in ids:
+        data[record_id >> 3] |= 1 << (record_id & 7)
+    return int.from_bytes(data, "little")
+
+def bitmap_ids(bitmap):
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    ids = []
+    for match in re.finditer(rb"[^\x00]", data):
+        base = match.start() * 8
+        ids.extend(base + bit for bit in BYTE_BITS[data[match.start()]])
+    return ids
+
+# 查询引擎: 按日期排序的索引、类型/分类位图和描述 n-gram 索引.
+# 规划器按估计结果数从小到大使用索引, 在位图上求交集, 最后才把编号换成行号并检查剩余条件
+class QueryEngine:
+    # 索引的估计结果数超过最小者的这个倍数时, 不再用它求交集, 改为逐行检查
+    INTERSECT_RATIO = 4
+
+    def __init__(self, records):
+        self.records = records
+        # 第一次查询时才建立
+        self.text_index = None
+        self.date_days = None
+        self.date_ids = None
+        self.bitmaps = None
+        self.counts = None
+
+    # 批量改动后丢弃所有索引, 下次查询时重建
+    def reset(self):
+        self.text_index = None
+        self.bitmaps = None
+
+    def build_text_index(self):
+        if self.text_index is None:
+            self.text_index = NgramIndex()
+            self.text_index.build(self.records)
+        return self.text_index
+
+    def build_indexes(self):
+        if self.bitmaps is not None:
+            return
+        records = self.records
+        order = sorted(range(len(records)), key=records.days.__getitem__)
+        self.date_days = array('i', (records.days[i] for i in order))
+        self.date_ids = array('q', (records.ids[i] for i in order))
+        groups = {}
+        for column in ("type", "category"):
+            codes = records.types if column == "type" else records.categories
+            for code, record_id in zip(codes, records.ids):
+                groups.setdefault((column, code), []).append(record_id)
+        self.bitmaps = {key: bitmap_from_ids(ids) for key, ids in groups.items()}
+        self.counts = {key: len(ids) for key, ids in groups.items()}
+
+    def add(self, i):
+        if self.text_index is not None:
+            self.text_index.add(self.records, i)
+        if self.bitmaps is None:
+            return
+        records = self.records
+        record_id = records.ids[i]
+        position = bisect_left(self.date_days, records.days[i] + 1)
+        self.date_days.insert(position, records.days[i])
+        self.date_ids.insert(position, record_id)
+        for key in (("type", records.types[i]), ("category", records.categories[i])):
+            self.bitmaps[key] = self.bitmaps.get(key, 0) | (1 << record_id)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def remove(self, i):
+        if self.text_index is not None:
+            self.text_index.remove(self.records, i)
+        if self.bitmaps is None:
+            return
+        records = self.records
+        record_id = records.ids[i]
+        day = records.days[i]
+        for position in range(bisect_left(self.date_days, day), bisect_left(self.date_days, day + 1)):
+            if self.date_ids[position] == record_id:
+                del self.date_days[position]
+                del self.date_ids[position]
+                break
+        for key in (("type", records.types[i]), ("category", records.categories[i])):
+            self.bitmaps[key] &= ~(1 << record_id)
+            self.counts[key] -= 1
+
+    def code_bitmap(self, column, names):
+        bitmap = 0
+        count = 0
+        for name in names:
+            key = (column, self.records.code_of(name))
+            bitmap |= self.bitmaps.get(key, 0)
+            count += self.counts.get(key, 0)
+        return bitmap, count
+
+    def date_range(self, query):
+        day_from = datetime.strptime(query.date_from, "%Y-%m-%d").toordinal() if query.date_from else 0
+        day_to = datetime.strptime(query.date_to, "%Y-%m-%d").toordinal() if query.date_to else None
+        low = bisect_left(self.date_days, day_from)
+        high = bisect_left(self.date_days, day_to + 1) if day_to is not None else len(self.date_days)
+        return day_from, day_to, low, high
+
+    # 返回 [(名称, 估计结果数, 取位图的函数)], 按估计结果数升序
+    def plan(self, query):
+        self.build_indexes()
+        steps = []
+        if query.types:
+            bitmap, count = self.code_bitmap("type", query.types)
+            steps.append(("类型位图", count, lambda bitmap=bitmap: bitmap))
+        if query.categories:
+            bitmap, count = self.code_bitmap("category", query.categories)
+            steps.append(("分类位图", count, lambda bitmap=bitmap: bitmap))
+        if query.date_from or query.date_to:
+            _, _, low, high = self.date_range(query)
+            steps.append(("日期索引", high - low, lambda: bitmap_from_ids(self.date_ids[low:high])))
+        if query.keyword:
+            ids = self.build_text_index().search_ids(query.keyword)
+            steps.append(("描述索引", len(ids), lambda: bitmap_from_ids(ids)))
+        steps.sort(key=lambda step: step[1])
+        return steps
+
+    def run(self, query):
+        records = self.records
+        steps = self.plan(query)
+        used = set()
+        bitmap = None
+        for name, estimate, get_bitmap in steps:
+            # 位图已经建好, 求交集几乎没有代价; 其余索引只在足够有选择性时使用
+            prebuilt = name in ("类型位图", "分类位图")
+            if bitmap is None or prebuilt or estimate <= steps[0][1] * self.INTERSECT_RATIO:
+                bitmap = get_bitmap() if bitmap is None else bitmap & get_bitmap()
+                used.add(name)
+        rows = records.rows_of(bitmap_ids(bitmap)) if bitmap is not None else range(len(records))
+
+        # 剩余条件直接在列上逐行检查
+        checks = []
+        if query.types and "类型位图" not in used:
+            codes = {records.code_of(name) for name in query.types}
+            checks.append(lambda i: records.types[i] in codes)
+        if query.categories and "分类位图" not in used:
+            codes = {records.code_of(name) for name in query.categories}
+            checks.append(lambda i: records.categories[i] in codes)
+        if (query.date_from or query.date_to) and "日期索引" not in used:
+            day_from, day_to, _, _ = self.date_range(query)
+            checks.append(lambda i: day_from <= records.days[i] and (day_to is None or records.days[i] <= day_to))
+        if query.keyword and "描述索引" not in used:
+            checks.append(lambda i: query.keyword in records.description(i).lower())
+        if query.amount_min is not None:
+            cents_min = to_cents(query.amount_min)
+            checks.append(lambda i: records.cents[i] >= cents_min)
+        if query.amount_max is not None:
+            cents_max = to_cents(query.amount_max)
+            checks.append(lambda i: records.cents[i] <= cents_max)
+        return [i for i in rows if all(check(i) for check in checks)]
+
+# 聚合缓存: 按类型的总额和按 (月份, 分类) 的支出 (单位: 分), 随记录增删改做增量更新
+class AggregateCache:
+    def __init__(self):
+        self.totals = {}
+        # 月份键 -> {category: cents}, 只统计支出
+        self.monthly = {}
+        # (月份键, category) -> 记录数, 归零时从 monthly 中移除该分类
+        self.counts = {}
+
+    def rebuild(self, records, rows=None):
+        self.__init__()
+        rows = rows if rows is not None else range(len(records))
+        with profiler.span("aggregate", records=len(rows)):
+            for i in rows:
+                self.add(records, i)
+        profiler.count("records_aggregated", len(rows))
+
+    def add(self, records, i, sign=1):
+        amount = records.cents[i] * sign
+        type_name = records.strings[records.types[i]]
+        self.totals[type_name] = self.totals.get(type_name, 0) + amount
+        month = records.months[i]
+        if type_name != "支出" or month < 0:
+            return
+        code = records.categories[i]
+        category = records.strings[code] if code >= 0 else '其他'
+        key = (month, category)
+        count = self.counts.get(key, 0) + sign
+        expenses = self.monthly.setdefault(month, {})
+        if count:
+            self.counts[key] = count
+            expenses[category] = expenses.get(category, 0) + amount
+        else:
+            del self.counts[key]
+            del expenses[category]
+            if not expenses:
+                del self.monthly[month]
+
+    def remove(self, records, i):
+        self.add(records, i, -1)
+
+    # 合并 (sign 为 -1 时减去) 另一份记录不重叠的聚合结果, 用于分页加载和分片存储
+    def merge(self, other, sign=1):
+        for type_name, amount in other.totals.items():
+            self.totals[type_name] = self.totals.get(type_name, 0) + amount * sign
+        for (month, category), count in other.counts.items():
+            key = (month, category)
+            count = self.counts.get(key, 0) + count * sign
+            expenses = self.monthly.setdefault(month, {})
+            if count:
+                self.counts[key] = count
+                expenses[category] = expenses.get(category, 0) + other.monthly[month][category] * sign
+            else:
+                self.counts.pop(key, None)
+                expenses.pop(category, None)
+                if not expenses:
+                    del self.monthly[month]
+
+    # 分片清单中保存的格式: 月份键写成字符串
+    def to_json(self):
+        counts = {}
+        for (month, category), count in self.counts.items():
+            counts.setdefault(str(month), {})[category] = count
+        return {'totals': dict(self.totals),
+                'monthly': {str(month): dict(expenses) for month, expenses in self.monthly.items()},
+                'counts': counts}
+
+    @classmethod
+    def from_json(cls, data):
+        aggregates = cls()
+        aggregates.totals = dict(data['totals'])
+        aggregates.monthly = {int(month): dict(expenses) for month, expenses in data['monthly'].items()}
+        aggregates.counts = {(int(month), category): count
+                             for month, counts in data['counts'].items() for category, count in counts.items()}
+        return aggregates
+
+    def get_total(self, type_name):
+        return self.totals.get(type_name, 0)
+
+    def get_monthly_expenses(self, month):
+        return dict(self.monthly.get(month_key(month), {}))
+
+    # 按月份排序的 [(月份键, 当月支出 cents)]
+    def get_monthly_totals(self):
+        return [(month, sum(expenses.values())) for month, expenses in sorted(self.monthly.items())]
+
+    def get_category_expenses(self):
+        expenses = {}
+        for month_expenses in self.monthly.values():
+            for category, cents in month_expenses.items():
+                expenses[category] = expenses.get(category, 0) + cents
+        return expenses
+
+    # 与另一份聚合结果比较, 返回不一致项的描述
+    def diff(self, other):
+        groups = [("总额", self.totals, other.totals)]
+        for month in sorted(set(self.monthly) | set(other.monthly)):
+            groups.append((f"{month} 支出", self.monthly.get(month, {}), other.monthly.get(month, {})))
+        problems = []
+        for name, mine, theirs in groups:
+            for key in set(mine) | set(theirs):
+                if mine.get(key, 0) != theirs.get(key, 0):
+                    problems.append(f"{name} {key}: 缓存 {format_cents(mine.get(key, 0))}, "
+                                    f"重算 {format_cents(theirs.get(key, 0))}")
+        return problems
+
+    # extra 为没有读入内存的记录的聚合结果 (分片存储)
+    def verify(self, records, extra=None):
+        expected = AggregateCache()
+        expected.rebuild(records)
+        if extra is not None:
+            expected.merge(extra)
+        return self.diff(expected)
+
+def month_label(month):
+    return f"{month // 100:04d}-{month % 100:02d}"
+
+# [month_from, month_to] 之间的月份键, 参数为 "YYYY-MM"
+def months_between(month_from, month_to):
+    months = []
+    month, last = month_key(month_from), month_key(month_to)
+    while month <= last:
+        months.append(month)
+        month = month + 1 if month % 100 < 12 else (month // 100 + 1) * 100 + 1
+    return months
+
+# 报表种类: 键 -> 显示名称
+REPORT_KINDS = {
+    "category_month": "分类 × 月份",
+    "type_year": "类型 × 年份",
+    "budget": "预算 vs 实际",
+}
+
+# 报表引擎: 按月份缓存 (类型, 分类) -> 金额 (分) 的分组结果, 记录改动时只作废改动所在的月份.
+# 已经结束且没有改动的月份算过一次就不再重算, 年度和任意区间的透视表都由月份结果合并得到
+class ReportEngine:
+    # 需要计算的月份不超过这个数时, 借助查询引擎的日期索引只扫描这些月份的记录, 否则整列扫描一遍
+    INDEX_MONTHS = 3
+
+    def __init__(self, records, query_engine):
+        self.records = records
+        self.query_engine = query_engine
+        # 月份键 -> {(type, category): cents}
+        self.periods = {}
+        # 月份键 -> {date.toordinal(): 当天支出 cents}, 与 periods 一起计算和作废
+        self.daily = {}
+
+    def invalidate(self, month):
+        self.periods.pop(month, None)
+        self.daily.pop(month, None)
+
+    def reset(self):
+        self.periods = {}
+        self.daily = {}
+
+    def rows_in_months(self, months):
+        engine = self.query_engine
+        engine.build_indexes()
+        ids = []
+        for month in months:
+            first = date(month // 100, month % 100, 1)
+            following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+            low = bisect_left(engine.date_days, first.toordinal())
+            high = bisect_left(engine.date_days, following.toordinal())
+            ids.extend(engine.date_ids[low:high])
+        return self.records.rows_of(ids)
+
+    # 在列上按 (月份, 类型编码, 分类编码) 和支出的日期分组求和, 最后才把编码换成名称
+    def compute(self, months):
+        records = self.records
+        wanted = set(months)
+        expense_code = records.code_of("支出")
+        groups = {}
+        daily = {month: {} for month in wanted}
+        with profiler.span("report", months=len(wanted)):
+            if len(wanted) <= self.INDEX_MONTHS:
+                columns = ((records.months[i], records.types[i], records.categories[i], records.cents[i],
+                            records.days[i]) for i in self.rows_in_months(wanted))
+            else:
+                columns = zip(records.months, records.types, records.categories, records.cents, records.days)
+            for month, type_code, category_code, cents, day in columns:
+                if month in wanted:
+                    key = (month, type_code, category_code)
+                    groups[key] = groups.get(key, 0) + cents
+                    if type_code == expense_code:
+                        days = daily[month]
+                        days[day] = days.get(day, 0) + cents
+            for month in wanted:
+                self.periods[month] = {}
+                self.daily[month] = daily[month]
+            for (month, type_code, category_code), cents in groups.items():
+                key = (records.strings[type_code], records.strings[category_code] if category_code >= 0 else '其他')
+                cells = self.periods[month]
+                cells[key] = cells.get(key, 0) + cents
+        profiler.count("report_months_computed", len(wanted))
+
+    # 返回 {月份键: {(type, category): cents}}, 只计算缓存中没有的月份
+    def cells(self, months):
+        missing = [month for month in months if month not in self.periods]
+        if missing:
+            self.compute(missing)
+        return {month: self.periods[month] for month in months}
+
+    # 返回 months (按先后排列) 中按日期排序的 [(date.toordinal(), 当天支出 cents)], 没有支出的日期不出现
+    def daily_expenses(self, months):
+        self.cells(months)
+        points = []
+        for month in months:
+            points.extend(sorted(self.daily[month].items()))
+        return points
+
+    # rows 为 "category" 或 "type", columns 为 "month" 或 "year"; type_name 不为 None 时只统计该类型.
+    # 返回 (列标签列表, {行标签: {列标签: cents}})
+    def pivot(self, month_from, month_to, rows="category", columns="month", type_name=None):
+        labels = []
+        table = {}
+        for month, cells in self.cells(months_between(month_from, month_to)).items():
+            column = month_label(month) if columns == "month" else f"{month // 100:04d}"
+            if column not in labels:
+                labels.append(column)
+            for (cell_type, category), cents in cells.items():
+                if type_name is not None and cell_type != type_name:
+                    continue
+                row = table.setdefault(category if rows == "category" else cell_type, {})
+                row[column] = row.get(column, 0) + cents
+        return labels, table
+
+    # budgets 为预算列表 (单位: 元); 返回 [(月份, 分类, 预算 cents 或 None, 实际支出 cents)],
+    # 包含区间内设置了预算或有支出的每个 (月份, 分类)
+    def budget_vs_actual(self, budgets, month_from, month_to):
+        months = months_between(month_from, month_to)
+        in_range = set(months)
+        planned = {(month_key(b['month']), b['category']): to_cents(b['amount'])
+                   for b in budgets if month_key(b['month']) in in_range}
+        result = []
+        for month, cells in self.cells(months).items():
+            actual = {category: cents for (type_name, category), cents in cells.items() if type_name == "支出"}
+            for category in sorted(set(actual) | {c for m, c in planned if m == month}):
+                result.append((month_label(month), category, planned.get((month, category)), actual.get(category, 0)))
+        return result
+
+# Largest-Triangle-Three-Buckets 降采样: 保留首尾两点, 其余点均分为 threshold - 2 个桶,
+# 每个桶取与前一个选中点和下一个桶平均点组成三角形面积最大的点, 折线形状和峰值基本不变
+def lttb(points, threshold):
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    sampled = [points[0]]
+    size = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * size) + 1
+        end = int((bucket + 1) * size) + 1
+        next_end = min(int((bucket + 2) * size) + 1, len(points))
+        following = points[end:next_end] or points[-1:]
+        avg_x = sum(x for x, _ in following) / len(following)
+        avg_y = sum(y for _, y in following) / len(following)
+        ax, ay = points[a]
+        best, best_area = start, -1
+        for i in range(start, end):
+            x, y = points[i]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = i, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+BUDGET_HEADER = ["月份", "分类", "预算", "实际支出", "差额", "执行率"]
+
+# 预算 vs 实际的一行, 金额单位为分, planned 为 None 表示没有设置预算
+def budget_row(month, category, planned, actual):
+    if planned is None:
+        return [month, category, "", format_cents(actual), "", ""]
+    rate = f"{actual * 100 / planned:.1f}%" if planned > 0 else ""
+    return [month, category, format_cents(planned), format_cents(actual), format_cents(planned - actual), rate]
+
+# 透视表 {行名: {列名: cents}} 按行合计从大到小格式化, 返回 (行, 各列合计)
+def pivot_rows(table, labels):
+    rows = []
+    column_totals = [0] * len(labels)
+    for name in sorted(table, key=lambda name: -sum(table[name].values())):
+        values = [table[name].get(label, 0) for label in labels]
+        column_totals = [total + value for total, value in zip(column_totals, values)]
+        rows.append([name] + [format_cents(value) for value in values] + [format_cents(sum(values))])
+    return rows, column_totals
+
+def total_row(name, values):
+    return [name] + [format_cents(value) for value in values] + [format_cents(sum(values))]
+
+# 报表导出为 CSV, 带 BOM 以便 Excel 正确识别中文
+def write_report_csv(path, header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    atomic_write_bytes(path, buffer.getvalue().encode("utf-8-sig"))
+
+def list_pages(records, page_size):
+    for end in range(len(records), 0, -page_size):
+        start = max(0, end - page_size)
+        yield start, records[start:end]
+
+# 相邻两条记录之间的分隔: 前一条的 "}" 和后一条的 "{"
+RECORD_SEPARATOR = re.compile(rb"\}\s*,\s*\{")
+
+# 从 JSON 数组文件的末尾开始分页解析 (账本按时间追加, 末尾是最近的记录). 记录是扁平的字典,
+# 每条正好一个 "}", 所以 "}" 的个数是记录数的上限. 按平均长度估计每页的起点, 再找到其后第一个
+# 记录分隔处; 分隔处落在字符串里时这一页解析失败, 起点再向前移一页重试
+def json_array_pages(data, page_size):
+    first = data.find(b"{")
+    if first < 0:
+        if json.loads(data.decode("utf-8") or "[]"):
+            raise ValueError("记录文件不是 JSON 数组")
+        return 0, iter(())
+    if data[:first].strip() != b"[":
+        raise ValueError("记录文件不是 JSON 数组")
+    count = data.count(b"}")
+    last = data.rfind(b"}") + 1
+
+    def pages():
+        end = last
+        row = count
+        step = max(1, (last - first) // count) * page_size
+        while end > first:
+            guess = end
+            while True:
+                guess = max(first, guess - step)
+                match = RECORD_SEPARATOR.search(data, guess, end) if guess > first else None
+                start = match.end() - 1 if match else first
+                if start == first and guess > first:
+                    continue
+                try:
+                    records = json.loads(b"[" + data[start:end] + b"]")
+                    if all(isinstance(rec, dict) for rec in records):
+                        break
+                except ValueError:
+                    pass
+                if start == first:
+                    raise ValueError("记录文件格式错误")
+            row -= len(records)
+            yield row, records
+            end = data.rfind(b"}", first, start) + 1 if start > first else first
+
+    return count, pages()
+
+# 存储层基类: 分类和预算保存为 JSON 文件, 记录的持久化方式由子类决定
+class LedgerStorage:
+    # 为 True 时存储层可以用查询全量重算聚合结果 (供一致性检查对比), 并按组合条件查询记录编号
+    supports_queries = False
+    # 为 True 时提交快照不丢弃之前的改动, 保存时先处理快照之前的改动再写快照
+    keeps_ops_with_snapshot = False
+    # 加载时给没有编号的旧记录分配了编号, 下一次 save_records 要把编号写回
+    ids_assigned = False
+
+    # read_only 为 True 时只读取 (比如合并报表): 不加锁, 不创建或修改账本目录中的任何文件
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+        # 保存线程在其中写入和读取其他实例的改动; 界面线程只领取编号, 不等待这个锁
+        self.file_lock = nullcontext() if read_only else FileLock()
+        self.id_lock = FileLock(ID_COUNTER_PATH)
+        # 已领取、还没用完的编号 [下一个, 终点)
+        self.id_block = [0, 0]
+
+    def load_json(self, path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_json(self, path, data):
+        atomic_write_bytes(path, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    def load_categories(self):
+        return self.load_json("categories.json", None)
+
+    def save_categories(self, categories):
+        self.save_json("categories.json", categories)
+
+    def load_budgets(self):
+        return self.load_json("budgets.json", [])
+
+    def save_budgets(self, budgets):
+        self.save_json("budgets.json", budgets)
+
+    def load_records(self):
+        records = self.load_json("records.json", [])
+        self.ids_assigned = assign_record_ids(records)
+        return records
+
+    # 有可以直接映射的二进制快照时返回 RecordColumns, 否则为 None, 由调用方用 load_records 读取
+    def load_columns(self):
+        return None
+
+    # 分页读取记录: 返回 (记录数上限, 生成器), 生成器从最后一页开始依次给出 (起始行, 该页记录)
+    def load_record_pages(self, page_size):
+        records = self.load_records()
+        return len(records), list_pages(records, page_size)
+
+    def save_records(self, records):
+        pass
+
+    # 为 True 时 save_records 需要全部记录的快照
+    def needs_snapshot(self, record_count):
+        return False
+
+    # op 为 "add" / "edit" / "delete", record 为改动后的记录 (含编号), previous 为编辑或删除前的记录
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        pass
+
+    # 新记录的编号不能小于这个值 (没有读入内存的记录也算在内)
+    def next_record_id(self):
+        return 0
+
+    # 领取 count 个连续的新编号, 返回第一个. 编号计数保存在 ID_COUNTER_PATH 中, 每次领取至少 ID_BLOCK_SIZE 个,
+    # 同时打开账本的实例不会分到相同的编号; next_id 为本实例已知的编号上界
+    def reserve_ids(self, count, next_id):
+        if self.id_block[1] - self.id_block[0] < count:
+            size = max(count, ID_BLOCK_SIZE)
+            with self.id_lock:
+                start = max(next_id, self.id_lock.read_counter())
+                self.id_lock.write_counter(start + size)
+            self.id_block = [start, start + size]
+        start = self.id_block[0]
+        self.id_block[0] += count
+        return start
+
+    # 其他实例写入了账本时会变化的文件和目录, 供界面监视
+    def watched_paths(self):
+        return []
+
+    # 在保存线程中、持有 file_lock 时读取其他实例写入而本实例还没读到的内容, 不改变存储层的状态;
+    # 没有新内容时返回 None. 结果交给界面线程的 external_changes
+    def read_external(self):
+        return None
+
+    # 在界面线程中 (保存线程暂停期间) 把 read_external 读到的内容记为已读, 返回 [(op, 编号, 记录)],
+    # 删除时记录为 None; 无法只给出增量时返回重新读入的全部记录 (RecordColumns).
+    # records 为内存中的记录, 用于和重新读取的内容对比
+    def external_changes(self, data, records):
+        return []
+
+    # 只有分片存储会延迟读入记录: 返回日期范围 (YYYY-MM-DD, None 表示不限) 内还没读入的分片
+    def unloaded_shards(self, date_from=None, date_to=None):
+        return []
+
+    # 这些日期的记录所在的、还没读入的分片
+    def unloaded_shards_for(self, dates):
+        return []
+
+    # 可能包含这些编号的记录的、还没读入的分片
+    def unloaded_shards_for_ids(self, record_ids):
+        return []
+
+    # 还没读入的记录的聚合结果, 全部读入时为 None
+    def unloaded_aggregates(self):
+        return None
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def close(self):
+        pass
+
+# 分页读取前先取出最后一页: 文件中是没有编号的旧记录时返回 None, 调用方改为整体读入并按位置编号
+def numbered_pages(count, pages):
+    first = next(pages, None)
+    if first is None:
+        return count, iter(())
+    if any('id' not in rec for rec in first[1]):
+        return None
+    return count, chain([first], pages)
+
+# 每次保存整体重写 records.json (和二进制快照). 文件在本实例上次读写之后被其他实例改写过时,
+# 把本实例的改动按编号重放到对方的版本上再写入, 不覆盖对方的改动; 整个文件没有增量可读, 同步时整体重新加载
+class JsonStorage(LedgerStorage):
+    keeps_ops_with_snapshot = True
+
+    def __init__(self, read_only=False):
+        LedgerStorage.__init__(self, read_only)
+        # 本实例上次读入或写出的 records.json 的 file_stamp; 从没读过时为 False, 保存时直接覆盖 (比如生成测试数据)
+        self.stamp = False
+        # 上次保存之后的改动 [(op, 编号, 记录)], 只在保存线程中使用
+        self.changes = []
+        # 保存时合并过其他实例的改动, 内存中的记录需要重新加载
+        self.merged = False
+
+    # 读入 records.json 之前记下它的状态
+    def read_stamp(self):
+        self.stamp = file_stamp("records.json")
+        self.merged = False
+
+    def load_records(self):
+        self.read_stamp()
+        return LedgerStorage.load_records(self)
+
+    def load_columns(self):
+        self.read_stamp()
+        snapshot = open_binary_snapshot("records.json")
+        return snapshot[0] if snapshot else None
+
+    def load_record_pages(self, page_size):
+        self.read_stamp()
+        if self.stamp is None:
+            return 0, iter(())
+        with open("records.json", "rb") as f:
+            pages = numbered_pages(*json_array_pages(f.read(), page_size))
+        return pages or LedgerStorage.load_record_pages(self, page_size)
+
+    def save_records(self, records):
+        if self.stamp is not False and file_stamp("records.json") != self.stamp:
+            theirs = RecordColumns.from_records(LedgerStorage.load_records(self))
+            for op, record_id, record in self.changes:
+                apply_change(theirs, op, record_id, record)
+            theirs.next_id = max(theirs.next_id, records.next_id)
+            records = theirs
+            self.merged = True
+        data = json.dumps(list(records), ensure_ascii=False, indent=2).encode("utf-8")
+        atomic_write_bytes("records.json", data)
+        self.stamp = file_stamp("records.json")
+        write_binary_snapshot(records, "records.json", zlib.crc32(data))
+        self.changes = []
+        self.ids_assigned = False
+
+    def needs_snapshot(self, record_count):
+        return True
+
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        self.changes.append((op, record_id, record))
+
+    def watched_paths(self):
+        return ["."]
+
+    # 整个文件没有增量可读: 被改写过 (或保存时合并过) 就重新读入全部记录
+    def read_external(self):
+        stamp = file_stamp("records.json")
+        if not self.merged and stamp == self.stamp:
+            return None
+        columns = open_binary_snapshot("records.json")
+        records = columns[0] if columns else RecordColumns.from_records(LedgerStorage.load_records(self))
+        return stamp, records
+
+    def external_changes(self, data, records):
+        self.stamp, records = data
+        self.merged = False
+        return records
+
+# 改动追加到 records.journal, 日志过长时才重写 records.json
+class JournalStorage(LedgerStorage):
+    # 其他实例追加了还没读到的条目时不能压缩, 快照之前的改动仍要追加到日志
+    keeps_ops_with_snapshot = True
+
+    def __init__(self, read_only=False):
+        LedgerStorage.__init__(self, read_only)
+        self.journal = RecordJournal(read_only=read_only)
+        # batch() 期间暂存的日志条目
+        self.pending = None
+
+    @property
+    def ids_assigned(self):
+        return self.journal.ids_assigned
+
+    def load_records(self):
+        return self.journal.load()
+
+    def load_columns(self):
+        return self.map_journal(self.journal)
+
+    # 快照用二进制快照, 日志在映射的列上重放 (有改动的列会被复制出来); 不能映射时返回 None
+    @staticmethod
+    def map_journal(journal):
+        if journal.has_index_entries():
+            return None
+        snapshot = open_binary_snapshot(journal.snapshot_path)
+        if snapshot is None:
+            return None
+        records, journal.snapshot_crc = snapshot
+        journal.entry_count = journal.replay(records)
+        return records
+
+    # 日志中有改动时需要先在完整的列表上重放, 只有快照时才能从文件末尾分页读取
+    def load_record_pages(self, page_size):
+        if self.journal.has_entries():
+            return LedgerStorage.load_record_pages(self, page_size)
+        data = b""
+        if os.path.exists(self.journal.snapshot_path):
+            with open(self.journal.snapshot_path, "rb") as f:
+                data = f.read()
+        pages = numbered_pages(*json_array_pages(data, page_size))
+        if pages is None:
+            return LedgerStorage.load_record_pages(self, page_size)
+        self.journal.snapshot_crc = zlib.crc32(data)
+        self.journal.entry_count = self.journal.replay([])
+        return pages
+
+    # 其他实例追加了本实例还没读到的条目时不压缩 (快照里没有那些改动), 同步之后的下一次保存再压缩
+    def save_records(self, records):
+        if self.needs_snapshot(len(records)) and self.journal.is_current():
+            # batch() 中暂存的是快照之前的改动, 已包含在快照中
+            if self.pending:
+                self.pending = []
+            self.journal.compact(list(records))
+            write_binary_snapshot(records, self.journal.snapshot_path, self.journal.snapshot_crc)
+
+    def needs_snapshot(self, record_count):
+        return self.journal.ids_assigned or self.journal.needs_compaction(record_count)
+
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        if self.pending is not None:
+            self.pending.append(self.journal.entry(op, record_id, record))
+        else:
+            self.journal.append(op, record_id, record)
+
+    def watched_paths(self):
+        return [".", self.journal.journal_path]
+
+    # 日志被其他实例压缩过, 或有旧版本没有编号的条目时用新的 RecordJournal 整体重新读入
+    def read_external(self):
+        read = self.journal.read_new_entries()
+        if read is not None and all('id' in entry for entry in read[0]):
+            entries, offset = read
+            return ("entries", entries, offset) if entries or offset != self.journal.size else None
+        journal = RecordJournal(self.journal.snapshot_path, self.journal.journal_path)
+        records = self.map_journal(journal)
+        if records is None:
+            records = RecordColumns.from_records(journal.load())
+        return "reload", journal, records
+
+    def external_changes(self, data, records):
+        if data[0] == "reload":
+            self.journal = data[1]
+            return data[2]
+        entries, offset = data[1:]
+        self.journal.mark_read(offset, len(entries))
+        return [(entry["op"], entry["id"], entry.get("record")) for entry in entries]
+
+    @contextmanager
+    def batch(self):
+        if self.pending is not None:
+            yield
+            return
+        self.pending = []
+        try:
+            yield
+            if self.pending:
+                self.journal.append_entries(self.pending)
+        finally:
+            self.pending = None
+
+# SQLite 存储: 记录按 date / (type, month, category) / category 建索引, 不含关键字的组合查询在数据库中进行,
+# 按月汇总和合并报表的筛选走 (type, month, category) 索引; 预算以 (month, category) 为主键.
+# 每次改动在 changes 表中留下 (序号, 记录编号, 写入的实例), 其他实例据此只读取改过的记录
+class SqliteStorage(LedgerStorage):
+    supports_queries = True
+    # changes 表保留的条数; 落后更多的实例整体重新加载
+    CHANGE_LOG_SIZE = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            month TEXT,
+            description TEXT NOT NULL DEFAULT '',
+            amount REAL NOT NULL DEFAULT 0,
+            type TEXT NOT NULL,
+            category TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_records_date ON records (date);
+        CREATE INDEX IF NOT EXISTS idx_records_type_month ON records (type, month, category);
+        CREATE INDEX IF NOT EXISTS idx_records_category ON records (category);
+        CREATE TABLE IF NOT EXISTS budgets (
+            month TEXT NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (month, category)
+        );
+        CREATE TABLE IF NOT EXISTS categories (
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (type, name)
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id INTEGER NOT NULL,
+            origin TEXT NOT NULL
+        );
+    """
+    RECORD_COLUMNS = "id, date, description, amount, type, category"
+    # 记录编号就是 id 列, 由 RecordColumns 分配
+    INSERT_RECORD = "INSERT INTO records (date, month, description, amount, type, category, id) " \
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path=SQLITE_PATH, read_only=False):
+        LedgerStorage.__init__(self, read_only)
+        self.path = path
+        self.batch_depth = 0
+        if read_only:
+            # 只读连接: 文件不存在时打开失败, 不建表也不迁移
+            from urllib.request import pathname2url
+            uri = "file:" + pathname2url(os.path.abspath(path)) + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            # 加载在主线程, 之后的写入都在后台保存线程中进行, 同一时间只有一个线程使用连接
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.conn:
+                self.conn.executescript(self.SCHEMA)
+                if self.get_meta("schema_version") is None:
+                    self.migrate_json()
+                    self.set_meta("schema_version", "1")
+            # 本实例写入的改动带上 origin, 读取增量时跳过; seen 为已读到的最大序号 (在读入记录之前取得,
+            # 之间其他实例的改动会再应用一次, 结果相同)
+            self.origin = os.urandom(8).hex()
+            self.seen = self.last_change()
+
+    def last_change(self):
+        return self.conn.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # 首次启动时导入 records.json (含未压缩的日志) / budgets.json / categories.json
+    def migrate_json(self):
+        records = JournalStorage().load_records() if os.path.exists("records.journal") \
+            else LedgerStorage.load_records(self)
+        self.conn.executemany(self.INSERT_RECORD, [self.record_params(rec) + (rec['id'],) for rec in records])
+        self.write_budgets(LedgerStorage.load_budgets(self))
+        categories = LedgerStorage.load_categories(self)
+        if categories:
+            self.write_categories(categories)
+        if records:
+            print(f"已从 JSON 文件迁移 {len(records)} 条记录到 {SQLITE_PATH}")
+
+    @staticmethod
+    def record_params(rec):
+        return (rec['date'], record_month(rec['date']), rec.get('description', ''), rec['amount'],
+                rec['type'], rec.get('category'))
+
+    @staticmethod
+    def row_to_record(row):
+        record = {'id': row[0], 'date': row[1], 'description': row[2], 'amount': row[3], 'type': row[4]}
+        if row[5] is not None:
+            record['category'] = row[5]
+        return record
+
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield
+        except Exception:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.conn.rollback()
+            raise
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.conn.commit()
+
+    def commit(self):
+        if self.batch_depth == 0:
+            self.conn.commit()
+
+    def load_categories(self):
+        categories = {}
+        for type_name, name in self.conn.execute(
+                "SELECT type, name FROM categories ORDER BY type, position"):
+            categories.setdefault(type_name, []).append(name)
+        return categories or None
+
+    def write_categories(self, categories):
+        self.conn.execute("DELETE FROM categories")
+        self.conn.executemany(
+            "INSERT INTO categories (type, name, position) VALUES (?, ?, ?)",
+            [(type_name, name, i) for type_name, names in categories.items()
+             for i, name in enumerate(names)])
+
+    def save_categories(self, categories):
+        self.write_categories(categories)
+        self.commit()
+
+    def load_budgets(self):
+        return [{'month': month, 'category': category, 'amount': amount}
+                for month, category, amount in self.conn.execute(
+                    "SELECT month, category, amount FROM budgets ORDER BY month, category")]
+
+    def write_budgets(self, budgets):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO budgets (month, category, amount) VALUES (?, ?, ?)",
+            [(b['month'], b['category'], b['amount']) for b in budgets])
+
+    def save_budgets(self, budgets):
+        self.write_budgets(budgets)
+        self.commit()
+
+    def load_records(self):
+        rows = self.conn.execute(f"SELECT {self.RECORD_COLUMNS} FROM records ORDER BY id").fetchall()
+        return [self.row_to_record(row) for row in rows]
+
+    # 在后台加载线程中用单独的连接按 id 从大到小分页读取
+    def load_record_pages(self, page_size):
+        count = self.conn.execute("SELECT count(*) FROM records").fetchone()[0]
+
+        def pages():
+            conn = sqlite3.connect(self.path)
+            try:
+                end = count
+                last_id = None
+                while end > 0:
+                    if last_id is None:
+                        rows = conn.execute(f"SELECT {self.RECORD_COLUMNS} FROM records "
+                                            "ORDER BY id DESC LIMIT ?", (page_size,)).fetchall()
+                    else:
+                        rows = conn.execute(f"SELECT {self.RECORD_COLUMNS} FROM records WHERE id < ? "
+                                            "ORDER BY id DESC LIMIT ?", (last_id, page_size)).fetchall()
+                    if not rows:
+                        break
+                    rows.reverse()
+                    last_id = rows[0][0]
+                    start = end - len(rows)
+                    yield start, [self.row_to_record(row) for row in rows]
+                    end = start
+            finally:
+                conn.close()
+
+        return count, pages()
+
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        if op == "add":
+            self.conn.execute(self.INSERT_RECORD, self.record_params(record) + (record_id,))
+        elif op == "edit":
+            self.conn.execute(
+                "UPDATE records SET date = ?, month = ?, description = ?, amount = ?, type = ?, category = ? WHERE id = ?",
+                self.record_params(record) + (record_id,))
+        elif op == "delete":
+            self.conn.execute("DELETE FROM records WHERE id = ?", (record_id,))
+        else:
+            return
+        seq = self.conn.execute("INSERT INTO changes (record_id, origin) VALUES (?, ?)",
+                                (record_id, self.origin)).lastrowid
+        if seq % 1000 == 0:
+            self.conn.execute("DELETE FROM changes WHERE seq <= ?", (seq - self.CHANGE_LOG_SIZE,))
+        self.commit()
+
+    def watched_paths(self):
+        return [self.path]
+
+    # 按 changes 表中其他实例改过的记录编号读出这些记录的当前内容 (已删除的为 None);
+    # 落后太多 (changes 表已被清理) 时读出全部记录
+    def read_external(self):
+        last = self.last_change()
+        if last == self.seen:
+            return None
+        first = self.conn.execute("SELECT min(seq) FROM changes").fetchone()[0]
+        if first is not None and first > self.seen + 1:
+            return last, RecordColumns.from_records(self.load_records())
+        record_ids = list(dict.fromkeys(record_id for record_id, in self.conn.execute(
+            "SELECT record_id FROM changes WHERE seq > ? AND seq <= ? AND origin != ? ORDER BY seq",
+            (self.seen, last, self.origin))))
+        if not record_ids:
+            # 只有本实例自己的改动
+            self.seen = last
+            return None
+        current = {}
+        for start in range(0, len(record_ids), 500):
+            chunk = record_ids[start:start + 500]
+            for row in self.conn.execute(f"SELECT {self.RECORD_COLUMNS} FROM records WHERE id IN "
+                                         f"({', '.join('?' * len(chunk))})", chunk):
+                current[row[0]] = self.row_to_record(row)
+        return last, [(record_id, current.get(record_id)) for record_id in record_ids]
+
+    # 与内存对比得出改动
+    def external_changes(self, data, records):
+        self.seen, current = data
+        if isinstance(current, RecordColumns):
+            return current
+        changes = []
+        for record_id, rec in current:
+            row = records.row_of(record_id)
+            if rec is None:
+                if row >= 0:
+                    changes.append(("delete", record_id, None))
+            elif row < 0:
+                changes.append(("add", record_id, rec))
+            elif records[row] != rec:
+                changes.append(("edit", record_id, rec))
+        return changes
+
+    # 用 SQL 全量重算聚合结果, 供一致性检查与内存中的缓存对比
+    # 满足 query 的记录编号 (按编号排序, 与 QueryEngine 的结果顺序相同). 日期范围走 idx_records_date,
+    # 分类走 idx_records_category, 类型走 idx_records_type_month, 由 SQLite 按选择性挑选; 不支持关键字
+    # (LIKE 用不上索引, 关键字由内存中的 n-gram 索引查询)
+    def query_ids(self, query):
+        where = []
+        params = []
+        if query.date_from:
+            where.append("date >= ?")
+            params.append(query.date_from)
+        if query.date_to:
+            where.append("date <= ?")
+            params.append(query.date_to)
+        for column, values in (("type", query.types), ("category", query.categories)):
+            if values:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(sorted(values))
+        if query.amount_min is not None:
+            where.append("CAST(round(amount * 100) AS INTEGER) >= ?")
+            params.append(to_cents(query.amount_min))
+        if query.amount_max is not None:
+            where.append("CAST(round(amount * 100) AS INTEGER) <= ?")
+            params.append(to_cents(query.amount_max))
+        sql = "SELECT id FROM records" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY id"
+        return [row[0] for row in self.conn.execute(sql, params)]
+
+    def compute_aggregates(self):
+        aggregates = AggregateCache()
+        cents = "sum(CAST(round(amount * 100) AS INTEGER))"
+        aggregates.totals = dict(self.conn.execute(
+            f"SELECT type, {cents} FROM records GROUP BY type").fetchall())
+        for month, category, amount in self.conn.execute(
+                f"SELECT month, coalesce(category, '其他'), {cents} FROM records "
+                "WHERE type = '支出' AND month IS NOT NULL GROUP BY month, coalesce(category, '其他')"):
+            aggregates.monthly.setdefault(month_key(month), {})[category] = amount
+        return aggregates
+
+    def close(self):
+        self.conn.close()
+
+def shard_name(month):
+    if month < 0:
+        return "undated"
+    if SHARD_PERIOD == "year":
+        return f"{month // 100:04d}"
+    return f"{month // 100:04d}-{month % 100:02d}"
+
+def shard_of(date_text):
+    month = record_month(date_text)
+    return shard_name(month_key(month) if month else -1)
+
+# 分片存储: SHARD_DIR 中每个周期一个 JSON 文件, manifest.json 记录各分片的记录数、文件大小和修改时间
+# 以及聚合结果. 启动时只读入当前周期 (和没有日期的记录), 其余分片的统计直接取清单中的聚合结果,
+# 查询或改动需要时才读入. 保存时只重写有改动的分片
+class ShardedStorage(LedgerStorage):
+    keeps_ops_with_snapshot = True
+
+    def __init__(self, directory=SHARD_DIR, read_only=False):
+        LedgerStorage.__init__(self, read_only)
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        # 分片名 -> {'count', 'size', 'mtime', 'aggregates'}
+        self.manifest = {}
+        # 所有分片中记录编号的上界
+        self.next_id = 0
+        # 已读入内存的分片, 只在界面线程中使用
+        self.loaded = set()
+        # 读入时发现记录没有编号的分片, 保存线程收到 "load_shard" 后把它们标记为需要重写
+        self.unnumbered = set()
+        # 有改动还没写入的分片, 以及上次保存之后的改动, 只在保存线程中使用
+        self.dirty = set()
+        self.changes = []
+        # 保存时合并过其他实例改动的分片, 同步时要重新读入
+        self.merged = set()
+        with self.file_lock:
+            if os.path.exists(self.manifest_path):
+                manifest = self.load_json(self.manifest_path, {})
+                self.manifest = manifest.get('shards', {})
+                self.next_id = manifest.get('next_id', 0)
+            elif not read_only:
+                os.makedirs(directory, exist_ok=True)
+                self.migrate_json()
+            self.loaded = self.eager_shards()
+
+    def shard_path(self, name):
+        return os.path.join(self.directory, name + ".json")
+
+    def shard_names(self):
+        return {name[:-5] for name in os.listdir(self.directory)
+                if name.endswith(".json") and name != "manifest.json"}
+
+    # 清单项记录的分片文件 file_stamp, 没有清单项时为 None
+    def shard_stamp(self, name):
+        entry = self.manifest.get(name)
+        return (entry['size'], entry['mtime']) if entry else None
+
+    # 启动时读入的分片: 当前周期、没有日期的记录, 以及文件与清单不一致 (比如写清单前崩溃) 的分片
+    def eager_shards(self):
+        eager = {shard_name(month_key(datetime.now().strftime("%Y-%m"))), "undated"}
+        on_disk = self.shard_names()
+        for name in list(self.manifest):
+            if name not in on_disk:
+                del self.manifest[name]
+        for name in on_disk:
+            if self.shard_stamp(name) != file_stamp(self.shard_path(name)):
+                eager.add(name)
+        return {name for name in eager if name in on_disk}
+
+    # 旧文件分页读入预留的行 (从最后一页开始), 不同时保留全部记录字典; 没有编号的旧记录按所在行编号
+    def migrate_json(self):
+        if os.path.exists("records.journal"):
+            count, pages = JournalStorage().load_record_pages(LOAD_PAGE_SIZE)
+        elif os.path.exists("records.json"):
+            with open("records.json", "rb") as f:
+                count, pages = json_array_pages(f.read(), LOAD_PAGE_SIZE)
+        else:
+            count, pages = 0, iter(())
+        columns = RecordColumns()
+        columns.reserve(count)
+        first_row = count
+        for start, page in pages:
+            for i, rec in enumerate(page, start):
+                rec.setdefault('id', i)
+            columns.fill(start, page)
+            first_row = start
+        columns.drop_front(first_row)
+        if not len(columns):
+            self.save_manifest()
+            return
+        self.dirty = {shard_name(month) for month in set(columns.months)}
+        self.save_records(columns)
+        print(f"已从 JSON 文件迁移 {len(columns)} 条记录到 {self.directory}/")
+
+    # names 为本实例刚写过的分片时, 其余分片的清单项以磁盘上的清单为准 (可能是其他实例刚写的),
+    # 不用本实例过时的清单项覆盖; 本实例的清单在同步时才更新
+    def save_manifest(self, names=None):
+        shards, next_id = self.manifest, self.next_id
+        if names is not None and os.path.exists(self.manifest_path):
+            manifest = self.load_json(self.manifest_path, {})
+            shards = manifest.get('shards', {})
+            for name in names:
+                if name in self.manifest:
+                    shards[name] = self.manifest[name]
+                else:
+                    shards.pop(name, None)
+            next_id = max(next_id, manifest.get('next_id', 0))
+        self.save_json(self.manifest_path, {'version': 1, 'period': SHARD_PERIOD, 'next_id': next_id,
+                                            'shards': shards})
+
+    # 旧版本写入的分片没有记录编号, 由 RecordColumns 分配后需要重写该分片
+    def read_shard(self, name):
+        records = self.load_json(self.shard_path(name), [])
+        if any('id' not in rec for rec in records):
+            self.unnumbered.add(name)
+            self.ids_assigned = True
+        return records
+
+    def next_record_id(self):
+        return self.next_id
+
+    def load_records(self):
+        records = []
+        stale = False
+        for name in sorted(self.loaded):
+            shard = self.read_shard(name)
+            records.extend(shard)
+            stat = os.stat(self.shard_path(name))
+            entry = self.manifest.get(name)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                self.manifest[name] = self.shard_entry(name, RecordColumns.from_records(shard), None)
+                stale = True
+        if stale:
+            self.save_manifest()
+        # 保存线程此时还没有改动要处理, 直接把没有编号的分片标记为需要重写
+        self.dirty |= self.unnumbered
+        self.unnumbered.clear()
+        return records
+
+    # 分片的清单项 (含编号范围, 按编号查找记录时用来排除分片); rows 为 records 中属于该分片的行, None 表示全部
+    def shard_entry(self, name, records, rows):
+        aggregates = AggregateCache()
+        aggregates.rebuild(records, rows)
+        ids = records.ids if rows is None else [records.ids[i] for i in rows]
+        stat = os.stat(self.shard_path(name))
+        return {'count': len(ids), 'ids': [min(ids), max(ids)] if len(ids) else None, 'size': stat.st_size,
+                'mtime': stat.st_mtime_ns, 'aggregates': aggregates.to_json()}
+
+    def unloaded_shards(self, date_from=None, date_to=None):
+        names = [name for name in self.manifest if name not in self.loaded]
+        if date_from is None and date_to is None:
+            return sorted(names)
+        low = month_key(date_from[:7]) if date_from else 0
+        high = month_key(date_to[:7]) if date_to else 999999
+        needed = []
+        for name in names:
+            if name == "undated":
+                continue
+            if SHARD_PERIOD == "year":
+                first, last = int(name) * 100 + 1, int(name) * 100 + 12
+            else:
+                first = last = month_key(name)
+            if first <= high and last >= low:
+                needed.append(name)
+        return sorted(needed)
+
+    # 还没有文件的分片记为已读入: 新记录先写在内存中, 保存后也不能再当作没读入的分片重复读取
+    def unloaded_shards_for(self, dates):
+        names = {shard_of(text) for text in dates}
+        self.loaded |= names - set(self.manifest)
+        return sorted(names & set(self.manifest) - self.loaded)
+
+    # 编号范围覆盖其中某个编号的分片; 旧版本的清单项没有编号范围, 都要读入查找
+    def unloaded_shards_for_ids(self, record_ids):
+        names = []
+        for name, entry in self.manifest.items():
+            bounds = entry.get('ids', False)
+            if name in self.loaded or bounds is None:
+                continue
+            if bounds is False or any(bounds[0] <= record_id <= bounds[1] for record_id in record_ids):
+                names.append(name)
+        return sorted(names)
+
+    def unloaded_aggregates(self):
+        aggregates = AggregateCache()
+        for name, entry in self.manifest.items():
+            if name not in self.loaded:
+                aggregates.merge(AggregateCache.from_json(entry['aggregates']))
+        return aggregates
+
+    def shard_aggregates(self, name):
+        return AggregateCache.from_json(self.manifest[name]['aggregates'])
+
+    # 界面线程读入分片后, 调用方还要提交 ("load_shard", None, 分片名), 没有编号的分片会在保存时重写
+    def load_shard(self, name):
+        records = self.read_shard(name)
+        self.loaded.add(name)
+        return records
+
+    def needs_snapshot(self, record_count):
+        return True
+
+    # 改动前后的记录所在的分片都要重写
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        if op == "load_shard":
+            if record in self.unnumbered:
+                self.unnumbered.discard(record)
+                self.dirty.add(record)
+            return
+        if previous is not None:
+            self.dirty.add(shard_of(previous['date']))
+        if record is not None:
+            self.dirty.add(shard_of(record['date']))
+        self.changes.append((op, record_id, record, previous))
+
+    # 快照中包含所有已读入的分片, 有改动的分片一定已经读入, 所以可以直接从快照中取出整个分片重写.
+    # 分片文件与清单项不一致说明其他实例在本实例上次读写之后改写过它, 这时改为合并 (见 merge_shard)
+    def save_records(self, records):
+        self.ids_assigned = False
+        changes, self.changes = self.changes, []
+        if not self.dirty:
+            return
+        self.next_id = max(self.next_id, records.next_id)
+        rows = {name: [] for name in self.dirty}
+        names = {}
+        for i, month in enumerate(records.months):
+            name = names.get(month)
+            if name is None:
+                name = names[month] = shard_name(month)
+            if name in rows:
+                rows[name].append(i)
+        for name, shard_rows in rows.items():
+            path = self.shard_path(name)
+            shard = records
+            if file_stamp(path) != self.shard_stamp(name):
+                shard = self.merge_shard(name, changes)
+                shard_rows = range(len(shard))
+                self.merged.add(name)
+            if shard_rows:
+                self.save_json(path, [shard[i] for i in shard_rows])
+                self.manifest[name] = self.shard_entry(name, shard, shard_rows)
+            else:
+                if os.path.exists(path):
+                    os.remove(path)
+                self.manifest.pop(name, None)
+        self.save_manifest(rows)
+        self.dirty.clear()
+
+    # 读出其他实例写过的分片, 按编号重放本实例的改动中落在这个分片里的部分: 移入的记录追加,
+    # 移出的删除, 对方已经删除的记录不再恢复
+    def merge_shard(self, name, changes):
+        shard = RecordColumns.from_records(self.load_json(self.shard_path(name), []))
+        for op, record_id, record, previous in changes:
+            inside = record is not None and shard_of(record['date']) == name
+            was_inside = previous is not None and shard_of(previous['date']) == name
+            if inside:
+                apply_change(shard, "edit" if was_inside else "add", record_id, record)
+            elif was_inside:
+                apply_change(shard, "delete", record_id, None)
+        return shard
+
+    def watched_paths(self):
+        return [self.directory]
+
+    # 文件与清单项不一致的分片都是其他实例写过的: 已读入的 (以及其他实例新建的当前周期分片) 重新读取内容,
+    # 没读入的只取得新的清单项. 返回 (清单中的编号上界, {分片名: (清单项, 内容或 None)}), 文件已删除的分片为 None
+    def read_external(self):
+        known, loaded = dict(self.manifest), set(self.loaded)
+        changed = self.merged | {name for name in self.shard_names() | set(known)
+                                 if file_stamp(self.shard_path(name)) != self.shard_stamp(name)}
+        if not changed:
+            return None
+        manifest = self.load_json(self.manifest_path, {})
+        eager = {shard_name(month_key(datetime.now().strftime("%Y-%m"))), "undated"}
+        shards = {}
+        for name in changed:
+            path = self.shard_path(name)
+            if not os.path.exists(path):
+                shards[name] = None
+                continue
+            entry = manifest.get('shards', {}).get(name)
+            content = None
+            if name in loaded or (name in eager and name not in known):
+                content = self.load_json(path, [])
+                entry = self.shard_entry(name, RecordColumns.from_records(content), None)
+            elif entry is None or (entry['size'], entry['mtime']) != file_stamp(path):
+                entry = self.shard_entry(name, RecordColumns.from_records(self.load_json(path, [])), None)
+            shards[name] = (entry, content)
+        return manifest.get('next_id', 0), shards
+
+    # 更新清单项 (调用方据此替换没读入的分片的聚合结果), 重新读取的分片按编号与内存中的记录对比得出改动.
+    # 读取之后界面线程才读入的分片保留旧的清单项, 下次同步时再对比
+    def external_changes(self, data, records):
+        next_id, shards = data
+        self.next_id = max(self.next_id, next_id)
+        self.merged = set()
+        loaded = set()
+        theirs = {}
+        for name, shard in shards.items():
+            if shard is None:
+                if name in self.loaded:
+                    loaded.add(name)
+                self.manifest.pop(name, None)
+                continue
+            entry, content = shard
+            if content is not None:
+                self.loaded.add(name)
+                loaded.add(name)
+                theirs.update((rec['id'], rec) for rec in content if 'id' in rec)
+            elif name in self.loaded:
+                continue
+            self.manifest[name] = entry
+        if not loaded:
+            return []
+
+        mine = set()
+        names = {}
+        for i, month in enumerate(records.months):
+            name = names.get(month)
+            if name is None:
+                name = names[month] = shard_name(month)
+            if name in loaded:
+                mine.add(records.ids[i])
+        changes = []
+        for record_id, rec in theirs.items():
+            row = records.row_of(record_id)
+            if row < 0:
+                changes.append(("add", record_id, rec))
+            elif records[row] != rec:
+                changes.append(("edit", record_id, rec))
+        changes += [("delete", record_id, None) for record_id in mine - theirs.keys()]
+        return changes
+
+# 后台保存线程: 收集记录改动、记录快照和分类/预算数据, 在 SAVE_DELAY 秒内没有新改动后合并为一次写入
+class PersistenceWorker:
+    def __init__(self, storage, on_status=None, delay=SAVE_DELAY):
+        self.storage = storage
+        self.on_status = on_status
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.ops = []
+        self.snapshot = None
+        # 快照提交时 ops 的长度: 在它之前的改动已包含在快照中
+        self.snapshot_at = 0
+        self.budgets = None
+        self.categories = None
+        # 读取其他实例改动的请求: 读完后调用的 on_pulled(data), 见 Ledger.request_pull
+        self.pull = None
+        # 读到的改动交给调用方之后暂停写入, 直到调用方应用完并 resume
+        self.paused = False
+        self.last_change = 0
+        self.writing = False
+        self.stopping = False
+        self.last_saved = None
+        self.thread = threading.Thread(target=self.run, name="ledger-writer", daemon=True)
+        self.thread.start()
+
+    def has_pending(self):
+        return bool(self.ops) or self.snapshot is not None or \
+            self.budgets is not None or self.categories is not None or self.pull is not None
+
+    def submit(self, **changes):
+        with self.condition:
+            if "snapshot" in changes:
+                # 快照已包含之前的所有改动; 分片存储还需要这些改动来判断哪些分片要重写,
+                # JSON 和日志后端在与其他实例的改动合并或不能压缩时也要用到
+                if not self.storage.keeps_ops_with_snapshot:
+                    self.ops = []
+                self.snapshot_at = len(self.ops)
+            self.ops.extend(changes.pop("ops", ()))
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.last_change = time.monotonic()
+            self.condition.notify_all()
+        self.report("pending")
+
+    def record_changed(self, op, record_id=None, record=None, previous=None):
+        self.submit(ops=[(op, record_id, record, previous)])
+
+    def report(self, status, detail=None):
+        if self.on_status:
+            self.on_status(status, detail)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.has_pending() and not self.stopping:
+                    self.condition.wait()
+                # 防抖: 直到连续 delay 秒没有新改动 (或正在退出、要读取其他实例的改动) 才写入
+                while not self.stopping and self.pull is None:
+                    remaining = self.last_change + self.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.has_pending():
+                    return
+                ops, snapshot, budgets, categories = self.ops, self.snapshot, self.budgets, self.categories
+                snapshot_at, pull = self.snapshot_at, self.pull
+                self.ops, self.snapshot, self.budgets, self.categories, self.pull = [], None, None, None, None
+                self.snapshot_at = 0
+                self.writing = True
+            if ops or snapshot is not None or budgets is not None or categories is not None:
+                self.write(ops, snapshot, snapshot_at, budgets, categories)
+            if pull is not None:
+                self.read_changes(pull)
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+                while self.paused and not self.stopping:
+                    self.condition.wait()
+
+    def write(self, ops, snapshot, snapshot_at, budgets, categories):
+        self.report("saving")
+        touched = len(ops) + (len(snapshot) if snapshot is not None else 0)
+        try:
+            # 写入期间持有跨进程写锁, 其他实例的写入和读取改动都要等这次写完
+            with profiler.span("save", records=touched):
+                with self.storage.file_lock, self.storage.batch():
+                    for op in ops[:snapshot_at]:
+                        self.storage.record_changed(*op)
+                    if snapshot is not None:
+                        self.storage.save_records(snapshot)
+                    for op in ops[snapshot_at:]:
+                        self.storage.record_changed(*op)
+                    if budgets is not None:
+                        self.storage.save_budgets(budgets)
+                    if categories is not None:
+                        self.storage.save_categories(categories)
+            profiler.count("records_saved", touched)
+            self.last_saved = datetime.now()
+            self.report("saved", self.last_saved)
+        except Exception as e:
+            print(f"保存数据失败: {e}")
+            self.report("error", e)
+
+    # 在写锁内读取其他实例的改动交给 on_pulled; 读到内容时先暂停, 调用方应用之前写入的快照不会覆盖这些改动
+    def read_changes(self, on_pulled):
+        data = None
+        try:
+            with profiler.span("pull"), self.storage.file_lock:
+                data = self.storage.read_external()
+        except Exception as e:
+            print(f"读取其他实例的改动失败: {e}")
+        with self.condition:
+            self.paused = data is not None
+        try:
+            on_pulled(data)
+        except Exception as e:
+            print(f"读取其他实例的改动失败: {e}")
+            self.resume()
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    # 已提交、还没写入的记录改动 [(op, 编号, 记录, 改动前的记录)]
+    def pending_ops(self):
+        with self.condition:
+            return [op for op in self.ops if op[0] in ("add", "edit", "delete")]
+
+    # 立即写入所有待保存的改动并等待完成; 暂停期间 (等待调用方应用读到的改动) 不等待, 以免调用方自己等自己
+    def flush(self):
+        with self.condition:
+            self.last_change = 0
+            self.condition.notify_all()
+            while (self.has_pending() or self.writing) and not self.paused:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+
+# 分页加载记录: 在后台线程中从存储末尾 (最近追加的记录) 开始逐页读取, 写入 records 中预先分配的行.
+# 每页算好自己的聚合结果, 通过 on_page(start, end, aggregates) 交给调用方; 结束后调用 on_finished(error)
+class RecordLoader:
+    def __init__(self, storage, records, page_size=LOAD_PAGE_SIZE, on_page=None, on_finished=None):
+        self.storage = storage
+        self.records = records
+        self.page_size = page_size
+        self.on_page = on_page
+        self.on_finished = on_finished
+        # 已加载部分的第一行; 已加载的行总是 [first_row, len(records)) 这一段
+        self.first_row = 0
+        self.thread = threading.Thread(target=self.run, name="ledger-load", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        error = None
+        try:
+            with profiler.span("load"), self.storage.file_lock:
+                columns = self.storage.load_columns()
+                if columns is not None:
+                    # 二进制快照不需要分页解析, 映射之后作为一整页交给调用方
+                    self.records.adopt(columns)
+                    self.page_loaded(0, len(self.records))
+                else:
+                    count, pages = self.storage.load_record_pages(self.page_size)
+                    self.records.reserve(count)
+                    self.first_row = len(self.records)
+                    for start, page in pages:
+                        self.records.fill(start, page)
+                        self.page_loaded(start, start + len(page))
+        except Exception as e:
+            print(f"加载记录失败: {e}")
+            error = e
+        if self.on_finished:
+            self.on_finished(error)
+
+    def page_loaded(self, start, end):
+        aggregates = AggregateCache()
+        aggregates.rebuild(self.records, range(start, end))
+        self.first_row = start
+        profiler.count("records_loaded", end - start)
+        if self.on_page:
+            self.on_page(start, end, aggregates)
+
+# 判断账单文件编码: 国内银行导出的 CSV 常见 GBK
+def detect_encoding(path):
+    with open(path, "rb") as f:
+        sample = f.read(65536)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "gbk"
+
+# 逐行读取账单, 生成 (行字典, 已读字节数); CSV 的第一行为表头, JSON Lines 每行一个对象
+def read_statement(path):
+    encoding = detect_encoding(path)
+    with open(path, "rb") as f:
+        position = [0]
+
+        def lines():
+            for raw in f:
+                position[0] += len(raw)
+                yield raw.decode(encoding)
+
+        if path.lower().endswith((".jsonl", ".json", ".ndjson")):
+            for line in lines():
+                if line.strip():
+                    yield json.loads(line), position[0]
+        else:
+            for row in csv.DictReader(lines()):
+                yield row, position[0]
+
+def statement_columns(path):
+    for row, _ in read_statement(path):
+        return list(row)
+    return []
+
+def guess_import_mapping(columns):
+    mapping = {}
+    for field, names in IMPORT_COLUMN_NAMES.items():
+        stripped = {column.strip().lower(): column for column in columns}
+        mapping[field] = next((stripped[name.lower()] for name in names if name.lower() in stripped), None)
+    return mapping
+
+def load_category_rules():
+    try:
+        if os.path.exists("category_rules.json"):
+            with open("category_rules.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"加载分类规则失败: {e}")
+    return DEFAULT_CATEGORY_RULES
+
+def record_hash(date_text, description, cents, type_name):
+    key = f"{date_text}\x1f{description}\x1f{cents}\x1f{type_name}".encode("utf-8")
+    return hashlib.blake2b(key, digest_size=8).digest()
+
+# 账单导入流水线: 读取 -> 按列映射取字段 -> 规范化日期和金额 -> 按规则分类 -> 去重 -> 分批交给 on_batch
+class StatementImporter:
+    def __init__(self, mapping, rules=None, batch_size=IMPORT_BATCH_SIZE):
+        self.mapping = mapping
+        self.rules = rules if rules is not None else load_category_rules()
+        self.batch_size = batch_size
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @staticmethod
+    def normalize_date(text):
+        text = text.strip()
+        for fmt in IMPORT_DATE_FORMATS:
+            try:
+                return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+        raise ValueError(f"无法识别的日期: {text}")
+
+    @staticmethod
+    def normalize_amount(text):
+        if isinstance(text, (int, float)):
+            return float(text)
+        text = text.strip().replace(",", "").replace("¥", "").replace("￥", "").replace("元", "")
+        if text.startswith("(") and text.endswith(")"):
+            text = "-" + text[1:-1]
+        return float(text)
+
+    @staticmethod
+    def normalize_type(text, amount):
+        if text:
+            text = str(text).strip().lower()
+            return "收入" if "收" in text or "入" in text or text in ("income", "credit") else "支出"
+        return "收入" if amount > 0 else "支出"
+
+    def categorize(self, description):
+        for keyword, category in self.rules:
+            if keyword in description:
+                return category
+        return "其他"
+
+    def normalize(self, row):
+        def field(name):
+            column = self.mapping.get(name)
+            value = row.get(column) if column else None
+            return value if value is not None else ""
+
+        amount = self.normalize_amount(field('amount'))
+        description = str(field('description')).strip()
+        return {
+            'date': self.normalize_date(str(field('date'))),
+            'description': description,
+            'amount': abs(to_cents(amount)) / 100,
+            'type': self.normalize_type(field('type'), amount),
+            'category': str(field('category')).strip() or self.categorize(description)
+        }
+
+    # month_hashes(月份 "YYYY-MM") 返回这个月已有记录的内容计数, 每个月份在读到它的第一条交易时取一次,
+    # 此时本次导入还没有提交这个月的记录. 同一内容出现的次数超过已有次数的部分才算新记录,
+    # 这样重复导入同一份账单会被跳过, 而账单里本来就重复的交易不会丢
+    def run(self, path, month_hashes, on_batch, on_progress=None):
+        existing_counts = {}
+        seen = Counter()
+        stats = {'imported': 0, 'duplicates': 0, 'errors': 0, 'cancelled': False}
+        total = os.path.getsize(path) or 1
+        batch = []
+        for row, position in read_statement(path):
+            if self.cancel_event.is_set():
+                stats['cancelled'] = True
+                break
+            try:
+                rec = self.normalize(row)
+            except (ValueError, TypeError, AttributeError):
+                stats['errors'] += 1
+                continue
+            month = rec['date'][:7]
+            counts = existing_counts.get(month)
+            if counts is None:
+                counts = existing_counts[month] = month_hashes(month)
+            key = record_hash(rec['date'], rec['description'], to_cents(rec['amount']), rec['type'])
+            seen[key] += 1
+            if seen[key] <= counts[key]:
+                stats['duplicates'] += 1
+                continue
+            batch.append(rec)
+            if len(batch) >= self.batch_size:
+                on_batch(batch)
+                stats['imported'] += len(batch)
+                batch = []
+                if on_progress:
+                    on_progress(position * 100 // total)
+        if batch and not stats['cancelled']:
+            on_batch(batch)
+            stats['imported'] += len(batch)
+        return stats
+
+def create_storage(backend=STORAGE_BACKEND, read_only=False):
+    if backend == "sqlite":
+        return SqliteStorage(read_only=read_only)
+    if backend == "sharded":
+        return ShardedStorage(read_only=read_only)
+    if backend == "journal":
+        return JournalStorage(read_only)
+    return JsonStorage(read_only)
+
+# 预算引擎: 预算按 (月份键, 分类) 索引. 记录改动时只标记受影响的 (月份, 分类), evaluate 只重算
+# 这些分类的执行率, 返回状态有变化的分类和第一次达到 80% / 100% 的提醒
+class BudgetEngine:
+    # (执行率下限, 级别), 从高到低
+    THRESHOLDS = ((100, 2), (80, 1))
+
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+        self.budgets = {}
+        # 正在显示的月份键和其中每个分类的状态
+        self.month = None
+        self.states = {}
+        # 本月已经提醒过的 (分类, 级别), 执行率回落到级别以下后可以再次提醒
+        self.notified = set()
+        self.dirty = set()
+
+    def load(self, budgets):
+        self.budgets = {(month_key(budget['month']), budget['category']): budget for budget in budgets}
+        self.reset()
+
+    # 聚合结果整体变化之后 (重建, 分页加载) 重算所有分类, 已发出的提醒不重复
+    def reset(self):
+        self.states = {}
+
+    def get(self, month, category):
+        return self.budgets.get((month_key(month), category))
+
+    # budget 为 Ledger.budgets 中新增或修改过的一项
+    def set(self, budget):
+        key = (month_key(budget['month']), budget['category'])
+        self.budgets[key] = budget
+        self.dirty.add(key)
+
+    # 第 i 条记录写入之后 / 改动之前调用
+    def touch(self, records, i):
+        month = records.months[i]
+        if month >= 0 and records.strings[records.types[i]] == "支出":
+            code = records.categories[i]
+            self.dirty.add((month, records.strings[code] if code >= 0 else '其他'))
+
+    # (级别, 执行率, 实际支出 cents, 预算 cents), 没有预算时为 None
+    def state(self, month, category):
+        budget = self.budgets.get((month, category))
+        if budget is None:
+            return None
+        planned = to_cents(budget['amount'])
+        actual = self.aggregates.monthly.get(month, {}).get(category, 0)
+        percent = min(100, actual * 100 // planned) if planned > 0 else 0
+        level = next((level for limit, level in self.THRESHOLDS if percent >= limit), 0)
+        return level, percent, actual, planned
+
+    # month 为 "YYYY-MM", categories 为显示进度条的分类; notify 为 False 时 (如数据还没加载完) 不产生提醒.
+    # 返回 ({分类: 新状态}, [(分类, 级别)])
+    def evaluate(self, month, categories, notify=True):
+        month = month_key(month)
+        if month != self.month:
+            self.month = month
+            self.states = {}
+            self.notified = set()
+        categories = {category for key_month, category in self.dirty if key_month == month
+                      and category in categories} | {category for category in categories if category not in self.states}
+        self.dirty = set()
+
+        changed = {}
+        events = []
+        for category in categories:
+            state = self.state(month, category)
+            if category in self.states and self.states[category] == state:
+                continue
+            self.states[category] = changed[category] = state
+            level = state[0] if state else 0
+            self.notified = {(name, notified) for name, notified in self.notified
+                             if name != category or notified <= level}
+            if notify and level and (category, level) not in self.notified:
+                events.append((category, level))
+                self.notified.update((category, lower) for lower in range(1, level + 1))
+        return changed, events
+
+# 账本: 界面和脚本共用的数据接口. 记录的增删改同时维护聚合缓存和查询索引, 并交给后台线程保存
+class Ledger:
+    # paged 为 True 时不在构造时加载记录, 由调用方用 start_paged_load 在后台分页加载
+    def __init__(self, storage=None, on_save_status=None, paged=False):
+        self.categories = {
+            "支出": ["餐饮", "交通", "购物", "娱乐", "住房"],
+            "收入": ["工资", "奖金", "投资", "兼职"]
+        }
+        self.budgets = []
+        self.records = RecordColumns()
+        self.storage = storage or create_storage()
+        self.aggregates = AggregateCache()
+        self.budget_engine = BudgetEngine(self.aggregates)
+        self.loader = None
+        # 已请求读取其他实例的改动, 还没应用 (见 request_pull)
+        self.pulling = False
+
+        self.load_categories()
+        if not paged:
+            self.load_records()
+        self.load_budgets()
+        self.query_engine = QueryEngine(self.records)
+        self.reports = ReportEngine(self.records, self.query_engine)
+        self.writer = PersistenceWorker(self.storage, on_save_status)
+        if not paged:
+            self.records_loaded()
+
+    def get_all_categories(self):
+        all_categories = []
+        for type_categories in self.categories.values():
+            all_categories.extend(type_categories)
+        return sorted(list(set(all_categories)))
+
+    def load_categories(self):
+        try:
+            categories = self.storage.load_categories()
+            if categories:
+                self.categories = categories
+        except Exception as e:
+            print(f"加载分类数据失败: {e}")
+
+    def save_categories(self):
+        self.writer.submit(categories={type_name: list(names) for type_name, names in self.categories.items()})
+
+    # 读入期间持有写锁: 其他实例不会在读快照和日志之间压缩日志
+    def load_records(self):
+        with profiler.span("load"), self.storage.file_lock:
+            try:
+                records = self.storage.load_columns()
+                self.records = records if records is not None else \
+                    RecordColumns.from_records(self.storage.load_records())
+            except Exception as e:
+                print(f"加载记录失败: {e}")
+        profiler.count("records_loaded", len(self.records))
+        self.rebuild_aggregates()
+
+    # 记录读入之后: 新编号要大于所有已有编号, 给旧记录分配的编号尽快写回存储
+    def records_loaded(self):
+        self.records.next_id = max(self.records.next_id, self.storage.next_record_id())
+        if self.storage.ids_assigned:
+            self.save_records()
+
+    # 分片存储中没有读入的记录直接用清单中的聚合结果
+    def rebuild_aggregates(self):
+        self.aggregates.rebuild(self.records)
+        unloaded = self.storage.unloaded_aggregates()
+        if unloaded is not None:
+            self.aggregates.merge(unloaded)
+        self.budget_engine.reset()
+
+    # 把分片追加到 records 末尾, 聚合结果由清单中的换成实际记录的
+    def load_shards(self, names):
+        for name in names:
+            expected = self.storage.shard_aggregates(name)
+            with profiler.span("load", shard=name):
+                records = self.storage.load_shard(name)
+            start = len(self.records)
+            for rec in records:
+                self.records.append(rec)
+            self.aggregates.merge(expected, -1)
+            for i in range(start, len(self.records)):
+                self.aggregates.add(self.records, i)
+                self.reports.invalidate(self.records.months[i])
+            self.writer.record_changed("load_shard", None, name)
+        if names:
+            self.query_engine.reset()
+            self.records_loaded()
+        return bool(names)
+
+    def load_all_shards(self):
+        return self.load_shards(self.storage.unloaded_shards())
+
+    # 导入去重用: 月份 month ("YYYY-MM") 中已有记录的内容计数, 只读入这个月所在的分片
+    def month_hashes(self, month):
+        self.load_shards(self.storage.unloaded_shards(month, month))
+        records = self.records
+        key = month_key(month)
+        return Counter(record_hash(records.date(i), records.description(i), records.cents[i], records.type_name(i))
+                       for i, record_month in enumerate(records.months) if record_month == key)
+
+    # 分页加载期间 records 的长度已是总数, 但只有 [loader.first_row, len(records)) 的行可以读取,
+    # 不能增删改记录. on_page / on_finished 在加载线程中调用, 调用方应在自己的线程中执行
+    # page_loaded 和 finish_paged_load
+    def start_paged_load(self, on_page=None, on_finished=None, page_size=LOAD_PAGE_SIZE):
+        unloaded = self.storage.unloaded_aggregates()
+        if unloaded is not None:
+            self.aggregates.merge(unloaded)
+        self.loader = RecordLoader(self.storage, self.records, page_size, on_page, on_finished)
+        self.loader.start()
+        return self.loader
+
+    @property
+    def loading(self):
+        return self.loader is not None
+
+    def page_loaded(self, aggregates):
+        self.aggregates.merge(aggregates)
+        self.budget_engine.reset()
+
+    def finish_paged_load(self, error=None):
+        self.loader.thread.join()
+        if error is not None:
+            # 与一次性加载失败时一样, 从空账本开始
+            self.records.drop_front(len(self.records))
+            self.rebuild_aggregates()
+        elif self.loader.first_row:
+            self.records.drop_front(self.loader.first_row)
+        self.loader = None
+        self.query_engine.reset()
+        self.reports.reset()
+        self.budget_engine.reset()
+        self.records_loaded()
+
+    # 日志和数据库后端的改动已由 record_changed 交给后台线程, 这里只在需要整体保存或压缩日志时提交快照
+    def save_records(self):
+        if self.storage.needs_snapshot(len(self.records)):
+            self.writer.submit(snapshot=self.records.copy())
+
+    def load_budgets(self):
+        try:
+            self.budgets = self.storage.load_budgets()
+        except Exception as e:
+            print(f"加载预算数据失败: {e}")
+        self.budget_engine.load(self.budgets)
+
+    def save_budgets(self):
+        self.writer.submit(budgets=[dict(budget) for budget in self.budgets])
+
+    def get_budget(self, month, category):
+        return self.budget_engine.get(month, category)
+
+    def set_budget(self, month, category, amount):
+        budget = self.get_budget(month, category)
+        if budget:
+            budget['amount'] = amount
+        else:
+            budget = {'month': month, 'category': category, 'amount': amount}
+            self.budgets.append(budget)
+        self.budget_engine.set(budget)
+        self.save_budgets()
+
+    # 记录改动之后调用: 按需检查聚合缓存并保存
+    def records_changed(self):
+        if CHECK_AGGREGATES:
+            self.check_aggregates()
+        self.save_records()
+
+    # 记录写入 self.records 之后 / 改动之前, 同步聚合缓存和查询索引
+    def index_record(self, index):
+        self.aggregates.add(self.records, index)
+        self.query_engine.add(index)
+        self.reports.invalidate(self.records.months[index])
+        self.budget_engine.touch(self.records, index)
+
+    def unindex_record(self, index):
+        self.aggregates.remove(self.records, index)
+        self.query_engine.remove(index)
+        self.reports.invalidate(self.records.months[index])
+        self.budget_engine.touch(self.records, index)
+
+    # 编号所在的行, 分片存储会先读入可能包含它的分片; 记录不存在时抛出 KeyError
+    def record_row(self, record_id):
+        row = self.records.row_of(record_id)
+        if row < 0 and self.load_shards(self.storage.unloaded_shards_for_ids([record_id])):
+            row = self.records.row_of(record_id)
+        if row < 0:
+            raise KeyError(record_id)
+        return row
+
+    # 按编号取出记录
+    def get_record(self, record_id):
+        return self.records[self.record_row(record_id)]
+
+    # 返回新记录的编号; record 中的 'id' 会被忽略, 编号由存储层统一分配 (见 reserve_ids)
+    def add_record(self, record):
+        self.load_shards(self.storage.unloaded_shards_for([record['date']]))
+        self.records.append(dict(record, id=self.storage.reserve_ids(1, self.records.next_id)))
+        index = len(self.records) - 1
+        self.index_record(index)
+        record_id = self.records.ids[index]
+        self.writer.record_changed("add", record_id, self.records[index])
+        self.records_changed()
+        return record_id
+
+    def edit_record(self, record_id, record):
+        self.load_shards(self.storage.unloaded_shards_for([record['date']]))
+        index = self.record_row(record_id)
+        previous = self.records[index]
+        self.unindex_record(index)
+        self.records[index] = record
+        self.index_record(index)
+        self.writer.record_changed("edit", record_id, self.records[index], previous)
+        self.records_changed()
+
+    def delete_record(self, record_id):
+        index = self.record_row(record_id)
+        previous = self.records[index]
+        self.unindex_record(index)
+        del self.records[index]
+        self.writer.record_changed("delete", record_id, None, previous)
+        self.records_changed()
+
+    # 批量追加 (账单导入): 只更新聚合, 查询索引在下次查询时重建, 结束后由调用方执行 records_changed.
+    # 出现新分类时加入分类表并返回 True
+    def add_records(self, batch):
+        self.load_shards(self.storage.unloaded_shards_for({rec['date'] for rec in batch}))
+        ops = []
+        categories_changed = False
+        first_id = self.storage.reserve_ids(len(batch), self.records.next_id)
+        for offset, rec in enumerate(batch):
+            self.records.append(dict(rec, id=first_id + offset))
+            index = len(self.records) - 1
+            self.aggregates.add(self.records, index)
+            self.reports.invalidate(self.records.months[index])
+            self.budget_engine.touch(self.records, index)
+            ops.append(("add", self.records.ids[index], self.records[index], None))
+            if rec['category'] not in self.categories.setdefault(rec['type'], []):
+                self.categories[rec['type']].append(rec['category'])
+                categories_changed = True
+        self.query_engine.reset()
+        self.writer.submit(ops=ops)
+        return categories_changed
+
+    # 脚本接口 (ledger_api.py) 合并的一组改动: ops 为 [(op, 编号, 记录)], "add" 的编号被忽略.
+    # 全部应用后只提交一次保存; 返回 (每条的结果, 是否出现新分类), 结果为记录编号, 编辑或删除的记录不存在时为 None
+    def apply_ops(self, ops):
+        missing = [record_id for op, record_id, record in ops if op != "add" and self.records.row_of(record_id) < 0]
+        names = set(self.storage.unloaded_shards_for([record['date'] for op, record_id, record in ops
+                                                      if record is not None]))
+        self.load_shards(sorted(names.union(self.storage.unloaded_shards_for_ids(missing) if missing else ())))
+        adds = sum(1 for op, record_id, record in ops if op == "add")
+        next_id = self.storage.reserve_ids(adds, self.records.next_id) if adds else 0
+        results = []
+        writer_ops = []
+        categories_changed = False
+        for op, record_id, record in ops:
+            if op == "add":
+                record_id, next_id = next_id, next_id + 1
+                self.records.append(dict(record, id=record_id))
+                index = len(self.records) - 1
+                self.index_record(index)
+                writer_ops.append(("add", record_id, self.records[index], None))
+            else:
+                index = self.records.row_of(record_id)
+                if index < 0:
+                    results.append(None)
+                    continue
+                previous = self.records[index]
+                self.unindex_record(index)
+                if op == "edit":
+                    self.records[index] = record
+                    self.index_record(index)
+                    writer_ops.append(("edit", record_id, self.records[index], previous))
+                else:
+                    del self.records[index]
+                    writer_ops.append(("delete", record_id, None, previous))
+            results.append(record_id)
+            if record is not None and record['category'] not in self.categories.setdefault(record['type'], []):
+                self.categories[record['type']].append(record['category'])
+                categories_changed = True
+        if writer_ops:
+            self.writer.submit(ops=writer_ops)
+            self.records_changed()
+        if categories_changed:
+            self.save_categories()
+        return results, categories_changed
+
+    # 请求读取其他实例 (或导入脚本) 写入的改动: 保存线程写完已提交的改动后在写锁内读取, 把读到的内容交给
+    # on_pulled(data) (在保存线程中调用) 并暂停写入; 调用方回到自己的线程后执行 apply_pull(data).
+    # 调用方不等待写锁和文件读写. 上一次请求还没应用时返回 False
+    def request_pull(self, on_pulled):
+        if self.pulling:
+            return False
+        self.pulling = True
+        self.writer.submit(pull=on_pulled)
+        return True
+
+    # 把读到的改动逐条应用到记录、聚合、查询索引和预算上, 不重新读取整个账本. 返回实际生效的 [(op, 编号)]
+    # (同一条记录的多次改动已合并), 供界面逐行更新; 存储层无法给出增量时整体替换记录并返回 None.
+    # 请求之后本实例新提交、还没写入的改动不在读到的内容中, 这些记录以本实例的改动为准 (其他实例的删除除外),
+    # 与随后写入存储的结果一致
+    def apply_pull(self, data):
+        try:
+            if data is None:
+                return []
+            local = self.writer.pending_ops()
+            before = self.storage.unloaded_aggregates()
+            changes = self.storage.external_changes(data, self.records)
+            if isinstance(changes, RecordColumns):
+                self.records.adopt(changes)
+                for op, record_id, record, previous in local:
+                    apply_change(self.records, op, record_id, record)
+                self.rebuild_aggregates()
+                self.query_engine.reset()
+                self.reports.reset()
+                self.records_loaded()
+                changes = None
+            else:
+                changes = self.apply_external(changes, local, before)
+            # 暂停期间提交的快照不包含读到的改动, 换成新的快照
+            if local or self.writer.snapshot is not None:
+                self.save_records()
+            return changes
+        finally:
+            self.pulling = False
+            self.writer.resume()
+
+    def apply_external(self, changes, local, before):
+        after = self.storage.unloaded_aggregates()
+        if before is not None and after.diff(before):
+            self.aggregates.merge(before, -1)
+            self.aggregates.merge(after)
+            self.budget_engine.reset()
+        # 本实例新增的记录不会出现在其他实例的改动中 (分片对比时会被当作已删除)
+        added = {record_id for op, record_id, record, previous in local if op == "add"}
+        touched = {record_id for op, record_id, record, previous in local}
+        applied = {}
+        for op, record_id, record in changes:
+            if record_id in added or (record_id in touched and op != "delete"):
+                continue
+            row = self.records.row_of(record_id)
+            if row >= 0:
+                self.unindex_record(row)
+            if not apply_change(self.records, op, record_id, record):
+                if row >= 0:
+                    self.index_record(row)
+                continue
+            if op != "delete":
+                self.index_record(self.records.row_of(record_id))
+            if op == "delete" and applied.get(record_id) == "add":
+                del applied[record_id]
+            elif applied.get(record_id) != "add":
+                applied[record_id] = op
+        self.records.next_id = max(self.records.next_id, self.storage.next_record_id())
+        return [(op, record_id) for record_id, op in applied.items()]
+
+    # 同步读取并应用其他实例的改动 (脚本使用): 在当前线程中等待保存线程读完
+    def pull_changes(self):
+        pulled = []
+        done = threading.Event()
+
+        def on_pulled(data):
+            pulled.append(data)
+            done.set()
+
+        if not self.request_pull(on_pulled):
+            return []
+        done.wait()
+        return self.apply_pull(pulled[0])
+
+    # 返回满足条件的记录下标列表; 分片存储会先读入日期范围内的分片
+    def query(self, query):
+        self.load_shards(self.storage.unloaded_shards(query.date_from, query.date_to))
+        with profiler.span("query"):
+            rows = self.storage_query(query)
+            return rows if rows is not None else self.query_engine.run(query)
+
+    # 数据库后端在数据库中查询 (先等后台线程写完已提交的改动). 含关键字、正在分页加载, 或写入暂停着
+    # (正在应用其他实例的改动) 时返回 None, 由内存中的查询引擎处理. 其他实例新增、本实例还没读到的记录不在结果中
+    def storage_query(self, query):
+        if not self.storage.supports_queries or query.keyword or self.loading:
+            return None
+        self.writer.flush()
+        if self.writer.pending_ops():
+            return None
+        id_rows = self.records.id_rows
+        return [id_rows[record_id] for record_id in self.storage.query_ids(query) if record_id in id_rows]
+
+    # kind 为 REPORT_KINDS 中的键, 月份为 "YYYY-MM"; 分片存储会先读入区间内的分片.
+    # 返回 (表头, 行), 金额格式化为元, 可直接显示或导出 CSV
+    def report(self, kind, month_from, month_to):
+        self.load_shards(self.storage.unloaded_shards(month_from, month_to))
+        if kind == "budget":
+            return BUDGET_HEADER, [budget_row(*row) for row in
+                                   self.reports.budget_vs_actual(self.budgets, month_from, month_to)]
+        if kind == "type_year":
+            labels, table = self.reports.pivot(month_from, month_to, rows="type", columns="year")
+            header = ["类型"] + labels + ["合计"]
+        else:
+            labels, table = self.reports.pivot(month_from, month_to, rows="category", columns="month",
+                                               type_name="支出")
+            header = ["分类"] + labels + ["合计"]
+        rows, column_totals = pivot_rows(table, labels)
+        if kind == "category_month":
+            rows.append(total_row("合计", column_totals))
+        else:
+            balance = [table.get("收入", {}).get(label, 0) - table.get("支出", {}).get(label, 0) for label in labels]
+            rows.append(total_row("结余", balance))
+        return header, rows
+
+    # 有支出的各月每天的支出, 见 ReportEngine.daily_expenses. 分片存储只统计已读入的分片,
+    # 不为画趋势图读入全部历史; 每月的趋势由聚合结果得到, 不受影响
+    def daily_expenses(self):
+        unloaded = set(self.storage.unloaded_shards())
+        months = [month for month in sorted(self.aggregates.monthly) if shard_name(month) not in unloaded]
+        return self.reports.daily_expenses(months)
+
+    # 单位: 分
+    def get_total(self, type_name):
+        return self.aggregates.get_total(type_name)
+
+    # 单位: 元
+    def get_monthly_expenses(self, month):
+        with profiler.span("monthly_expenses"):
+            return {category: cents / 100
+                    for category, cents in self.aggregates.get_monthly_expenses(month).items()}
+
+    # 把聚合缓存与全量重算 (SQLite 后端还包括数据库中的结果) 对比, 不一致时打印差异并重建缓存
+    def check_aggregates(self):
+        problems = self.aggregates.verify(self.records, self.storage.unloaded_aggregates())
+        if self.storage.supports_queries:
+            # 等后台线程写完再查询数据库
+            self.writer.flush()
+            problems += [f"数据库: {p}" for p in self.aggregates.diff(self.storage.compute_aggregates())]
+        if problems:
+            print("聚合缓存不一致:\n" + "\n".join(problems))
+            self.rebuild_aggregates()
+        return not problems
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        self.storage.close()
+
+# 命令行汇总, 适合定时任务: python ledger.py [YYYY-MM]
+def main(argv):
+    month = argv[1] if len(argv) > 1 else datetime.now().strftime("%Y-%m")
+    ledger = Ledger()
+    try:
+        total_income = ledger.get_total("收入")
+        total_expense = ledger.get_total("支出")
+        print(f"记录数: {len(ledger.records)}")
+        print(f"总收入: {format_cents(total_income)} | 总支出: {format_cents(total_expense)} | "
+              f"结余: {format_cents(total_income - total_expense)}")
+        print(f"{month} 支出:")
+        for category, amount in sorted(ledger.get_monthly_expenses(month).items()):
+            budget = ledger.get_budget(month, category)
+            line = f"  {category}: ¥{amount:.2f}"
+            if budget:
+                line += f" (预算:¥{budget['amount']:.2f})"
+                if amount > budget['amount']:
+                    line += " 超支"
+            print(line)
+    finally:
+        ledger.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
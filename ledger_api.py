@@ -0,0 +1,440 @@
+# 本机脚本接口: 小票识别、银行导出等自动化脚本通过 HTTP/JSON 增删改查记录和预算, 不经过 RecordDialog.
+# 只监听 127.0.0.1 或 Unix 套接字. 同时到达的写请求合并为一组, 在账本所在线程中一次应用、只提交一次保存;
+# 界面模式下账本归界面线程所有, 改动应用后通知 MainWindow 逐行更新表格.
+# 网页中的脚本也能向本机端口发请求: Host 不是 127.0.0.1:<端口> 或 localhost:<端口> 的请求返回 403
+# (DNS 重绑定), 带请求体但 Content-Type 不是 application/json 的请求返回 415 (浏览器不经预检就能发出的表单请求).
+#
+#   python ledger_api.py --port 8765                  (无界面, 账本归事件循环线程所有)
+#   LEDGER_API=8765 python 77-源代码.py               (随主窗口在后台线程中启动; 也可以是 unix:/tmp/ledger.sock)
+#
+#   POST   /records          {"record": {...}} 或 {"records": [...]}   -> {"ids": [...]}
+#   GET    /records          ?date_from=&date_to=&type=&category=&keyword=&amount_min=&amount_max=&limit=&offset=
+#   GET    /records/<id>
+#   PUT    /records/<id>     {"record": {...}}
+#   DELETE /records/<id>
+#   POST   /batch            {"ops": [{"op": "add", "record": {...}}, {"op": "edit", "id": 1, "record": {...}},
+#                                     {"op": "delete", "id": 2}]}  -> {"results": [{"id": ...} 或 {"error": ...}]}
+#   GET    /budgets          ?month=YYYY-MM
+#   PUT    /budgets          {"month": "YYYY-MM", "category": "餐饮", "amount": 1000} 或 {"budgets": [...]}
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import ledger
+
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+# 请求体上限 (字节) 和一次提交合并的最多改动数
+API_MAX_BODY = 16 * 1024 * 1024
+API_MAX_BATCH = 20000
+# 查询默认和最多返回的记录数
+API_QUERY_LIMIT = 1000
+API_QUERY_MAX = 100000
+# 无界面运行时, 每隔这么多秒读取一次其他实例 (比如同时打开的主窗口) 写入的改动
+API_SYNC_INTERVAL = 1.0
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 415: "Unsupported Media Type", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+# 在当前线程中立即执行 fn, 结果放入 future (没有给出时新建); 无界面时账本归事件循环线程所有
+def run_now(fn, future=None):
+    future = future or Future()
+    if future.set_running_or_notify_cancel():
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+    return future
+
+# LEDGER_API 的值转换为 LedgerServer.serve 的参数
+def parse_address(text):
+    if text.startswith("unix:"):
+        return {'unix_path': text[5:]}
+    try:
+        return {'port': int(text)}
+    except ValueError:
+        raise ValueError(f"{ledger.API_ENV} 应为端口号或 unix:套接字路径")
+
+# 与 RecordDialog.get_data 相同的字段, 日期、金额和类型不合法时返回 400
+def parse_record(data):
+    if not isinstance(data, dict):
+        raise ApiError(400, "记录必须是 JSON 对象")
+    try:
+        datetime.strptime(str(data.get('date')), "%Y-%m-%d")
+    except ValueError:
+        raise ApiError(400, "日期格式应为 YYYY-MM-DD")
+    amount = data.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount):
+        raise ApiError(400, "金额必须是数字")
+    if data.get('type') not in ("收入", "支出"):
+        raise ApiError(400, "类型应为 收入 或 支出")
+    if not isinstance(data.get('category'), str) or not data['category']:
+        raise ApiError(400, "缺少分类")
+    return {'date': data['date'], 'description': str(data.get('description', '')), 'amount': float(amount),
+            'type': data['type'], 'category': data['category']}
+
+def parse_id(text):
+    try:
+        return int(text)
+    except ValueError:
+        raise ApiError(404, "记录不存在")
+
+def parse_budget(data):
+    if not isinstance(data, dict):
+        raise ApiError(400, "预算必须是 JSON 对象")
+    try:
+        datetime.strptime(str(data.get('month')), "%Y-%m")
+    except ValueError:
+        raise ApiError(400, "月份格式应为 YYYY-MM")
+    amount = data.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount):
+        raise ApiError(400, "金额必须是数字")
+    if not isinstance(data.get('category'), str) or not data['category']:
+        raise ApiError(400, "缺少分类")
+    return data['month'], data['category'], float(amount)
+
+# 查询参数转换为 RecordQuery, 与界面上的组合查询含义相同
+def parse_query(params):
+    def single(name):
+        values = params.get(name)
+        return values[-1] if values else None
+
+    query = ledger.RecordQuery(date_from=single("date_from"), date_to=single("date_to"),
+                               types=params.get("type"), categories=params.get("category"),
+                               keyword=single("keyword"))
+    for name in ("date_from", "date_to"):
+        if getattr(query, name):
+            try:
+                datetime.strptime(getattr(query, name), "%Y-%m-%d")
+            except ValueError:
+                raise ApiError(400, "日期格式应为 YYYY-MM-DD")
+    try:
+        for name in ("amount_min", "amount_max"):
+            if single(name) is not None:
+                setattr(query, name, float(single(name)))
+        limit = min(int(single("limit") or API_QUERY_LIMIT), API_QUERY_MAX)
+        offset = int(single("offset") or 0)
+    except ValueError:
+        raise ApiError(400, "金额、limit 和 offset 必须是数字")
+    return query, limit, offset
+
+# 一个请求中的写操作转换为 [(op, 编号, 记录)], 全部合法才提交
+def parse_ops(items):
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, "ops 必须是非空数组")
+    ops = []
+    for item in items:
+        if not isinstance(item, dict) or item.get('op') not in ("add", "edit", "delete"):
+            raise ApiError(400, "op 应为 add / edit / delete")
+        record_id = None
+        if item['op'] != "add":
+            if isinstance(item.get('id'), bool) or not isinstance(item.get('id'), int):
+                raise ApiError(400, "edit 和 delete 需要记录编号 id")
+            record_id = item['id']
+        record = parse_record(item.get('record')) if item['op'] != "delete" else None
+        ops.append((item['op'], record_id, record))
+    return ops
+
+class LedgerServer:
+    # execute(fn) 把 fn 交给账本所在的线程执行并返回 Future, 默认在事件循环线程中直接执行;
+    # on_change(changes, categories_changed) 在同一线程中、改动应用之后调用, changes 为 [(op, 编号)]
+    def __init__(self, ledger, execute=None, on_change=None, sync_interval=None):
+        self.ledger = ledger
+        self.execute = execute or run_now
+        self.on_change = on_change
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        # 允许的 Host 头 (小写), 监听端口之后才确定; Unix 套接字为 None, 不检查
+        self.allowed_hosts = None
+        # 等待提交的 (ops, 请求的 Future), 在事件循环中创建
+        self.queue = None
+        self.commits = 0
+        self.committed_ops = 0
+
+    # 在账本所在的线程中执行 fn
+    async def call(self, fn):
+        return await asyncio.wrap_future(self.execute(fn))
+
+    # 写请求排队, 由 commit_loop 与同时到达的其他请求合并提交; 返回与 ops 对应的结果
+    async def write(self, ops):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((ops, future))
+        return await future
+
+    # 上一组提交期间到达的请求合并为下一组, 负载越高每组越大, 空闲时单个请求立即提交
+    async def commit_loop(self):
+        while True:
+            groups = [await self.queue.get()]
+            count = len(groups[0][0])
+            while count < API_MAX_BATCH and not self.queue.empty():
+                groups.append(self.queue.get_nowait())
+                count += len(groups[-1][0])
+            ops = [op for group_ops, future in groups for op in group_ops]
+            try:
+                results = await self.call(lambda: self.commit(ops))
+            except Exception as e:
+                for group_ops, future in groups:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for group_ops, future in groups:
+                if not future.done():
+                    future.set_result(results[start:start + len(group_ops)])
+                start += len(group_ops)
+
+    # 以下在账本所在的线程中执行. 无界面时定期请求读取其他实例的改动, 读到的内容回到事件循环中应用
+    def check_ready(self):
+        if self.ledger.loading:
+            raise ApiError(503, "账本正在加载")
+        if self.sync_interval is not None and time.monotonic() - self.last_sync >= self.sync_interval:
+            self.last_sync = time.monotonic()
+            self.ledger.request_pull(lambda data: self.loop.call_soon_threadsafe(self.ledger.apply_pull, data))
+
+    def commit(self, ops):
+        self.check_ready()
+        with ledger.profiler.span("api_commit", ops=len(ops)):
+            results, categories_changed = self.ledger.apply_ops(ops)
+        self.commits += 1
+        self.committed_ops += len(ops)
+        if self.on_change:
+            changes = [(op, record_id) for (op, _, _), record_id in zip(ops, results) if record_id is not None]
+            self.on_change(changes, categories_changed)
+        return results
+
+    # 分片存储按编号或日期范围读入其他分片后, 界面模式下通知主窗口整体刷新表格
+    def shards_loaded(self, count):
+        if self.on_change and len(self.ledger.records) != count:
+            self.on_change([], False)
+
+    def get_record(self, record_id):
+        self.check_ready()
+        count = len(self.ledger.records)
+        try:
+            return self.ledger.get_record(record_id)
+        except KeyError:
+            raise ApiError(404, "记录不存在")
+        finally:
+            self.shards_loaded(count)
+
+    # 没有条件时列出全部记录, 分片存储要先读入所有分片
+    def query(self, query, limit, offset):
+        self.check_ready()
+        records = self.ledger.records
+        count = len(records)
+        if query.is_empty():
+            self.ledger.load_all_shards()
+            rows = range(len(records))
+        else:
+            rows = self.ledger.query(query)
+        self.shards_loaded(count)
+        return {'total': len(rows), 'records': [records[i] for i in rows[offset:offset + limit]]}
+
+    def budgets(self, month):
+        self.check_ready()
+        return [dict(budget) for budget in self.ledger.budgets if month is None or budget['month'] == month]
+
+    def set_budgets(self, budgets):
+        self.check_ready()
+        for month, category, amount in budgets:
+            self.ledger.set_budget(month, category, amount)
+        if self.on_change:
+            self.on_change([], False)
+        return len(budgets)
+
+    # headers 的键为小写; Content-Type 的参数 (如 charset) 不影响判断
+    def check_headers(self, headers, body):
+        if self.allowed_hosts is not None and headers.get("host", "").lower() not in self.allowed_hosts:
+            raise ApiError(403, "只接受发给本机地址的请求")
+        if body and headers.get("content-type", "").partition(";")[0].strip().lower() != "application/json":
+            raise ApiError(415, "请求体必须是 application/json")
+
+    # 返回 (状态码, JSON 数据)
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.strip("/").split("/") if part]
+        params = parse_qs(url.query)
+        data = None
+        if body:
+            try:
+                data = json.loads(body.decode("utf-8"))
+            except ValueError:
+                raise ApiError(400, "请求体不是合法的 JSON")
+        payload = data if isinstance(data, dict) else {}
+
+        if path == ["records"] and method == "POST":
+            items = payload['records'] if 'records' in payload else [payload.get('record')]
+            if not isinstance(items, list) or not items:
+                raise ApiError(400, "records 必须是非空数组")
+            ops = [("add", None, parse_record(item)) for item in items]
+            return 200, {'ids': await self.write(ops)}
+        if path == ["records"] and method == "GET":
+            query, limit, offset = parse_query(params)
+            return 200, await self.call(lambda: self.query(query, limit, offset))
+        if len(path) == 2 and path[0] == "records":
+            record_id = parse_id(path[1])
+            if method == "GET":
+                return 200, await self.call(lambda: self.get_record(record_id))
+            if method in ("PUT", "DELETE"):
+                record = parse_record(payload.get('record')) if method == "PUT" else None
+                op = "edit" if method == "PUT" else "delete"
+                if (await self.write([(op, record_id, record)]))[0] is None:
+                    raise ApiError(404, "记录不存在")
+                return 200, {'id': record_id}
+            raise ApiError(405, "不支持的方法")
+        if path == ["batch"] and method == "POST":
+            ops = parse_ops(payload.get('ops'))
+            results = await self.write(ops)
+            return 200, {'results': [{'id': record_id} if record_id is not None else {'error': "记录不存在"}
+                                     for record_id in results]}
+        if path == ["budgets"] and method == "GET":
+            month = params.get("month", [None])[-1]
+            return 200, {'budgets': await self.call(lambda: self.budgets(month))}
+        if path == ["budgets"] and method == "PUT":
+            items = payload['budgets'] if 'budgets' in payload else [payload]
+            if not isinstance(items, list) or not items:
+                raise ApiError(400, "budgets 必须是非空数组")
+            budgets = [parse_budget(item) for item in items]
+            return 200, {'updated': await self.call(lambda: self.set_budgets(budgets))}
+        if path and path[0] in ("records", "batch", "budgets"):
+            raise ApiError(405, "不支持的方法")
+        raise ApiError(404, "没有这个接口")
+
+    # 一个连接上的请求依次处理 (HTTP/1.1 默认保持连接), 脚本可以开多个连接并发写入
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length > API_MAX_BODY:
+                        raise ApiError(413, "请求体过大")
+                    body = await reader.readexactly(length) if length else b""
+                    self.check_headers(headers, body)
+                    status, result = await self.dispatch(method.upper(), target, body)
+                except ApiError as e:
+                    status, result = e.status, {'error': str(e)}
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {'error': f"请求不合法: {e}"}
+                except Exception as e:
+                    print(f"处理接口请求失败: {e}")
+                    status, result = 500, {'error': str(e)}
+                if status == 413:
+                    keep_alive = False
+                data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+                header = f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json; charset=utf-8\r\n" \
+                         f"Content-Length: {len(data)}\r\n"
+                if not keep_alive:
+                    header += "Connection: close\r\n"
+                writer.write(header.encode("ascii") + b"\r\n" + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port=API_PORT, unix_path=None, on_ready=None):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        committer = asyncio.ensure_future(self.commit_loop())
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.server = await asyncio.start_unix_server(self.handle, unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle, API_HOST, port)
+            # port 为 0 时由系统分配
+            port = self.server.sockets[0].getsockname()[1]
+            self.allowed_hosts = {f"{API_HOST}:{port}", f"localhost:{port}"}
+        print(f"脚本接口已启动: {unix_path or f'http://{API_HOST}:{port}'}")
+        if on_ready:
+            on_ready()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            committer.cancel()
+            if unix_path and os.path.exists(unix_path):
+                os.remove(unix_path)
+
+    # 界面模式: 在后台线程中运行事件循环, 启动失败 (比如端口被占用) 时抛出异常
+    def start_thread(self, **address):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                self.loop.run_until_complete(self.serve(on_ready=ready.set, **address))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                ready.set()
+                self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="ledger-api", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+
+    # 停止接收请求; 已提交的改动由调用方随后 flush / close 账本写入
+    def stop(self):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.thread.join(5)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="账本的本机 HTTP/JSON 接口")
+    parser.add_argument("--port", type=int, default=API_PORT, help="监听 127.0.0.1 上的端口")
+    parser.add_argument("--unix", help="改为监听 Unix 套接字")
+    parser.add_argument("--backend", default=ledger.STORAGE_BACKEND, help="存储后端")
+    args = parser.parse_args(argv)
+    book = ledger.Ledger(ledger.create_storage(args.backend))
+    server = LedgerServer(book, sync_interval=API_SYNC_INTERVAL)
+    try:
+        asyncio.run(server.serve(port=args.port, unix_path=args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        book.close()
+        print(f"已提交 {server.committed_ops} 条改动, 合并为 {server.commits} 次写入")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# consolidate.py 的测试: 各存储后端的账本目录只读聚合, 多个账本的合并和报表输出.
+#
+#   python -m pytest -q
+import csv
+import os
+import random
+
+import pytest
+
+import consolidate
+import ledger
+
+BACKENDS = ["json", "journal", "sqlite", "sharded"]
+CATEGORIES = {"支出": ["餐饮", "交通", "购物"], "收入": ["工资", "奖金"]}
+
+def make_records(count, seed):
+    rng = random.Random(seed)
+    records = []
+    for _ in range(count):
+        type_name = "支出" if rng.random() < 0.8 else "收入"
+        records.append({
+            'date': f"{rng.randint(2023, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            'description': f"记录 {rng.randint(1, 99)}",
+            'amount': round(rng.uniform(0.01, 500), 2),
+            'type': type_name,
+            'category': rng.choice(CATEGORIES[type_name]),
+        })
+    return records
+
+# 在 directory 中用 backend 建一个账本, 返回写入的记录
+def make_ledger(directory, backend, seed, budgets=()):
+    os.makedirs(directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        book = ledger.Ledger(ledger.create_storage(backend))
+        records = make_records(300, seed)
+        for rec in records:
+            book.add_record(rec)
+        for month, category, amount in budgets:
+            book.set_budget(month, category, amount)
+        book.close()
+    finally:
+        os.chdir(cwd)
+    return records
+
+def expected_aggregates(records, month_from, month_to):
+    columns = ledger.RecordColumns.from_records([rec for rec in records if month_from <= rec['date'][:7] <= month_to])
+    aggregates = ledger.AggregateCache()
+    aggregates.rebuild(columns)
+    return aggregates, len(columns)
+
+# 目录中每个文件的 (大小, 修改时间, 内容)
+def directory_state(directory):
+    state = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                state[path] = (os.path.getsize(path), os.path.getmtime(path), f.read())
+    return state
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_aggregate_ledger_is_read_only(tmp_path, backend):
+    directory = str(tmp_path / backend)
+    records = make_ledger(directory, backend, seed=1, budgets=[("2023-05", "餐饮", 800), ("2024-01", "交通", 50)])
+    before = directory_state(directory)
+    cwd = os.getcwd()
+
+    partial = consolidate.aggregate_ledger(backend, directory, "2023-03", "2023-11")
+    assert partial['error'] is None
+    expected, count = expected_aggregates(records, "2023-03", "2023-11")
+    assert partial['records'] == count
+    assert partial['aggregates'].diff(expected) == []
+    assert partial['budgets'] == {(202305, "餐饮"): 80000}
+    assert directory_state(directory) == before
+    assert os.getcwd() == cwd
+
+def test_aggregate_ledger_reports_missing_ledger(tmp_path):
+    partial = consolidate.aggregate_ledger("空", str(tmp_path), "2023-01", "2023-12")
+    assert partial['error'] and partial['records'] == 0
+
+# 合并结果与把所有记录放在一个账本中聚合相同, 同一 (月份, 分类) 的预算相加
+def test_merge_partials(tmp_path):
+    first = make_ledger(str(tmp_path / "a"), "json", seed=2, budgets=[("2024-02", "餐饮", 100)])
+    second = make_ledger(str(tmp_path / "b"), "sqlite", seed=3,
+                         budgets=[("2024-02", "餐饮", 50.5), ("2024-03", "购物", 20)])
+    partials = [consolidate.aggregate_ledger(name, str(tmp_path / name), "2024-01", "2024-12") for name in "ab"]
+    aggregates, budgets = consolidate.merge_partials(partials)
+    expected, count = expected_aggregates(first + second, "2024-01", "2024-12")
+    assert aggregates.diff(expected) == []
+    assert sum(partial['records'] for partial in partials) == count
+    assert budgets == {(202402, "餐饮"): 15050, (202403, "购物"): 2000}
+
+# 命令行: 汇总失败的账本不计入报表, 退出码为 1
+def test_main_writes_report(tmp_path):
+    make_ledger(str(tmp_path / "a"), "journal", seed=4)
+    make_ledger(str(tmp_path / "b"), "sharded", seed=5)
+    os.makedirs(tmp_path / "empty")
+    output = str(tmp_path / "report.csv")
+    directories = [str(tmp_path / name) for name in ("a", "b", "empty")]
+    assert consolidate.main(directories + ["--year", "2024", "--workers", "2", "--output", output]) == 1
+    with open(output, encoding="utf-8-sig") as f:
+        rows = list(csv.reader(f))
+    assert [row[0] for row in rows[1:3]] == directories[:2]
+    assert rows[3][0] == "合计"
+    assert int(rows[3][1]) == int(rows[1][1]) + int(rows[2][1])
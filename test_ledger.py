@@ -0,0 +1,476 @@
+# ledger.py 的测试: 各存储后端的保存/重新打开和崩溃恢复, 组合查询与关键字索引, SQLite 后端的查询和汇总, 聚合缓存的增量更新, 报表缓存, 预算提醒, 账单导入去重, 旧账本迁移到分片, 多个实例之间的同步.
+#
+#   python -m pytest -q
+import json
+import os
+import sqlite3
+import random
+import threading
+import zlib
+
+import pytest
+
+import ledger
+
+BACKENDS = ["json", "journal", "sqlite", "sharded"]
+CATEGORIES = {"支出": ["餐饮", "交通", "购物", "其他"], "收入": ["工资", "奖金"]}
+WORDS = ["美团外卖", "地铁", "工资", "超市", "咖啡", "Taxi", "年终奖", "房租"]
+
+# 每个测试在自己的临时目录中运行, 账本文件都写在当前目录
+@pytest.fixture(autouse=True)
+def ledger_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+# 确定性的随机记录, 跨三年; 部分支出没有分类 (旧版本的记录), 统计时归入 "其他"
+def make_records(count, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for _ in range(count):
+        type_name = "支出" if rng.random() < 0.8 else "收入"
+        rec = {
+            'date': f"{rng.randint(2022, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            'description': f"{rng.choice(WORDS)} {rng.randint(1, 99)}",
+            'amount': round(rng.uniform(0.01, 500), 2),
+            'type': type_name,
+        }
+        if type_name == "收入" or rng.random() < 0.9:
+            rec['category'] = rng.choice(CATEGORIES[type_name])
+        records.append(rec)
+    return records
+
+def open_ledger(backend):
+    return ledger.Ledger(ledger.create_storage(backend))
+
+# 编号 -> 记录; 分片存储先读入全部分片
+def contents(book):
+    book.load_all_shards()
+    return {rec['id']: rec for rec in book.records}
+
+def with_id(rec, record_id):
+    return dict(rec, id=record_id)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_round_trip(backend):
+    book = open_ledger(backend)
+    expected = {}
+    for rec in make_records(300):
+        expected[book.add_record(rec)] = rec
+    ids = sorted(expected)
+    for record_id in ids[:20]:
+        rec = dict(expected[record_id], description="改过", amount=1.5)
+        book.edit_record(record_id, rec)
+        expected[record_id] = rec
+    for record_id in ids[20:40]:
+        book.delete_record(record_id)
+        del expected[record_id]
+    book.set_budget("2023-05", "餐饮", 800)
+    book.close()
+
+    book = open_ledger(backend)
+    try:
+        assert contents(book) == {record_id: with_id(rec, record_id) for record_id, rec in expected.items()}
+        assert book.get_budget("2023-05", "餐饮")['amount'] == 800
+        assert book.check_aggregates()
+    finally:
+        book.close()
+
+# 新记录的编号不与重新打开之前的编号重复
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_ids_stay_unique_after_reopen(backend):
+    book = open_ledger(backend)
+    first = [book.add_record(rec) for rec in make_records(10)]
+    book.close()
+    book = open_ledger(backend)
+    try:
+        second = [book.add_record(rec) for rec in make_records(10, seed=1)]
+        assert not set(first) & set(second)
+        assert len(contents(book)) == 20
+    finally:
+        book.close()
+
+# 写入日志时崩溃: 末尾不完整的条目被丢弃并截断, 之前的改动都在
+def test_journal_recovers_torn_tail():
+    book = open_ledger("journal")
+    expected = {book.add_record(rec): rec for rec in make_records(50)}
+    book.close()
+    size = os.path.getsize("records.journal")
+    with open("records.journal", "ab") as f:
+        f.write(b'{"op": "add", "record": {"date": "2024-01-')
+
+    book = open_ledger("journal")
+    try:
+        assert contents(book) == {record_id: with_id(rec, record_id) for record_id, rec in expected.items()}
+        assert os.path.getsize("records.journal") == size
+    finally:
+        book.close()
+
+# 压缩时写完快照、重置日志之前崩溃: 日志头的校验值与快照不符, 日志中的条目已在快照里, 不再重放
+def test_journal_skips_entries_already_compacted():
+    rec = with_id(make_records(1)[0], 0)
+    with open("records.json", "w", encoding="utf-8") as f:
+        json.dump([rec], f, ensure_ascii=False)
+    with open("records.journal", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"snapshot_crc": 12345}) + "\n")
+        f.write(json.dumps(ledger.RecordJournal.entry("add", 0, rec), ensure_ascii=False) + "\n")
+
+    journal = ledger.RecordJournal()
+    assert journal.load() == [rec]
+    with open("records.json", "rb") as f:
+        crc = zlib.crc32(f.read())
+    with open("records.journal", "rb") as f:
+        assert json.loads(f.read()) == {"snapshot_crc": crc}
+
+# records.json 在二进制快照之后被改写 (比如旧版本保存过): 快照作废, 以 JSON 文件为准
+def test_stale_binary_snapshot_is_ignored():
+    book = open_ledger("json")
+    book.add_record(make_records(1)[0])
+    book.close()
+    assert os.path.exists(ledger.binary_snapshot_path("records.json"))
+    replaced = [with_id(rec, i) for i, rec in enumerate(make_records(3, seed=2))]
+    with open("records.json", "w", encoding="utf-8") as f:
+        json.dump(replaced, f, ensure_ascii=False)
+
+    book = open_ledger("json")
+    try:
+        assert list(book.records) == replaced
+    finally:
+        book.close()
+
+# 打开时映射的快照在保存时不被覆盖: 新快照写到按 records.json 的大小和修改时间命名的新文件, 旧文件随后删除
+def test_binary_snapshot_is_versioned():
+    with open(ledger.BINARY_SNAPSHOT_PATH, "wb") as f:
+        f.write(b"old")
+    book = open_ledger("json")
+    book.add_record(make_records(1)[0])
+    book.close()
+    first = ledger.binary_snapshot_path("records.json")
+    assert sorted(name for name in os.listdir() if name.endswith(".bin")) == [first]
+
+    book = open_ledger("json")
+    try:
+        assert book.records.mapping is not None
+        book.add_record(make_records(1, seed=1)[0])
+        book.flush()
+        second = ledger.binary_snapshot_path("records.json")
+        assert second != first
+        assert sorted(name for name in os.listdir() if name.endswith(".bin")) == [second]
+        assert len(book.records) == 2
+    finally:
+        book.close()
+    book = open_ledger("json")
+    try:
+        assert book.records.mapping is not None and len(book.records) == 2
+    finally:
+        book.close()
+
+# 不含关键字的组合查询在数据库中进行, 日期和分类条件走各自的索引, 结果与内存中的查询引擎相同
+def test_sqlite_queries_use_indexes():
+    book = open_ledger("sqlite")
+    try:
+        ids = [book.add_record(rec) for rec in make_records(500)]
+        for record_id in ids[:50]:
+            book.delete_record(record_id)
+        queries = [
+            ledger.RecordQuery(date_from="2023-02-01", date_to="2023-03-15"),
+            ledger.RecordQuery(categories=["餐饮", "交通"]),
+            ledger.RecordQuery(types=["收入"], amount_min=100, amount_max=300),
+            ledger.RecordQuery(date_from="2024-06-01", categories=["购物"], amount_max=50),
+        ]
+        for query in queries:
+            assert book.storage_query(query) is not None
+            assert sorted(book.query(query)) == sorted(book.query_engine.run(query))
+        assert book.storage_query(ledger.RecordQuery(keyword="地铁")) is None
+    finally:
+        book.close()
+    conn = sqlite3.connect(ledger.SQLITE_PATH)
+    plan = str(conn.execute("EXPLAIN QUERY PLAN SELECT id FROM records WHERE date >= ? AND date <= ?",
+                            ("2023-02-01", "2023-02-02")).fetchall())
+    assert "idx_records_date" in plan
+    plan = str(conn.execute("EXPLAIN QUERY PLAN SELECT id FROM records WHERE category IN (?)", ("购物",)).fetchall())
+    assert "idx_records_category" in plan
+    conn.close()
+
+# 数据库中的汇总与聚合缓存一致; 没有分类的支出和分类为 "其他" 的支出合并到同一项
+def test_sqlite_aggregates_match_database():
+    book = open_ledger("sqlite")
+    try:
+        for rec in make_records(300):
+            book.add_record(rec)
+        book.add_record({'date': "2023-03-01", 'description': "a", 'amount': 2, 'type': "支出"})
+        book.add_record({'date': "2023-03-02", 'description': "b", 'amount': 3, 'type': "支出", 'category': "其他"})
+        book.flush()
+        assert book.aggregates.diff(book.storage.compute_aggregates()) == []
+        assert book.check_aggregates()
+    finally:
+        book.close()
+
+# 增删改之后聚合缓存与全量重算一致; SQLite 后端还与数据库中的汇总对比
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_aggregate_cache_follows_changes(backend):
+    book = open_ledger(backend)
+    try:
+        ids = [book.add_record(rec) for rec in make_records(500)]
+        # 没有分类的支出和分类为 "其他" 的支出合并到同一项
+        ids.append(book.add_record({'date': "2023-03-01", 'description': "a", 'amount': 2, 'type': "支出"}))
+        ids.append(book.add_record({'date': "2023-03-02", 'description': "b", 'amount': 3, 'type': "支出",
+                                    'category': "其他"}))
+        assert book.aggregates.monthly[202303]["其他"] >= 500
+        rng = random.Random(2)
+        for step in range(200):
+            record_id = rng.choice(ids)
+            if step % 3 == 0:
+                ids.remove(record_id)
+                book.delete_record(record_id)
+            else:
+                book.edit_record(record_id, make_records(1, seed=step)[0])
+            assert book.aggregates.verify(book.records) == []
+        assert book.check_aggregates()
+    finally:
+        book.close()
+
+# 关键字查询的结果与逐条扫描描述相同; 只匹配到一种描述时返回的列表被修改也不影响索引
+def test_ngram_index_matches_substring_scan():
+    book = open_ledger("json")
+    try:
+        for rec in make_records(400):
+            book.add_record(rec)
+        book.add_record({'date': "2023-03-01", 'description': "独一无二", 'amount': 2, 'type': "支出"})
+        index = book.query_engine.build_text_index()
+        for keyword in ["地铁", "taxi", "外", "1", "咖啡 7", "没有的词", "独一无二"]:
+            expected = sorted(rec['id'] for rec in book.records if keyword in rec['description'].lower())
+            assert list(index.search_ids(keyword)) == expected
+        found = index.search_ids("独一无二")
+        found.append(-1)
+        assert list(index.search_ids("独一无二")) == found[:-1]
+    finally:
+        book.close()
+
+# 逐行扫描的对照实现
+def linear_query(records, query):
+    rows = []
+    for i, rec in enumerate(records):
+        if query.date_from and rec['date'] < query.date_from:
+            continue
+        if query.date_to and rec['date'] > query.date_to:
+            continue
+        if query.types and rec['type'] not in query.types:
+            continue
+        if query.categories and rec.get('category') not in query.categories:
+            continue
+        if query.amount_min is not None and ledger.to_cents(rec['amount']) < ledger.to_cents(query.amount_min):
+            continue
+        if query.amount_max is not None and ledger.to_cents(rec['amount']) > ledger.to_cents(query.amount_max):
+            continue
+        if query.keyword and query.keyword not in rec['description'].lower():
+            continue
+        rows.append(i)
+    return rows
+
+def random_query(rng):
+    options = {}
+    if rng.random() < 0.5:
+        options['date_from'] = f"{rng.randint(2022, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    if rng.random() < 0.5:
+        options['date_to'] = f"{rng.randint(2022, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    if rng.random() < 0.3:
+        options['types'] = [rng.choice(list(CATEGORIES))]
+    if rng.random() < 0.3:
+        options['categories'] = rng.sample(CATEGORIES["支出"] + CATEGORIES["收入"], rng.randint(1, 2))
+    if rng.random() < 0.3:
+        options['amount_min'] = round(rng.uniform(0, 300), 2)
+    if rng.random() < 0.3:
+        options['amount_max'] = round(rng.uniform(100, 500), 2)
+    if rng.random() < 0.4:
+        word = rng.choice(WORDS)
+        start = rng.randint(0, len(word) - 1)
+        options['keyword'] = word[start:start + rng.randint(1, 3)]
+    return ledger.RecordQuery(**options)
+
+def test_query_matches_linear_scan():
+    book = open_ledger("json")
+    try:
+        ids = [book.add_record(rec) for rec in make_records(2000)]
+        rng = random.Random(1)
+        for round_number in range(3):
+            for _ in range(100):
+                query = random_query(rng)
+                assert sorted(book.query(query)) == linear_query(book.records, query)
+            # 改动之后索引增量更新, 结果仍与逐行扫描一致
+            for record_id in rng.sample(ids, 50):
+                ids.remove(record_id)
+                book.delete_record(record_id)
+            for record_id in rng.sample(ids, 50):
+                book.edit_record(record_id, make_records(1, seed=round_number * 1000 + record_id)[0])
+            ids += [book.add_record(rec) for rec in make_records(50, seed=round_number + 10)]
+    finally:
+        book.close()
+
+# 重复导入同一份账单全部跳过; 账单里本来就重复的交易都导入; 去重只读入账单涉及的月份的分片
+def test_import_skips_duplicates():
+    with open("statement.csv", "w", encoding="utf-8") as f:
+        f.write("日期,摘要,金额\n")
+        for i in range(300):
+            f.write(f"2024/{i % 3 + 1:02d}/{i % 28 + 1:02d},拿铁 {i % 7},-{i % 5 + 1}.5\n")
+        f.write("不是日期,咖啡,-1\n")
+    mapping = {'date': "日期", 'description': "摘要", 'amount': "金额"}
+    book = open_ledger("sharded")
+    for rec in make_records(200):
+        book.add_record(rec)
+    book.close()
+
+    book = open_ledger("sharded")
+    try:
+        stats = ledger.StatementImporter(mapping, batch_size=50).run("statement.csv", book.month_hashes,
+                                                                      book.add_records)
+        assert (stats['imported'], stats['duplicates'], stats['errors']) == (300, 0, 1)
+        assert book.storage.unloaded_shards("2024-01", "2024-03") == []
+        assert book.storage.unloaded_shards("2022-01", "2022-12") != []
+        stats = ledger.StatementImporter(mapping).run("statement.csv", book.month_hashes, book.add_records)
+        assert (stats['imported'], stats['duplicates'], stats['errors']) == (0, 300, 1)
+        assert sum(1 for rec in contents(book).values() if rec['description'].startswith("拿铁 ")) == 300
+        assert book.check_aggregates()
+    finally:
+        book.close()
+
+# 旧版本的 records.json 没有编号: 按位置编号, 迁移到分片后编号不变
+def test_sharded_migrates_legacy_json():
+    records = make_records(120)
+    with open("records.json", "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False)
+    book = open_ledger("sharded")
+    try:
+        assert contents(book) == {i: with_id(rec, i) for i, rec in enumerate(records)}
+    finally:
+        book.close()
+
+# 报表按月缓存: 再次生成不重新计算, 改动一条记录只重算它所在的月份, 结果与清空缓存后重算相同
+def test_reports_recompute_changed_months_only(monkeypatch):
+    book = open_ledger("json")
+    try:
+        ids = [book.add_record(rec) for rec in make_records(500)]
+        computed = []
+        compute = book.reports.compute
+        monkeypatch.setattr(book.reports, "compute", lambda months: computed.append(sorted(months)) or compute(months))
+        first = book.report("category_month", "2023-01", "2023-12")
+        assert computed == [list(range(202301, 202313))]
+        assert book.report("category_month", "2023-01", "2023-12") == first
+        assert len(computed) == 1
+
+        record_id = next(record_id for record_id in ids if book.get_record(record_id)['date'].startswith("2023-05"))
+        book.edit_record(record_id, dict(book.get_record(record_id), amount=12345.67, type="支出", category="餐饮"))
+        computed.clear()
+        assert book.report("category_month", "2023-01", "2023-12") != first
+        assert computed == [[202305]]
+        for kind in ledger.REPORT_KINDS:
+            report = book.report(kind, "2023-01", "2023-12")
+            book.reports.reset()
+            assert book.report(kind, "2023-01", "2023-12") == report
+    finally:
+        book.close()
+
+# 预算引擎只重算改动涉及的 (月份, 分类); 达到 80% / 100% 各提醒一次, 回落到 80% 以下后可以再次提醒
+def test_budget_alerts_follow_dirty_categories(monkeypatch):
+    book = open_ledger("json")
+    try:
+        book.set_budget("2024-05", "餐饮", 100)
+        book.set_budget("2024-05", "交通", 100)
+        engine = book.budget_engine
+        evaluated = []
+        state = engine.state
+        monkeypatch.setattr(engine, "state", lambda month, category: evaluated.append(category) or state(month, category))
+        categories = ["餐饮", "交通", "购物"]
+
+        def spend(amount, category="餐饮", day="2024-05-10"):
+            evaluated.clear()
+            record_id = book.add_record({'date': day, 'description': "x", 'amount': amount, 'type': "支出",
+                                         'category': category})
+            return record_id, engine.evaluate("2024-05", categories)
+
+        changed, events = engine.evaluate("2024-05", categories)
+        assert changed == {"餐饮": (0, 0, 0, 10000), "交通": (0, 0, 0, 10000), "购物": None} and events == []
+        assert spend(50)[1] == ({"餐饮": (0, 50, 5000, 10000)}, [])
+        assert evaluated == ["餐饮"]
+        first, (changed, events) = spend(35)
+        assert events == [("餐饮", 1)]
+        assert spend(10)[1][1] == []
+        assert spend(20)[1][1] == [("餐饮", 2)]
+        assert spend(5)[1] == ({"餐饮": (2, 100, 12000, 10000)}, [])
+        # 其他月份的改动不触发重算, 没有预算的分类状态不变
+        spend(30, day="2024-06-01")
+        assert evaluated == []
+        assert spend(30, category="购物")[1] == ({}, [])
+
+        evaluated.clear()
+        book.delete_record(first)
+        book.edit_record(first + 1, dict(book.get_record(first + 1), amount=1))
+        assert engine.evaluate("2024-05", categories) == ({"餐饮": (0, 76, 7600, 10000)}, [])
+        assert spend(10)[1][1] == [("餐饮", 1)]
+        assert evaluated == ["餐饮"]
+    finally:
+        book.close()
+
+# 两个实例打开同一个账本: 各自的增删改在对方读取改动之后一致, 保存时不覆盖对方的改动
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_instances_merge_changes(backend):
+    first = open_ledger(backend)
+    second = open_ledger(backend)
+    try:
+        records = make_records(40)
+        first_ids = [first.add_record(rec) for rec in records[:20]]
+        second_ids = [second.add_record(rec) for rec in records[20:]]
+        first.flush()
+        second.flush()
+        first.pull_changes()
+        second.pull_changes()
+        assert contents(first) == contents(second)
+        assert len(contents(first)) == 40
+
+        first.edit_record(second_ids[0], dict(records[20], description="第一个实例改的"))
+        second.delete_record(first_ids[0])
+        first.flush()
+        second.flush()
+        first.pull_changes()
+        second.pull_changes()
+        assert contents(first) == contents(second)
+        assert first_ids[0] not in contents(first)
+        assert contents(second)[second_ids[0]]['description'] == "第一个实例改的"
+        assert first.aggregates.verify(first.records) == []
+        assert second.aggregates.verify(second.records) == []
+    finally:
+        first.close()
+        second.close()
+
+    book = open_ledger(backend)
+    try:
+        assert len(contents(book)) == 39
+    finally:
+        book.close()
+
+# 读取其他实例的改动之后、应用之前批量导入的记录: 应用时以本实例新增的记录为准, 随后正常写入并被对方读到
+def test_add_records_while_pulling():
+    first = open_ledger("sqlite")
+    second = open_ledger("sqlite")
+    try:
+        # 导入的记录都有分类
+        records = [dict(rec, category=rec.get('category', "其他")) for rec in make_records(30)]
+        second_ids = [second.add_record(rec) for rec in records[:10]]
+        second.flush()
+        pulled = []
+        done = threading.Event()
+        assert first.request_pull(lambda data: (pulled.append(data), done.set()))
+        done.wait()
+        first.add_records(records[10:20])
+        first.apply_pull(pulled[0])
+        first.add_records(records[20:])
+        first.pull_changes()
+        first.flush()
+        second.pull_changes()
+        assert contents(first) == contents(second)
+        assert len(contents(second)) == 30
+        assert set(second_ids) <= set(contents(first))
+        assert first.aggregates.verify(first.records) == []
+        assert second.aggregates.verify(second.records) == []
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,101 @@
+# ledger_api.py 的测试: 记录和预算的增删改查, 批量改动, 只接受发给本机地址的 JSON 请求.
+#
+#   python -m pytest -q
+import http.client
+import json
+from urllib.parse import urlencode
+
+import pytest
+
+import ledger
+import ledger_api
+
+RECORD = {'date': "2024-03-05", 'description': "美团外卖", 'amount': 32.5, 'type': "支出", 'category': "餐饮"}
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    book = ledger.Ledger(ledger.create_storage("json"))
+    server = ledger_api.LedgerServer(book)
+    server.start_thread(port=0)
+    try:
+        yield book, server.server.sockets[0].getsockname()[1]
+    finally:
+        server.stop()
+        book.close()
+
+# 返回 (状态码, JSON 数据); 有请求体时默认带上 Content-Type: application/json
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        data = None
+        if body is not None:
+            data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode("utf-8")
+            headers = dict({"Content-Type": "application/json"}, **(headers or {}))
+        connection.request(method, path, body=data, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+def test_records_crud(api):
+    book, port = api
+    status, result = request(port, "POST", "/records", {'records': [RECORD, dict(RECORD, description="地铁",
+                                                                                amount=4, category="交通")]})
+    assert status == 200
+    first, second = result['ids']
+    assert request(port, "GET", f"/records/{first}") == (200, dict(RECORD, id=first))
+
+    edited = dict(RECORD, amount=40)
+    assert request(port, "PUT", f"/records/{first}", {'record': edited}) == (200, {'id': first})
+    assert book.get_record(first) == dict(edited, id=first)
+    status, result = request(port, "GET", "/records?" + urlencode({'category': "交通", 'date_from': "2024-03-01"}))
+    assert status == 200 and result['total'] == 1 and result['records'][0]['id'] == second
+
+    assert request(port, "DELETE", f"/records/{second}") == (200, {'id': second})
+    assert request(port, "GET", f"/records/{second}")[0] == 404
+    assert request(port, "DELETE", f"/records/{second}")[0] == 404
+    assert request(port, "GET", "/records")[1]['total'] == 1
+    assert book.check_aggregates()
+
+def test_batch_and_budgets(api):
+    book, port = api
+    first = book.add_record(dict(RECORD))
+    ops = [{'op': "add", 'record': RECORD}, {'op': "edit", 'id': first, 'record': dict(RECORD, amount=1)},
+           {'op': "delete", 'id': 12345}]
+    status, result = request(port, "POST", "/batch", {'ops': ops})
+    assert status == 200
+    assert result['results'][1:] == [{'id': first}, {'error': "记录不存在"}]
+    assert len(book.records) == 2 and book.get_record(first)['amount'] == 1
+
+    assert request(port, "PUT", "/budgets", {'month': "2024-03", 'category': "餐饮", 'amount': 800}) == \
+        (200, {'updated': 1})
+    assert request(port, "GET", "/budgets?month=2024-03") == \
+        (200, {'budgets': [{'month': "2024-03", 'category': "餐饮", 'amount': 800.0}]})
+
+# 不合法的请求不改动账本
+def test_invalid_requests(api):
+    book, port = api
+    assert request(port, "POST", "/records", {'record': dict(RECORD, date="2024/03/05")})[0] == 400
+    assert request(port, "POST", "/records", {'record': dict(RECORD, amount="12")})[0] == 400
+    assert request(port, "POST", "/records", b"{not json")[0] == 400
+    assert request(port, "POST", "/batch", {'ops': [{'op': "edit", 'record': RECORD}]})[0] == 400
+    assert request(port, "GET", "/records/abc")[0] == 404
+    assert request(port, "GET", "/nothing")[0] == 404
+    assert request(port, "PATCH", "/records")[0] == 405
+    assert len(book.records) == 0
+
+# Host 不是本机地址的请求 (DNS 重绑定) 和不是 JSON 的请求体 (网页表单) 被拒绝
+def test_rejects_foreign_host_and_non_json_body(api):
+    book, port = api
+    assert request(port, "GET", "/records", headers={"Host": f"evil.example:{port}"})[0] == 403
+    assert request(port, "POST", "/records", {'record': RECORD}, headers={"Host": "127.0.0.1:1"})[0] == 403
+    assert request(port, "POST", "/records", {'record': RECORD}, headers={"Content-Type": "text/plain"})[0] == 415
+    assert request(port, "POST", "/records", b"record=1",
+                   headers={"Content-Type": "application/x-www-form-urlencoded"})[0] == 415
+    assert len(book.records) == 0
+
+    assert request(port, "GET", "/records", headers={"Host": f"localhost:{port}"})[0] == 200
+    status, result = request(port, "POST", "/records", {'record': RECORD},
+                             headers={"Content-Type": "application/json; charset=utf-8"})
+    assert status == 200 and len(result['ids']) == 1